@@ -13,14 +13,10 @@ BOT_DIR=$(pwd)
 # Создаем директорию для бэкапов
 mkdir -p $BACKUP_DIR
 
-echo "📁 Создаем резервную копию базы данных..."
-# Копируем базу данных
-if [ -f "$BOT_DIR/data/vape_shop_new.db" ]; then
-    cp "$BOT_DIR/data/vape_shop_new.db" "$BACKUP_DIR/vape_shop_$DATE.db"
-    echo "✅ База данных скопирована: vape_shop_$DATE.db"
-else
-    echo "⚠️  База данных не найдена"
-fi
+# База данных копируется самим ботом: ежедневный снимок через SQLite backup API
+# со сжатием, проверкой целостности и ротацией в data/backups/ (команды /backup, /restore).
+# Простое cp работающей базы может дать испорченную копию, поэтому здесь базу не копируем.
+echo "💾 Снимки базы: $BOT_DIR/data/backups (создаются ботом)"
 
 echo "📁 Создаем резервную копию товаров..."
 # Копируем резервные копии товаров
@@ -43,15 +39,12 @@ fi
 echo "📁 Создаем резервную копию конфигурации..."
 # Копируем конфигурационные файлы
 cp "$BOT_DIR/.env" "$BACKUP_DIR/.env_$DATE" 2>/dev/null || echo "⚠️  Файл .env не найден"
-cp "$BOT_DIR/main.py" "$BACKUP_DIR/main.py_$DATE" 2>/dev/null || echo "⚠️  Файл main.py не найден"
 
 echo "🧹 Очищаем старые бэкапы (старше 30 дней)..."
 # Удаляем старые бэкапы
-find $BACKUP_DIR -name "*.db" -mtime +30 -delete 2>/dev/null
 find $BACKUP_DIR -name "csv_files_*" -mtime +30 -exec rm -rf {} \; 2>/dev/null
 find $BACKUP_DIR -name "logs_*" -mtime +30 -exec rm -rf {} \; 2>/dev/null
 find $BACKUP_DIR -name ".env_*" -mtime +30 -delete 2>/dev/null
-find $BACKUP_DIR -name "main.py_*" -mtime +30 -delete 2>/dev/null
 
 echo "📊 Статистика резервного копирования:"
 echo "  📁 Директория бэкапов: $BACKUP_DIR"
@@ -62,7 +55,7 @@ echo ""
 echo "✅ Резервное копирование завершено!"
 echo ""
 echo "📋 Для восстановления используйте:"
-echo "  cp $BACKUP_DIR/vape_shop_$DATE.db $BOT_DIR/data/vape_shop_new.db"
+echo "  команду /restore в боте (база восстанавливается без остановки)"
 echo "  cp -r $BACKUP_DIR/csv_files_$DATE/* $BOT_DIR/csv_files/"
 echo ""
 echo "⏰ Для автоматического бэкапа добавьте в crontab:"
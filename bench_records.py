@@ -0,0 +1,62 @@
+"""Сравнение памяти: записи-словари против NamedTuple из utils/models.py.
+
+Запуск: python bench_records.py [товаров] [заказов]
+"""
+import sys
+import tracemalloc
+
+from utils.models import Product, OrderItem, Order
+
+def make_product_dicts(count):
+    return [
+        {'id': i, 'category': f"Категория {i % 20}", 'name': f"Товар {i}", 'cost': 100.0 + i,
+         'quantity': i % 50, 'image_path': '', 'description': ''}
+        for i in range(count)
+    ]
+
+def make_products(count):
+    return [
+        Product(i, f"Категория {i % 20}", f"Товар {i}", 100.0 + i, i % 50, '', '')
+        for i in range(count)
+    ]
+
+def make_order_dicts(count):
+    return [
+        {'id': i, 'user_id': i % 1000, 'user_name': f"user{i % 1000}", 'total_price': 500.0,
+         'location': 'Центр', 'comment': '', 'status': 'completed', 'created_at': '2024-01-01 12:00:00',
+         'order_data': {f"Товар {i % 300}": 1, f"Товар {(i + 1) % 300}": 2}}
+        for i in range(count)
+    ]
+
+def make_orders(count):
+    return [
+        Order(i, i % 1000, f"user{i % 1000}", 500.0, 'Центр', '', 'completed', '2024-01-01 12:00:00',
+              (OrderItem(i % 300, f"Товар {i % 300}", 100.0, 1),
+               OrderItem((i + 1) % 300, f"Товар {(i + 1) % 300}", 200.0, 2)))
+        for i in range(count)
+    ]
+
+def measure(build, count):
+    tracemalloc.start()
+    data = build(count)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return size, peak
+
+def main():
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    orders = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+
+    cases = [
+        (f"товары, dict ({products})", make_product_dicts, products),
+        (f"товары, Product ({products})", make_products, products),
+        (f"заказы, dict ({orders})", make_order_dicts, orders),
+        (f"заказы, Order ({orders})", make_orders, orders),
+    ]
+    for title, build, count in cases:
+        size, peak = measure(build, count)
+        print(f"{title:<32} {size / 1024 / 1024:8.1f} МБ (пик {peak / 1024 / 1024:.1f} МБ)")
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,76 @@ ADMIN_ID = int(os.getenv('ADMIN_ID'))
 
 # Пути к файлам
 DB_PATH = 'data/vape_shop_new.db'  # Изменил название БД для нового бота
+CART_JOURNAL_PATH = 'data/carts.journal'
 IMAGES_DIR = 'images/products/'
 CSV_DIR = 'csv_files/'
 LOGS_DIR = 'logs/'
 
+# Резервные копии базы: каталог, час ежедневного снимка, сколько хранить
+BACKUP_DIR = 'data/backups/'
+BACKUP_HOUR = 3
+BACKUP_KEEP = 14
+BACKUP_MAX_AGE_DAYS = 30
+
+# Архив заказов: через сколько дней завершённые/отменённые заказы уходят из горячей таблицы
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_INTERVAL = 3600  # секунды между запусками
+
+# Как часто корзины из памяти сбрасываются в базу (секунды)
+CART_FLUSH_INTERVAL = 0.5
+
+# Как часто состояние диалогов и user_data сохраняется в базу (секунды)
+PERSISTENCE_FLUSH_INTERVAL = 5
+
+# Отбрасывать ли сообщения, пришедшие, пока бот был выключен.
+# Диалоги переживают перезапуск, поэтому по умолчанию сообщения обрабатываются.
+DROP_PENDING_UPDATES = os.getenv('DROP_PENDING_UPDATES', '0') == '1'
+
+# Получение обновлений: 'polling' (long polling) или 'webhook' (встроенный HTTP-сервер)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Webhook: адрес и порт сервера, публичный URL, секретная часть пути и TLS.
+# Telegram шлёт обновления на WEBHOOK_URL/<путь>; путь по умолчанию - WEBHOOK_SECRET,
+# поэтому посторонний запрос, не зная секрета, не попадёт в обработчик.
+# Без секрета (или такого же длинного WEBHOOK_PATH) бот в режиме webhook не стартует.
+# Сертификат и ключ нужны, только если TLS завершается на самом боте.
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH') or WEBHOOK_SECRET
+WEBHOOK_MIN_PATH = 16
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT')
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# Потоки обработчиков: обновления одного чата идут по порядку, разных чатов - параллельно.
+# Пул HTTP-соединений к Bot API: обработчики + служебные потоки PTB (опрос, задачи, run_async)
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '16'))
+
+# Очередь исходящих сообщений: потоки отправки и лимиты Telegram
+# (сообщений в секунду на бота, на личный чат и пачка подряд в один чат)
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+OUTBOX_GLOBAL_RATE = 30
+OUTBOX_CHAT_RATE = 1
+OUTBOX_CHAT_BURST = 3
+
+CON_POOL_SIZE = int(os.getenv('CON_POOL_SIZE', str(BOT_WORKERS + OUTBOX_WORKERS + 8)))
+
+# Рассылки: получателей в пачке и пауза между проверками очереди (секунды)
+BROADCAST_BATCH = 25
+BROADCAST_INTERVAL = 1.0
+
+# Процессы пережатия фото, присланных администратором
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 - не запускать)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# Другой сервер Bot API (локальный telegram-bot-api или тестовый), например http://127.0.0.1:8081/bot
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
 # Создаем необходимые директории
 os.makedirs('data', exist_ok=True)
 os.makedirs('images/products', exist_ok=True)
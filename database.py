@@ -1,284 +1,1188 @@
 import os
 import sqlite3
+import itertools
 import json
 import logging
-from typing import Dict, List, Optional, Any
+from decimal import Decimal
+from io import StringIO
+from typing import Dict, List, Optional, Any, Callable, Iterable, Set, TextIO, Union
+
+from utils.catalog_cache import CatalogCache
+from utils.db_executor import DBExecutor
+from utils.cart_store import CartStore
+from utils.models import Product, OrderItem, Order, Broadcast
+from utils.pricing import price_cart
+from utils.search import SEARCH_LIMIT, FUZZY_CANDIDATES, prefix_query, trigram_query, rank_fuzzy, prefix_scan
+from utils.backup import create_backup, unpack_backup, restore_into
+from utils.csv_import import ImportReport, iter_product_rows, iter_batches, IMPORT_BATCH_SIZE
+from utils.metrics import metrics, timed_methods
 
 logger = logging.getLogger(__name__)
 
+# Настройки подключений SQLite
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KB = 8192
+# Потоков-читателей в пуле исполнителя
+DB_READERS = 4
+# Статусы заказов, которые можно переносить в архив
+ARCHIVE_STATUSES = ('completed', 'cancelled')
+
+# Сколько параметров подставлять в один WHERE ... IN (...)
+SQL_IN_CHUNK = 500
+
+class CheckoutAborted(Exception):
+    """Откат транзакции оформления заказа с результатом для вызывающего кода"""
+
+    def __init__(self, result: Dict):
+        super().__init__("checkout aborted")
+        self.result = result
+
+@timed_methods('bot_db_call_seconds', 'bot_db_call_errors_total')
 class Database:
-    def __init__(self, db_path: str):
+    """Доступ к SQLite через исполнитель запросов (utils.db_executor.DBExecutor).
+
+    Все изменения идут через ``_write``: операция ставится в очередь
+    единственного потока-писателя и выполняется в транзакции
+    ``BEGIN IMMEDIATE`` вместе с соседними (group commit). Чтения - через
+    ``_read`` в пуле потоков с read-only соединениями. В режиме WAL читатели
+    не ждут писателя, поэтому просмотр каталога не блокируется записью корзин.
+    Время и ошибки публичных методов пишутся в метрики (utils/metrics.py).
+    """
+
+    ORDER_COLUMNS = "id, user_id, user_name, total_price, location, comment, status, created_at"
+
+    def __init__(self, db_path: str, cart_journal_path: Optional[str] = None, readers: int = DB_READERS):
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        in_memory = db_path == ':memory:'
+        # База в памяти видна только одному соединению - читаем через писателя
+        self.executor = DBExecutor(
+            self._connect_writer,
+            None if in_memory else lambda: self._connect(read_only=True),
+            readers=readers
+        )
         self.create_tables()
-    
+        self.migrate_order_items()
+        # Кэш каталога; сбрасывается при любом изменении таблицы products
+        self.catalog = CatalogCache(self._load_products)
+        # Имена временных таблиц импорта CSV на соединении писателя
+        self._staging_ids = itertools.count(1)
+        # Корзины пишутся в базу пачками, см. flush_carts()
+        self.carts = CartStore(self._load_cart, self._persist_carts, cart_journal_path)
+
+    # ==================== СОЕДИНЕНИЯ ====================
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        if read_only:
+            conn = sqlite3.connect(
+                f"file:{os.path.abspath(self.db_path)}?mode=ro", uri=True,
+                check_same_thread=False, isolation_level=None
+            )
+            conn.execute("PRAGMA query_only=ON")
+        else:
+            # Транзакциями управляем сами (isolation_level=None)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _connect_writer(self) -> sqlite3.Connection:
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Выполнить fn(conn) на соединении для чтения"""
+        return self.executor.read(metrics.traced(fn))
+
+    def _write(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Выполнить fn(conn) в транзакции писателя; исключение откатывает только эту операцию"""
+        return self.executor.write(metrics.traced(fn))
+
+    def backup(self, backup_dir: str) -> str:
+        """Сделать сжатый снимок базы, не останавливая запись"""
+        return create_backup(self.db_path, backup_dir)
+
+    def restore(self, backup_dir: str, name: str):
+        """Восстановить базу из снимка name в каталоге backup_dir.
+
+        Несохранённые корзины и их журнал относятся к прежней базе и
+        отбрасываются. Состояние диалогов и кэш фото перезагружает
+        вызывающий код (SQLitePersistence.replaced/reload, PhotoCache.reload).
+        """
+        snapshot = unpack_backup(backup_dir, name)
+        try:
+            # Выполняется потоком-писателем, отдельно от пачек записи
+            with self.carts.replaced():
+                self.executor.write(lambda conn: restore_into(snapshot, conn), transaction=False)
+        finally:
+            os.remove(snapshot)
+        # Снимок мог быть сделан до последних изменений схемы
+        self.create_tables()
+        self.migrate_order_items()
+        self.catalog.invalidate()
+        logger.info(f"Database restored from backup {name}")
+
+    def db_stats(self) -> Dict[str, float]:
+        """Счётчики очередей исполнителя запросов"""
+        return self.executor.stats()
+
+    def close(self):
+        """Сбросить корзины и закрыть все соединения"""
+        try:
+            self.carts.close()
+        except Exception as e:
+            logger.error(f"Error flushing carts on close: {e}")
+        self.executor.close()
+
     def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        # Таблица товаров
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                category TEXT NOT NULL,
-                name TEXT NOT NULL UNIQUE,
-                cost REAL NOT NULL,
-                quantity INTEGER NOT NULL,
-                image_path TEXT,
-                description TEXT
+        def create(conn):
+            # Таблица товаров
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS products (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    category TEXT NOT NULL,
+                    name TEXT NOT NULL UNIQUE,
+                    cost REAL NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    image_path TEXT,
+                    description TEXT
+                )
+            ''')
+
+            # Таблица корзин
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS carts (
+                    user_id INTEGER PRIMARY KEY,
+                    cart_data TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Таблица заказов
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    user_name TEXT,
+                    order_data TEXT,
+                    total_price REAL,
+                    location TEXT,
+                    comment TEXT,
+                    status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Позиции заказов (вместо JSON в orders.order_data)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS order_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_id INTEGER NOT NULL REFERENCES orders (id),
+                    product_id INTEGER,
+                    name_snapshot TEXT NOT NULL,
+                    unit_price REAL,
+                    qty INTEGER NOT NULL
+                )
+            ''')
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)"
             )
-        ''')
-        
-        # Таблица корзин
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS carts (
-                user_id INTEGER PRIMARY KEY,
-                cart_data TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items (product_id, order_id)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_order_items_name ON order_items (name_snapshot, order_id)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)"
+            )
+            # Постраничный вывод заказов по статусу (keyset по id)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_orders_status_id ON orders (status, id)"
+            )
+
+            # Архив завершённых и отменённых заказов: горячая таблица orders остаётся маленькой
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS orders_archive (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    user_name TEXT,
+                    order_data TEXT,
+                    total_price REAL,
+                    location TEXT,
+                    comment TEXT,
+                    status TEXT,
+                    created_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS order_items_archive (
+                    id INTEGER PRIMARY KEY,
+                    order_id INTEGER NOT NULL,
+                    product_id INTEGER,
+                    name_snapshot TEXT NOT NULL,
+                    unit_price REAL,
+                    qty INTEGER NOT NULL
+                )
+            ''')
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_order_items_archive_order ON order_items_archive (order_id)"
+            )
+
+            # Состояние бота между перезапусками: диалоги и user_data (utils/persistence.py)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (kind, key)
+                ) WITHOUT ROWID
+            ''')
+
+            # Покупатели (для рассылок); blocked - бот заблокирован пользователем
+            new_customers = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'customers'"
+            ).fetchone() is None
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS customers (
+                    user_id INTEGER PRIMARY KEY,
+                    first_name TEXT,
+                    username TEXT,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            if new_customers:
+                # Покупатели, оформлявшие заказы до появления таблицы
+                for table in ('orders', 'orders_archive'):
+                    conn.execute(
+                        f"INSERT OR IGNORE INTO customers (user_id, first_name) "
+                        f"SELECT user_id, MAX(user_name) FROM {table} WHERE user_id IS NOT NULL GROUP BY user_id"
+                    )
+
+            # Рассылки и статус доставки каждому получателю
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    text TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                    broadcast_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    error TEXT,
+                    sent_at TIMESTAMP,
+                    PRIMARY KEY (broadcast_id, user_id)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status "
+                "ON broadcast_recipients (broadcast_id, status)"
+            )
+
+            # file_id загруженных в Telegram фото по SHA-256 содержимого (utils/media.py)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS media_files (
+                    sha256 TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                ) WITHOUT ROWID
+            ''')
+
+            # Служебные значения схемы (прогресс миграций и т.п.)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            ''')
+
+            # Индекс для выборки товаров категории
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_products_category ON products (category, name)"
+            )
+
+            self._create_search_index(conn)
+
+        self._write(create)
+
+    def _create_search_index(self, conn: sqlite3.Connection):
+        """Полнотекстовый индекс товаров (FTS5) и триггеры синхронизации.
+
+        products_fts - слова названия, категории и описания (поиск по префиксам),
+        products_trigram - триграммы названия (поиск с опечатками). Обе таблицы
+        external content: текст хранится только в products, триггеры обновляют
+        индекс при любом изменении товаров, в том числе при импорте CSV.
+        Списание остатков индекс не трогает - триггер только на текстовые поля.
+
+        Токенизатор trigram есть только с SQLite 3.34, а FTS5 может быть не
+        собран вовсе. Недоступная таблица пропускается, триггеры создаются для
+        тех, что есть; search_products тогда ищет без опечаток или перебором
+        каталога.
+        """
+        existing = {
+            row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE name IN ('products_fts', 'products_trigram')"
+            )
+        }
+
+        self._search_fts = self._create_virtual_table(conn, '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5 (
+                name, category, description,
+                content='products', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
             )
         ''')
-        
-        # Таблица заказов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                user_name TEXT,
-                order_data TEXT,
-                total_price REAL,
-                location TEXT,
-                comment TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        self._search_trigram = self._search_fts and self._create_virtual_table(conn, '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS products_trigram USING fts5 (
+                name,
+                content='products', content_rowid='id',
+                tokenize='trigram'
             )
         ''')
-        
-        self.conn.commit()
-    def get_all_products(self) -> List[Dict]:
-        """Получить все товары"""
+
+        inserts = []
+        deletes = []
+        if self._search_fts:
+            inserts.append('''
+                INSERT INTO products_fts (rowid, name, category, description)
+                VALUES (new.id, new.name, new.category, new.description);''')
+            deletes.append('''
+                INSERT INTO products_fts (products_fts, rowid, name, category, description)
+                VALUES ('delete', old.id, old.name, old.category, old.description);''')
+        if self._search_trigram:
+            inserts.append('''
+                INSERT INTO products_trigram (rowid, name) VALUES (new.id, new.name);''')
+            deletes.append('''
+                INSERT INTO products_trigram (products_trigram, rowid, name)
+                VALUES ('delete', old.id, old.name);''')
+
+        # Триггеры пересоздаются под доступные таблицы: SQLite могли обновить
+        for trigger in ('products_search_ai', 'products_search_ad', 'products_search_au'):
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        if inserts:
+            conn.execute(
+                "CREATE TRIGGER products_search_ai AFTER INSERT ON products BEGIN"
+                + ''.join(inserts) + " END"
+            )
+            conn.execute(
+                "CREATE TRIGGER products_search_ad AFTER DELETE ON products BEGIN"
+                + ''.join(deletes) + " END"
+            )
+            conn.execute(
+                "CREATE TRIGGER products_search_au AFTER UPDATE OF name, category, description ON products BEGIN"
+                + ''.join(deletes + inserts) + " END"
+            )
+
+        # Индекс создан для уже заполненной базы - построить его по products
+        if self._search_fts and 'products_fts' not in existing:
+            conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+        if self._search_trigram and 'products_trigram' not in existing:
+            conn.execute("INSERT INTO products_trigram (products_trigram) VALUES ('rebuild')")
+
+    @staticmethod
+    def _create_virtual_table(conn: sqlite3.Connection, sql: str) -> bool:
+        """Создать виртуальную таблицу; False - модуль или токенизатор не поддерживается"""
+        conn.execute("SAVEPOINT virtual_table")
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "SELECT name, cost, quantity, image_path, category, description FROM products ORDER BY category, name"
+            conn.execute(sql)
+        except sqlite3.OperationalError as e:
+            conn.execute("ROLLBACK TO virtual_table")
+            conn.execute("RELEASE virtual_table")
+            logger.warning(f"SQLite {sqlite3.sqlite_version}: search table not available ({e})")
+            return False
+        conn.execute("RELEASE virtual_table")
+        return True
+
+    def migrate_order_items(self, batch_size: int = 500) -> int:
+        """Перенести JSON из orders.order_data в таблицу order_items.
+
+        Идёт пачками по batch_size заказов, каждая пачка - своя транзакция,
+        последний перенесённый id хранится в schema_meta. Если процесс прервётся,
+        следующий запуск продолжит с того же места. Возвращает число
+        перенесённых заказов.
+        """
+        def migrate_batch(conn):
+            row = conn.execute(
+                "SELECT value FROM schema_meta WHERE key = 'order_items_migrated_id'"
+            ).fetchone()
+            last_id = int(row[0]) if row else 0
+
+            orders = conn.execute(
+                "SELECT id, order_data, total_price FROM orders WHERE id > ? AND order_data IS NOT NULL ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+            if not orders:
+                return 0
+
+            products = {}
+            for order_id, order_data, total_price in orders:
+                # Повторный запуск пачки не должен задвоить позиции
+                if conn.execute("SELECT 1 FROM order_items WHERE order_id = ? LIMIT 1", (order_id,)).fetchone():
+                    continue
+                # Один битый заказ пропускаем, иначе пачка не пройдёт и миграция встанет навсегда
+                try:
+                    cart = json.loads(order_data) or {}
+                    if not isinstance(cart, dict):
+                        raise ValueError(f"expected an object, got {type(cart).__name__}")
+
+                    items = []
+                    for name, qty in cart.items():
+                        if name not in products:
+                            products[name] = conn.execute(
+                                "SELECT id, cost FROM products WHERE name = ?", (name,)
+                            ).fetchone()
+                        product = products[name]
+                        # В старом JSON цен нет: для заказа из одной позиции цена известна точно,
+                        # иначе берём текущую цену товара
+                        if len(cart) == 1 and qty and total_price is not None:
+                            unit_price = total_price / qty
+                        else:
+                            unit_price = product[1] if product else None
+                        items.append((order_id, product[0] if product else None, name, unit_price, qty))
+                except (TypeError, ValueError, ZeroDivisionError) as e:
+                    logger.warning(f"Order #{order_id} has broken order_data, skipped: {e}")
+                    continue
+
+                conn.executemany(
+                    "INSERT INTO order_items (order_id, product_id, name_snapshot, unit_price, qty) VALUES (?, ?, ?, ?, ?)",
+                    items
+                )
+
+            conn.execute(
+                "INSERT OR REPLACE INTO schema_meta (key, value) VALUES ('order_items_migrated_id', ?)",
+                (str(orders[-1][0]),)
             )
-            return [{
-                'name': row[0], 
-                'cost': row[1], 
-                'quantity': row[2], 
-                'image_path': row[3],
-                'category': row[4],
-                'description': row[5]
-            } for row in cursor.fetchall()]
+            return len(orders)
+
+        migrated = 0
+        try:
+            while True:
+                count = self._write(migrate_batch)
+                if not count:
+                    break
+                migrated += count
+            if migrated:
+                logger.info(f"Migrated {migrated} orders to order_items")
+        except Exception as e:
+            logger.error(f"Error migrating orders to order_items: {e}")
+        return migrated
+
+    def _fetch_products_by_name(self, conn: sqlite3.Connection, names: Iterable[str]) -> Dict[str, Product]:
+        """Товары по точным названиям одной выборкой WHERE name IN (...)"""
+        names = list(dict.fromkeys(names))
+        products = {}
+        for start in range(0, len(names), SQL_IN_CHUNK):
+            chunk = names[start:start + SQL_IN_CHUNK]
+            rows = conn.execute(
+                "SELECT id, category, name, cost, quantity, image_path, description FROM products "
+                f"WHERE name IN ({', '.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            for row in rows:
+                products[row[2]] = Product._make(row)
+        return products
+
+    def _load_products(self) -> List[Product]:
+        rows = self._read(lambda conn: conn.execute(
+            "SELECT id, category, name, cost, quantity, image_path, description FROM products"
+        ).fetchall())
+        return [Product._make(row) for row in rows]
+
+    def get_all_products(self) -> List[Product]:
+        """Получить все товары"""
+        try:
+            return self.catalog.get_all()
         except Exception as e:
             logger.error(f"Error getting all products: {e}")
             return []
-    def get_products_by_category(self, category: str) -> List[Dict]:
+    def get_products_by_category(self, category: str) -> List[Product]:
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "SELECT name, cost, quantity, image_path FROM products WHERE category = ? AND quantity > 0 ORDER BY name",
-                (category,)
-            )
-            return [{
-                'name': row[0], 
-                'cost': row[1], 
-                'quantity': row[2], 
-                'image_path': row[3]
-            } for row in cursor.fetchall()]
+            return self.catalog.get_by_category(category)
         except Exception as e:
             logger.error(f"Error getting products by category: {e}")
             return []
-    
-    def get_product(self, name: str) -> Optional[Dict]:
+
+    def get_product(self, name: str) -> Optional[Product]:
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "SELECT name, cost, quantity, image_path FROM products WHERE name = ?",
-                (name,)
-            )
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'name': row[0], 
-                    'cost': row[1], 
-                    'quantity': row[2], 
-                    'image_path': row[3]
-                }
-            return None
+            return self.catalog.get(name)
         except Exception as e:
             logger.error(f"Error getting product: {e}")
             return None
-    
+
+    def search_products(self, text: str, limit: int = SEARCH_LIMIT, offset: int = 0) -> List[Product]:
+        """Найти товары в наличии по названию, категории и описанию.
+
+        Сначала ищутся слова запроса как префиксы (ранжирование bm25, название
+        важнее категории и описания). Если ничего не нашлось - поиск с
+        опечатками по триграммам названия с пересчётом похожести.
+        Без FTS5 префиксы ищутся перебором каталога в памяти, без
+        токенизатора trigram поиск с опечатками пропускается.
+        offset - пропустить столько первых результатов (постраничный вывод).
+        """
+        match = prefix_query(text)
+        if match is None:
+            return []
+        if not self._search_fts:
+            return prefix_scan(text, self.get_all_products())[offset:offset + limit]
+
+        def query(conn):
+            rows = conn.execute('''
+                SELECT p.id, p.category, p.name, p.cost, p.quantity, p.image_path, p.description
+                FROM products_fts f JOIN products p ON p.id = f.rowid
+                WHERE products_fts MATCH ? AND p.quantity > 0
+                ORDER BY bm25(products_fts, 10.0, 2.0, 1.0)
+                LIMIT ? OFFSET ?
+            ''', (match, limit, offset)).fetchall()
+            if rows:
+                return [Product._make(row) for row in rows]
+            if offset and conn.execute('''
+                SELECT 1 FROM products_fts f JOIN products p ON p.id = f.rowid
+                WHERE products_fts MATCH ? AND p.quantity > 0 LIMIT 1
+            ''', (match,)).fetchone():
+                # Дальние страницы точного поиска закончились
+                return []
+
+            fuzzy = trigram_query(text)
+            if fuzzy is None or not self._search_trigram:
+                return []
+            rows = conn.execute('''
+                SELECT p.id, p.category, p.name, p.cost, p.quantity, p.image_path, p.description
+                FROM products_trigram t JOIN products p ON p.id = t.rowid
+                WHERE products_trigram MATCH ? AND p.quantity > 0
+                ORDER BY bm25(products_trigram)
+                LIMIT ?
+            ''', (fuzzy, FUZZY_CANDIDATES)).fetchall()
+            return rank_fuzzy(text, [Product._make(row) for row in rows], offset + limit)[offset:]
+
+        try:
+            return self._read(query)
+        except Exception as e:
+            logger.error(f"Error searching products '{text}': {e}")
+            return []
+
     def update_product_quantity(self, name: str, quantity: int):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
+            cursor = self._write(lambda conn: conn.execute(
                 "UPDATE products SET quantity = quantity - ? WHERE name = ? AND quantity >= ?",
                 (quantity, name, quantity)
-            )
-            self.conn.commit()
-            return cursor.rowcount > 0
+            ))
+            if cursor.rowcount > 0:
+                self.catalog.invalidate()
+                return True
+            return False
         except Exception as e:
             logger.error(f"Error updating product quantity: {e}")
             return False
-    
-    def save_cart(self, user_id: int, cart_data: Dict):
+
+    def set_product_images(self, rows: List[tuple]) -> int:
+        """Записать фото товаров одной транзакцией: (image_path, name)"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
+            cursor = self._write(lambda conn: conn.executemany(
+                "UPDATE products SET image_path = ? WHERE name = ?", rows
+            ))
+            self.catalog.invalidate()
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Error saving product images: {e}")
+            return 0
+
+    def _load_cart(self, user_id: int) -> Optional[Dict]:
+        row = self._read(lambda conn: conn.execute(
+            "SELECT cart_data FROM carts WHERE user_id = ?",
+            (user_id,)
+        ).fetchone())
+        return json.loads(row[0]) if row else None
+
+    def _persist_carts(self, carts: Dict[int, Optional[Dict]]):
+        """Записать пачку корзин одной транзакцией (None - удалить корзину)"""
+        def persist(conn):
+            conn.executemany(
                 "INSERT OR REPLACE INTO carts (user_id, cart_data, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
-                (user_id, json.dumps(cart_data))
+                [(user_id, json.dumps(cart)) for user_id, cart in carts.items() if cart is not None]
             )
-            self.conn.commit()
+            conn.executemany(
+                "DELETE FROM carts WHERE user_id = ?",
+                [(user_id,) for user_id, cart in carts.items() if cart is None]
+            )
+
+        self._write(persist)
+
+    def load_bot_state(self) -> List[tuple]:
+        """Все строки bot_state: (kind, key, data)"""
+        return self._read(lambda conn: conn.execute("SELECT kind, key, data FROM bot_state").fetchall())
+
+    def save_bot_state(self, rows: List[tuple]):
+        """Записать пачку строк bot_state одной транзакцией (data None - удалить)"""
+        def persist(conn):
+            conn.executemany(
+                "INSERT OR REPLACE INTO bot_state (kind, key, data, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                [row for row in rows if row[2] is not None]
+            )
+            conn.executemany(
+                "DELETE FROM bot_state WHERE kind = ? AND key = ?",
+                [(kind, key) for kind, key, data in rows if data is None]
+            )
+
+        self._write(persist)
+
+    def save_cart(self, user_id: int, cart_data: Dict):
+        try:
+            self.carts.put(user_id, cart_data)
         except Exception as e:
             logger.error(f"Error saving cart: {e}")
-    
+
     def get_cart(self, user_id: int) -> Dict:
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "SELECT cart_data FROM carts WHERE user_id = ?",
-                (user_id,)
-            )
-            row = cursor.fetchone()
-            return json.loads(row[0]) if row else {}
+            return self.carts.get(user_id)
         except Exception as e:
             logger.error(f"Error getting cart: {e}")
             return {}
-    
+
+    def flush_carts(self, user_id: Optional[int] = None):
+        """Записать накопленные изменения корзин в базу"""
+        try:
+            self.carts.flush(user_id)
+        except Exception as e:
+            logger.error(f"Error flushing carts: {e}")
+
+    def _insert_order(self, conn: sqlite3.Connection, user_id: int, user_name: str, items: List[tuple],
+                      total_price: float, location: str, comment: str) -> int:
+        """Записать заказ и его позиции; items - кортежи (product_id, name, unit_price, qty)"""
+        cursor = conn.execute(
+            "INSERT INTO orders (user_id, user_name, total_price, location, comment) VALUES (?, ?, ?, ?, ?)",
+            (user_id, user_name, total_price, location, comment)
+        )
+        order_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT INTO order_items (order_id, product_id, name_snapshot, unit_price, qty) VALUES (?, ?, ?, ?, ?)",
+            [(order_id,) + tuple(item) for item in items]
+        )
+        return order_id
+
     def save_order(self, user_id: int, user_name: str, order_data: Dict, total_price: float, location: str, comment: str):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "INSERT INTO orders (user_id, user_name, order_data, total_price, location, comment) VALUES (?, ?, ?, ?, ?, ?)",
-                (user_id, user_name, json.dumps(order_data), total_price, location, comment)
-            )
-            self.conn.commit()
-            order_id = cursor.lastrowid
+            def save(conn):
+                products = self._fetch_products_by_name(conn, order_data)
+                items = []
+                for name, qty in order_data.items():
+                    product = products.get(name)
+                    items.append((product.id if product else None, name, product.cost if product else None, qty))
+                return self._insert_order(conn, user_id, user_name, items, total_price, location, comment)
+
+            order_id = self._write(save)
             logger.info(f"Order #{order_id} saved successfully for user {user_id}")
             return order_id
         except Exception as e:
             logger.error(f"Error saving order: {e}")
             return None
-    
-    def clear_cart(self, user_id: int):
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "DELETE FROM carts WHERE user_id = ?",
+
+    def checkout(self, user_id: int, user_name: str, location: str, comment: str) -> Dict:
+        """Оформить заказ из корзины одной транзакцией.
+
+        В транзакции BEGIN IMMEDIATE перечитываются цены, списываются остатки
+        (только если товара хватает), сохраняется заказ и удаляется корзина.
+        Цены считаются в Decimal по товарам корзины из одной выборки. Если
+        хотя бы одной позиции не хватает или её нет в каталоге, транзакция
+        откатывается целиком.
+
+        Возвращает словарь:
+            order_id     - номер заказа или None, если заказ не создан
+            items        - позиции заказа (OrderItem)
+            total_price  - итоговая сумма (Decimal, точные копейки)
+            quote        - расчёт корзины (PriceQuote) для текста заказа
+            out_of_stock - позиции, которых не хватило: name, requested, available
+            unknown      - названия из корзины, которых больше нет в каталоге
+        """
+        def run(conn):
+            result = {
+                'order_id': None, 'items': [], 'total_price': Decimal('0.00'),
+                'quote': None, 'out_of_stock': [], 'unknown': []
+            }
+
+            row = conn.execute(
+                "SELECT cart_data FROM carts WHERE user_id = ?",
                 (user_id,)
+            ).fetchone()
+            cart = json.loads(row[0]) if row else {}
+            if not cart:
+                return result
+
+            products = self._fetch_products_by_name(conn, cart)
+            quote = price_cart(cart, products)
+            result['unknown'] = quote.unknown
+
+            for item in quote.items:
+                cursor = conn.execute(
+                    "UPDATE products SET quantity = quantity - ? WHERE id = ? AND quantity >= ?",
+                    (item.quantity, item.product_id, item.quantity)
+                )
+                if cursor.rowcount == 0:
+                    result['out_of_stock'].append({
+                        'name': item.name,
+                        'requested': item.quantity,
+                        'available': products[item.name].quantity
+                    })
+
+            if result['out_of_stock'] or result['unknown']:
+                raise CheckoutAborted(result)
+
+            result['items'] = quote.items
+            result['total_price'] = quote.total
+            result['quote'] = quote
+            result['order_id'] = self._insert_order(
+                conn, user_id, user_name, quote.items, float(quote.total), location, comment
             )
-            self.conn.commit()
+            conn.execute("DELETE FROM carts WHERE user_id = ?", (user_id,))
+            return result
+
+        # Корзина могла ещё не дойти до базы
+        self.carts.flush(user_id)
+        try:
+            result = self._write(run)
+        except CheckoutAborted as e:
+            logger.warning(
+                f"Checkout for user {user_id} aborted, out of stock: {e.result['out_of_stock']}, "
+                f"unknown: {e.result['unknown']}"
+            )
+            return e.result
+
+        if result['order_id']:
+            self.carts.forget(user_id)
+            self.catalog.invalidate()
+            logger.info(f"Order #{result['order_id']} checked out for user {user_id}")
+        return result
+
+    def clear_cart(self, user_id: int):
+        try:
+            # Удаление пишется после сброса, который мог успеть взять старую корзину
+            self.carts.forget(user_id)
+            self.carts.flush(user_id)
         except Exception as e:
             logger.error(f"Error clearing cart: {e}")
-    
-    def import_products_from_csv(self, csv_data: str):
+
+    def import_products_from_csv(self, source: Union[str, TextIO],
+                                 report: Optional[ImportReport] = None) -> Optional[Dict]:
+        """Синхронизировать товары с CSV (строка или открытый файл).
+
+        Строки читаются и проверяются по одной, ошибки попадают в report.
+        Возвращает сводку sync_products или None при ошибке.
+        """
         try:
-            import csv
-            from io import StringIO
-            
-            cursor = self.conn.cursor()
-            
-            # Читаем CSV
-            reader = csv.DictReader(StringIO(csv_data))
-            products = []
-            
-            for row in reader:
-                products.append((
-                    row.get('category', ''),
-                    row.get('name', ''),
-                    float(row.get('cost', 0)),
-                    int(row.get('quantity', 0)),
-                    row.get('image_path', ''),
-                    row.get('description', '')
-                ))
-            
-            # Очищаем и заполняем таблицу
-            cursor.execute("DELETE FROM products")
-            cursor.executemany(
-                "INSERT INTO products (category, name, cost, quantity, image_path, description) VALUES (?, ?, ?, ?, ?, ?)",
-                products
-            )
-            
-            self.conn.commit()
-            return True
+            if isinstance(source, str):
+                source = StringIO(source)
+            if report is None:
+                report = ImportReport()
+
+            summary = self.sync_products(iter_product_rows(source, report), keep_names=report.skipped_names)
+            if report.errors:
+                logger.warning(f"CSV import finished with {len(report.errors)} errors")
+            return summary
         except Exception as e:
             logger.error(f"Error importing products from CSV: {e}")
-            return False
-    
-    def get_all_orders(self, status: str = None) -> List[Dict]:
+            return None
+
+    def sync_products(self, products: Iterable[tuple], keep_names: Optional[Set[str]] = None,
+                      batch_size: int = IMPORT_BATCH_SIZE) -> Dict:
+        """Привести таблицу товаров к присланному списку одной транзакцией.
+
+        products - кортежи (category, name, cost, quantity, image_path, description),
+        можно передать генератор. Он читается пачками по batch_size вне транзакции
+        каталога: каждая пачка короткой записью попадает во временную таблицу
+        соединения писателя, поэтому разбор большого CSV не держит блокировку
+        записи. Затем одна транзакция сравнивает строки по name: новые
+        добавляются, изменившиеся обновляются, отсутствующие в списке удаляются
+        (кроме keep_names), остальные не трогаются - id товаров сохраняются. Если
+        не пришло ни одной строки, транзакция откатывается.
+        Возвращает {'added', 'updated', 'removed', 'unchanged'}.
+        """
+        staging = f"staged_products_{next(self._staging_ids)}"
+
+        def stage(batch: List[tuple]):
+            def insert(conn):
+                conn.executemany(f"INSERT INTO temp.{staging} VALUES (?, ?, ?, ?, ?, ?)", batch)
+            return insert
+
+        def sync(conn):
+            current = {
+                row[0]: row[1:]
+                for row in conn.execute(
+                    "SELECT name, category, cost, quantity, IFNULL(image_path, ''), IFNULL(description, '') FROM products"
+                )
+            }
+
+            summary = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+            seen = set()
+            rows = conn.execute(f"SELECT * FROM temp.{staging} ORDER BY rowid")
+            while True:
+                batch = rows.fetchmany(batch_size)
+                if not batch:
+                    break
+                inserts = []
+                updates = []
+                for category, name, cost, quantity, image_path, description in batch:
+                    existing = current.get(name)
+                    # Пустой image_path в CSV не стирает фото, загруженное через бота
+                    if not image_path and existing is not None:
+                        image_path = existing[3]
+                    values = (category, cost, quantity, image_path or '', description or '')
+                    if existing is None and name not in seen:
+                        inserts.append((category, name) + values[1:])
+                    elif existing is not None and tuple(existing) != values:
+                        updates.append(values + (name,))
+                    else:
+                        summary['unchanged'] += 1
+                    seen.add(name)
+
+                conn.executemany(
+                    "UPDATE products SET category = ?, cost = ?, quantity = ?, image_path = ?, description = ? WHERE name = ?",
+                    updates
+                )
+                conn.executemany(
+                    "INSERT INTO products (category, name, cost, quantity, image_path, description) VALUES (?, ?, ?, ?, ?, ?)",
+                    inserts
+                )
+                summary['added'] += len(inserts)
+                summary['updated'] += len(updates)
+
+            if not seen:
+                raise ValueError("CSV не содержит ни одной корректной строки")
+
+            keep = keep_names or set()
+            removed = [(name,) for name in current if name not in seen and name not in keep]
+            conn.executemany("DELETE FROM products WHERE name = ?", removed)
+            summary['removed'] = len(removed)
+            return summary
+
+        self._write(lambda conn: conn.execute(
+            f"CREATE TEMP TABLE {staging} "
+            "(category TEXT, name TEXT, cost REAL, quantity INTEGER, image_path TEXT, description TEXT)"
+        ))
+        try:
+            # Разбор и проверка строк - в потоке вызывающего, между записями пачек
+            for batch in iter_batches(products, batch_size):
+                self._write(stage(batch))
+            summary = self._write(sync)
+        finally:
+            self._write(lambda conn: conn.execute(f"DROP TABLE IF EXISTS temp.{staging}"))
+            self.catalog.invalidate()
+        logger.info(f"Products synced: {summary}")
+        return summary
+
+    def clear_products(self) -> int:
+        """Удалить все товары, вернуть количество удалённых"""
+        def clear(conn):
+            count = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+            conn.execute("DELETE FROM products")
+            return count
+
+        try:
+            return self._write(clear)
+        finally:
+            self.catalog.invalidate()
+
+    def _build_orders(self, conn: sqlite3.Connection, rows: List[tuple],
+                      items_table: str = 'order_items') -> List[Order]:
+        """Собрать заказы из строк orders и их позиций из order_items (или архива)"""
+        items = {row[0]: [] for row in rows}
+
+        ids = list(items)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for order_id, product_id, name, unit_price, qty in conn.execute(
+                f"SELECT order_id, product_id, name_snapshot, unit_price, qty FROM {items_table} "
+                f"WHERE order_id IN ({placeholders}) ORDER BY id",
+                chunk
+            ):
+                items[order_id].append(OrderItem(product_id, name, unit_price, qty))
+
+        return [Order(*row, items=tuple(items[row[0]])) for row in rows]
+
+    def get_all_orders(self, status: str = None) -> List[Order]:
         """Получить все заказы с возможностью фильтрации по статусу"""
         try:
-            cursor = self.conn.cursor()
-            if status:
-                cursor.execute("""
-                    SELECT id, user_id, user_name, order_data, total_price, 
-                           location, comment, status, created_at 
-                    FROM orders WHERE status = ? ORDER BY created_at DESC
-                """, (status,))
-            else:
-                cursor.execute("""
-                    SELECT id, user_id, user_name, order_data, total_price, 
-                           location, comment, status, created_at 
-                    FROM orders ORDER BY created_at DESC
-                """)
-            
-            orders = []
-            for row in cursor.fetchall():
-                orders.append({
-                    'id': row[0],
-                    'user_id': row[1],
-                    'user_name': row[2],
-                    'order_data': json.loads(row[3]),
-                    'total_price': row[4],
-                    'location': row[5],
-                    'comment': row[6],
-                    'status': row[7],
-                    'created_at': row[8]
-                })
-            return orders
+            def query(conn):
+                if status:
+                    rows = conn.execute(
+                        f"SELECT {self.ORDER_COLUMNS} FROM orders WHERE status = ? ORDER BY created_at DESC",
+                        (status,)
+                    ).fetchall()
+                else:
+                    rows = conn.execute(
+                        f"SELECT {self.ORDER_COLUMNS} FROM orders ORDER BY created_at DESC"
+                    ).fetchall()
+                return self._build_orders(conn, rows)
+
+            return self._read(query)
         except Exception as e:
             logger.error(f"Error getting orders: {e}")
             return []
 
+    def get_orders_page(self, status: Optional[str] = None, before_id: Optional[int] = None,
+                        limit: int = 10) -> Dict:
+        """Страница заказов от новых к старым (keyset-пагинация по id).
+
+        before_id - курсор: вернуть заказы с id меньше него (None - первая страница).
+        Возвращает {'orders': [...], 'next_before_id': курсор следующей страницы или None}.
+        """
+        try:
+            def query(conn):
+                conditions = []
+                params = []
+                if status:
+                    conditions.append("status = ?")
+                    params.append(status)
+                if before_id is not None:
+                    conditions.append("id < ?")
+                    params.append(before_id)
+                where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+                rows = conn.execute(
+                    f"SELECT {self.ORDER_COLUMNS} FROM orders {where} ORDER BY id DESC LIMIT ?",
+                    params + [limit + 1]
+                ).fetchall()
+                return self._build_orders(conn, rows[:limit]), len(rows) > limit
+
+            orders, has_more = self._read(query)
+            return {
+                'orders': orders,
+                'next_before_id': orders[-1].id if has_more else None
+            }
+        except Exception as e:
+            logger.error(f"Error getting orders page: {e}")
+            return {'orders': [], 'next_before_id': None}
+
     def update_order_status(self, order_id: int, status: str) -> bool:
         """Обновить статус заказа"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
+            cursor = self._write(lambda conn: conn.execute(
                 "UPDATE orders SET status = ? WHERE id = ?",
                 (status, order_id)
-            )
-            self.conn.commit()
+            ))
             return cursor.rowcount > 0
         except Exception as e:
             logger.error(f"Error updating order status: {e}")
             return False
 
-    def get_order_by_id(self, order_id: int) -> Optional[Dict]:
+    def get_order_by_id(self, order_id: int) -> Optional[Order]:
         """Получить заказ по ID"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("""
-                SELECT id, user_id, user_name, order_data, total_price, 
-                       location, comment, status, created_at 
-                FROM orders WHERE id = ?
-            """, (order_id,))
-            
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'id': row[0],
-                    'user_id': row[1],
-                    'user_name': row[2],
-                    'order_data': json.loads(row[3]),
-                    'total_price': row[4],
-                    'location': row[5],
-                    'comment': row[6],
-                    'status': row[7],
-                    'created_at': row[8]
-                }
-            return None
+            def query(conn):
+                rows = conn.execute(
+                    f"SELECT {self.ORDER_COLUMNS} FROM orders WHERE id = ?",
+                    (order_id,)
+                ).fetchall()
+                if rows:
+                    return self._build_orders(conn, rows)
+
+                # Старые заказы ищем в архиве
+                rows = conn.execute(
+                    f"SELECT {self.ORDER_COLUMNS} FROM orders_archive WHERE id = ?",
+                    (order_id,)
+                ).fetchall()
+                return self._build_orders(conn, rows, 'order_items_archive')
+
+            orders = self._read(query)
+            return orders[0] if orders else None
         except Exception as e:
             logger.error(f"Error getting order by ID: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def archive_orders(self, older_than_days: int, statuses: tuple = ARCHIVE_STATUSES,
+                       batch_size: int = 200, max_batches: int = 50) -> int:
+        """Перенести старые заказы в конечном статусе в архивные таблицы.
+
+        Переносятся заказы со статусом из statuses, созданные больше
+        older_than_days дней назад. Работает короткими транзакциями по
+        batch_size заказов, не больше max_batches за вызов, чтобы не
+        задерживать остальные записи. Возвращает число перенесённых заказов.
+        """
+        placeholders = ','.join('?' * len(statuses))
+
+        def archive_batch(conn):
+            ids = [row[0] for row in conn.execute(
+                f"SELECT id FROM orders WHERE status IN ({placeholders}) "
+                f"AND created_at < datetime('now', ?) ORDER BY id LIMIT ?",
+                list(statuses) + [f"-{int(older_than_days)} days", batch_size]
+            )]
+            if not ids:
+                return 0
+
+            id_list = ','.join('?' * len(ids))
+            conn.execute(
+                f"INSERT OR REPLACE INTO orders_archive (id, user_id, user_name, order_data, total_price, "
+                f"location, comment, status, created_at) "
+                f"SELECT id, user_id, user_name, order_data, total_price, location, comment, status, created_at "
+                f"FROM orders WHERE id IN ({id_list})",
+                ids
+            )
+            conn.execute(
+                f"INSERT OR REPLACE INTO order_items_archive (id, order_id, product_id, name_snapshot, unit_price, qty) "
+                f"SELECT id, order_id, product_id, name_snapshot, unit_price, qty "
+                f"FROM order_items WHERE order_id IN ({id_list})",
+                ids
+            )
+            conn.execute(f"DELETE FROM order_items WHERE order_id IN ({id_list})", ids)
+            conn.execute(f"DELETE FROM orders WHERE id IN ({id_list})", ids)
+            return len(ids)
+
+        archived = 0
+        try:
+            for _ in range(max_batches):
+                count = self._write(archive_batch)
+                archived += count
+                if count < batch_size:
+                    break
+            if archived:
+                logger.info(f"Archived {archived} orders older than {older_than_days} days")
+        except Exception as e:
+            logger.error(f"Error archiving orders: {e}")
+        return archived
+
+    # ==================== ФОТО ТОВАРОВ ====================
+
+    def load_media_file_ids(self) -> Dict[str, str]:
+        """Все сохранённые file_id: {sha256: file_id}"""
+        try:
+            return dict(self._read(lambda conn: conn.execute("SELECT sha256, file_id FROM media_files").fetchall()))
+        except Exception as e:
+            logger.error(f"Error loading media file ids: {e}")
+            return {}
+
+    def save_media_file_ids(self, rows: List[tuple]):
+        """Записать пачку (sha256, file_id)"""
+        try:
+            self._write(lambda conn: conn.executemany(
+                "INSERT OR REPLACE INTO media_files (sha256, file_id, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                rows
+            ))
+        except Exception as e:
+            logger.error(f"Error saving media file ids: {e}")
+
+    def forget_media_file_id(self, sha256: str):
+        try:
+            self._write(lambda conn: conn.execute("DELETE FROM media_files WHERE sha256 = ?", (sha256,)))
+        except Exception as e:
+            logger.error(f"Error deleting media file id: {e}")
+
+    # ==================== ПОКУПАТЕЛИ И РАССЫЛКИ ====================
+
+    def touch_customer(self, user_id: int, first_name: str, username: Optional[str]):
+        """Запомнить покупателя (при /start); снова написавший снимает блокировку"""
+        try:
+            self._write(lambda conn: conn.execute(
+                "INSERT INTO customers (user_id, first_name, username) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET first_name = excluded.first_name, "
+                "username = excluded.username, blocked = 0, last_seen_at = CURRENT_TIMESTAMP",
+                (user_id, first_name, username)
+            ))
+        except Exception as e:
+            logger.error(f"Error saving customer {user_id}: {e}")
+
+    def create_broadcast(self, text: str) -> Optional[Broadcast]:
+        """Создать рассылку всем незаблокировавшим покупателям"""
+        def create(conn):
+            broadcast_id = conn.execute(
+                "INSERT INTO broadcasts (text) VALUES (?)", (text,)
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO broadcast_recipients (broadcast_id, user_id) "
+                "SELECT ?, user_id FROM customers WHERE blocked = 0",
+                (broadcast_id,)
+            )
+            return self._load_broadcasts(conn, broadcast_id)[0]
+
+        try:
+            broadcast = self._write(create)
+            logger.info(f"Broadcast #{broadcast.id} created for {broadcast.total} customers")
+            return broadcast
+        except Exception as e:
+            logger.error(f"Error creating broadcast: {e}")
+            return None
+
+    def next_broadcast_batch(self, limit: int) -> Optional[tuple]:
+        """Следующая пачка получателей: (broadcast_id, text, [user_id]) или None.
+
+        Рассылка без ожидающих получателей отмечается завершённой.
+        Пока рассылок нет, проверка идёт чтением, без транзакции записи.
+        """
+        running = self._read(lambda conn: conn.execute(
+            "SELECT 1 FROM broadcasts WHERE status = 'running' LIMIT 1"
+        ).fetchone())
+        if running is None:
+            return None
+
+        def query(conn):
+            for broadcast_id, text in conn.execute(
+                "SELECT id, text FROM broadcasts WHERE status = 'running' ORDER BY id"
+            ).fetchall():
+                user_ids = [row[0] for row in conn.execute(
+                    "SELECT user_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'pending' LIMIT ?",
+                    (broadcast_id, limit)
+                )]
+                if user_ids:
+                    return broadcast_id, text, user_ids
+                conn.execute(
+                    "UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (broadcast_id,)
+                )
+                logger.info(f"Broadcast #{broadcast_id} finished")
+            return None
+
+        return self._write(query)
+
+    def record_broadcast_results(self, broadcast_id: int, results: List[tuple]):
+        """Записать статусы доставки: (user_id, status, error); заблокировавших отметить в customers"""
+        def record(conn):
+            conn.executemany(
+                "UPDATE broadcast_recipients SET status = ?, error = ?, sent_at = CURRENT_TIMESTAMP "
+                "WHERE broadcast_id = ? AND user_id = ?",
+                [(status, error, broadcast_id, user_id) for user_id, status, error in results]
+            )
+            conn.executemany(
+                "UPDATE customers SET blocked = 1 WHERE user_id = ?",
+                [(user_id,) for user_id, status, _ in results if status == 'blocked']
+            )
+
+        self._write(record)
+
+    def cancel_broadcast(self, broadcast_id: int) -> bool:
+        cursor = self._write(lambda conn: conn.execute(
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status = 'running'",
+            (broadcast_id,)
+        ))
+        return cursor.rowcount > 0
+
+    def _load_broadcasts(self, conn: sqlite3.Connection, broadcast_id: Optional[int] = None,
+                         limit: int = 5) -> List[Broadcast]:
+        where = "WHERE b.id = ?" if broadcast_id is not None else ""
+        params = [broadcast_id] if broadcast_id is not None else []
+        rows = conn.execute(
+            f"SELECT b.id, b.status, b.created_at, COUNT(r.user_id), "
+            f"SUM(r.status = 'sent'), SUM(r.status = 'failed'), SUM(r.status = 'blocked'), "
+            f"SUM(r.status = 'pending') "
+            f"FROM broadcasts b LEFT JOIN broadcast_recipients r ON r.broadcast_id = b.id "
+            f"{where} GROUP BY b.id ORDER BY b.id DESC LIMIT ?",
+            params + [limit]
+        ).fetchall()
+        return [Broadcast(*row[:4], *(value or 0 for value in row[4:])) for row in rows]
+
+    def get_broadcasts(self, limit: int = 5) -> List[Broadcast]:
+        """Последние рассылки с количеством доставленных, ошибок и ожидающих"""
+        try:
+            return self._read(lambda conn: self._load_broadcasts(conn, limit=limit))
+        except Exception as e:
+            logger.error(f"Error getting broadcasts: {e}")
+            return []
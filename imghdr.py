@@ -1,25 +1,44 @@
 """
 Simple imghdr replacement for Python 3.13 compatibility
+
+Тип картинки определяется по первым байтам (сигнатуре), а не по
+расширению файла. Интерфейс как у стандартного imghdr: what(file, h=None),
+его вызывает и python-telegram-bot при загрузке файлов.
 """
 import os
 
-def what(filepath):
+# (тип, проверка первых байт)
+tests = [
+    ('jpeg', lambda h: h[:3] == b'\xff\xd8\xff'),
+    ('png', lambda h: h[:8] == b'\x89PNG\r\n\x1a\n'),
+    ('gif', lambda h: h[:6] in (b'GIF87a', b'GIF89a')),
+    ('webp', lambda h: h[:4] == b'RIFF' and h[8:12] == b'WEBP'),
+    ('bmp', lambda h: h[:2] == b'BM'),
+    ('tiff', lambda h: h[:4] in (b'II*\x00', b'MM\x00*')),
+]
+
+# Сколько байт нужно для определения типа
+HEADER_SIZE = 32
+
+def what(file, h=None):
     """
-    Determine the type of an image file
+    Determine the type of an image by its header bytes
+
+    file - путь или открытый двоичный файл; h - уже прочитанные байты
     """
-    if not os.path.isfile(filepath):
-        return None
-    
-    ext = os.path.splitext(filepath)[1].lower()
-    
-    image_extensions = {
-        '.jpg': 'jpeg',
-        '.jpeg': 'jpeg',
-        '.png': 'png',
-        '.gif': 'gif',
-        '.bmp': 'bmp',
-        '.tiff': 'tiff',
-        '.webp': 'webp'
-    }
+    if h is None:
+        if isinstance(file, (str, os.PathLike)):
+            if not os.path.isfile(file):
+                return None
+            with open(file, 'rb') as f:
+                h = f.read(HEADER_SIZE)
+        else:
+            position = file.tell()
+            h = file.read(HEADER_SIZE)
+            file.seek(position)
     
-    return image_extensions.get(ext)
\ No newline at end of file
+    h = bytes(h[:HEADER_SIZE])
+    for kind, test in tests:
+        if test(h):
+            return kind
+    return None
\ No newline at end of file
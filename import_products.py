@@ -42,9 +42,9 @@ def import_initial_data():
             
             categories = {}
             for product in products:
-                if product['category'] not in categories:
-                    categories[product['category']] = 0
-                categories[product['category']] += 1
+                if product.category not in categories:
+                    categories[product.category] = 0
+                categories[product.category] += 1
             
             for category, count in categories.items():
                 print(f"  - {category}: {count} товаров")
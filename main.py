@@ -1,17 +1,40 @@
 import sys
 import os
 import logging
-import sqlite3
+import tempfile
 from typing import *
-from datetime import datetime
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+from datetime import datetime, time as dt_time
+from telegram import (
+    Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton,
+    InlineKeyboardButton, InlineKeyboardMarkup,
+    InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
+)
 from telegram.ext import (
     Updater, CommandHandler, MessageHandler, Filters,
-    ConversationHandler, CallbackContext
+    ConversationHandler, CallbackContext, InlineQueryHandler
+)
+from config import (
+    BOT_TOKEN, ADMIN_ID, DB_PATH, CSV_DIR, IMAGES_DIR, CART_JOURNAL_PATH, CART_FLUSH_INTERVAL,
+    BACKUP_DIR, BACKUP_HOUR, BACKUP_KEEP, BACKUP_MAX_AGE_DAYS, ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL,
+    BOT_MODE, BOT_WORKERS, CON_POOL_SIZE, TELEGRAM_API_URL, PERSISTENCE_FLUSH_INTERVAL, DROP_PENDING_UPDATES,
+    OUTBOX_WORKERS, OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, BROADCAST_BATCH, BROADCAST_INTERVAL, IMAGE_WORKERS,
+    METRICS_HOST, METRICS_PORT,
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_MIN_PATH, WEBHOOK_CERT, WEBHOOK_KEY, WEBHOOK_MAX_CONNECTIONS
 )
-from config import BOT_TOKEN, ADMIN_ID, DB_PATH
 from database import Database
-from utils.helpers import setup_logging, calculate_order_total, format_order_text
+from utils.models import Order
+from utils.helpers import setup_logging, format_order_text, format_sync_summary
+from utils.csv_import import ImportReport
+from utils.pricing import to_money, format_money
+from utils.backup import list_backups, apply_retention
+from utils.chat_scheduler import create_updater
+from utils.persistence import SQLitePersistence
+from utils.outbox import Outbox, PRIORITY_ADMIN
+from utils.broadcast import Broadcaster
+from utils.media import PhotoCache, ALBUM_SIZE
+from utils.images import ImageIngestor, start_encoder_pool
+from utils.router import Router
+from utils.metrics import metrics, instrument_handlers
 # Настройка логирования
 setup_logging()
 logger = logging.getLogger(__name__)
@@ -22,20 +45,51 @@ AWAIT_LOCATION, AWAIT_COMMENT = range(6, 8)
 ADMIN_PANEL, VIEW_ORDERS, ORDER_DETAIL = range(8, 11)
 AWAIT_CLIENT_MESSAGE = 11
 
+# Количество заказов на одной странице админ-панели
+ORDERS_PAGE_SIZE = 10
+
+# Кнопки категорий главного меню
+CATEGORIES = ('Одноразки', 'Жидкости', 'Вейпы')
+
+# Inline-режим: результатов на странице и сколько секунд Telegram кэширует ответ
+INLINE_PAGE_SIZE = 20
+INLINE_CACHE_TIME = 300
+
+# Процессы пережатия фото создаются до первого потока (его запускает база)
+encoder_pool = start_encoder_pool(IMAGE_WORKERS)
+
 # Инициализация базы данных
-db = Database(DB_PATH)
+db = Database(DB_PATH, CART_JOURNAL_PATH)
+
+# Диалоги и user_data покупателей переживают перезапуск бота
+persistence = SQLitePersistence(db.load_bot_state, db.save_bot_state)
+
+# Все исходящие сообщения идут через очередь с лимитами Telegram
+outbox = Outbox(OUTBOX_WORKERS, OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+
+# Рассылки покупателям идут в фоне через полосу рассылок очереди отправки
+broadcaster = Broadcaster(db, outbox, BROADCAST_BATCH)
+
+# Фото товаров: файл загружается один раз, дальше отправляется file_id
+photos = PhotoCache(db, IMAGES_DIR)
+
+# Фото от администратора разбираются и пережимаются в фоне
+images = ImageIngestor(db, IMAGES_DIR, encoder_pool)
 
 # ==================== ОСНОВНЫЕ ФУНКЦИИ ====================
 
 def start(update: Update, context: CallbackContext):
-    user = update.message.from_user
+    user = update.effective_user
     logger.info(f"User {user.first_name} (ID: {user.id}) started the bot")
     
+    # Запоминаем покупателя для рассылок
+    db.touch_customer(user.id, user.first_name, user.username)
+    
     # Очищаем корзину при старте
     db.clear_cart(user.id)
     context.user_data.clear()
     
-    keyboard = [['Одноразки', 'Жидкости', 'Вейпы']]
+    keyboard = [list(CATEGORIES)]
     
     # Добавляем кнопку админ-панели только для администратора
     if user.id == ADMIN_ID:
@@ -43,66 +97,17 @@ def start(update: Update, context: CallbackContext):
     
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    update.message.reply_text(
+    update.effective_message.reply_text(
         "------------------------------------\n"
         "🚬 *Soft Vape* - магазин вейпов и аксессуаров\n"
         "------------------------------------\n\n"
-        "Выберите категорию:",
+        "Выберите категорию или напишите название товара:",
         reply_markup=reply_markup,
         parse_mode='Markdown'
     )
     
     return MAIN_MENU
 
-def handle_main_menu(update: Update, context: CallbackContext):
-    text = update.message.text
-    user = update.message.from_user
-    
-    if text in ['Одноразки', 'Жидкости', 'Вейпы']:
-        context.user_data['category'] = text
-        return show_category_products(update, context)
-    elif text == '👑 Админ-панель' and user.id == ADMIN_ID:
-        return admin_panel(update, context)
-    
-    update.message.reply_text("Пожалуйста, выберите категорию из меню:")
-    return MAIN_MENU
-
-def show_category_products(update: Update, context: CallbackContext):
-    category = context.user_data['category']
-    products = db.get_products_by_category(category)
-    
-    if not products:
-        keyboard = [['⬅️ Назад в мен️']]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
-        update.message.reply_text(
-            f"😔 В категории '{category}' пока нет товаров в наличии.",
-            reply_markup=reply_markup
-        )
-        return CATEGORY_SELECTION
-    
-    # Создаем кнопки товаров
-    product_buttons = [[product['name']] for product in products]
-    product_buttons.append(['⬅️ Назад в меню'])
-    
-    reply_markup = ReplyKeyboardMarkup(product_buttons, resize_keyboard=True)
-    
-    # Формируем список товаров
-    product_list = "-------------------------------------\n"
-    for product in products:
-        product_list += f"• {product['name']} - {product['cost']} руб. ({product['quantity']} шт.)\n"
-    product_list += "-------------------------------------"
-    
-    update.message.reply_text(
-        f"🏷️ *{category}*:\n\n{product_list}\n\nВыберите товар:",
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
-    )
-    
-    return PRODUCT_SELECTION
-
-#FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
-
 # ==================== ОСНОВНЫЕ ФУНКЦИИ НАВИГАЦИИ ====================
 
 def handle_back_to_menu(update: Update, context: CallbackContext):
@@ -112,6 +117,7 @@ def handle_back_to_menu(update: Update, context: CallbackContext):
     
     # Очищаем временные данные
     context.user_data.pop('category', None)
+    context.user_data.pop('search_query', None)
     context.user_data.pop('selected_product', None)
     context.user_data.pop('quantity', None)
     
@@ -122,28 +128,38 @@ def handle_back_to_products(update: Update, context: CallbackContext):
     user = update.message.from_user
     logger.info(f"User {user.id} returning to products")
     
-    # Сохраняем категорию и возвращаемся к товарам
+    # Сохраняем категорию или запрос поиска и возвращаемся к товарам
     if 'category' in context.user_data:
         return show_category_products(update, context)
+    elif 'search_query' in context.user_data:
+        return show_search_results(update, context, context.user_data['search_query'])
     else:
         return start(update, context)
 
-def handle_main_menu(update: Update, context: CallbackContext):
-    text = update.message.text
-    user = update.message.from_user
-    
-    # Обработка навигации
-    if text == '⬅️ Назад в меню':
-        return handle_back_to_menu(update, context)
-    
-    if text in ['Одноразки', 'Жидкости', 'Вейпы']:
-        context.user_data['category'] = text
-        return show_category_products(update, context)
-    elif text == '👑 Админ-панель' and user.id == ADMIN_ID:
-        return admin_panel(update, context)
-    
-    update.message.reply_text("Пожалуйста, выберите категорию из меню:")
-    return MAIN_MENU
+def handle_category(update: Update, context: CallbackContext):
+    """Кнопка категории в главном меню"""
+    category = update.message.text
+    context.user_data['category'] = category
+    context.user_data.pop('search_query', None)
+    send_category_album(update, context, category)
+    return show_category_products(update, context)
+
+def handle_search_text(update: Update, context: CallbackContext):
+    """Любой другой текст в главном меню - поиск товара по названию"""
+    return show_search_results(update, context, update.message.text)
+
+def send_category_album(update: Update, context: CallbackContext, category: str):
+    """Один альбом с фото первых товаров категории перед списком.
+
+    Сообщения в чат уходят не чаще раза в секунду, поэтому фото всей
+    категории надолго задержали бы список товаров.
+    """
+    products = db.get_products_by_category(category)
+    items = [(product, f"{product.name} - {format_money(to_money(product.cost))} руб.") for product in products]
+    try:
+        photos.send_album(context.bot, update.message.chat_id, items, limit=ALBUM_SIZE)
+    except Exception as e:
+        logger.error(f"Error sending {category} photos: {e}")
 
 def show_category_products(update: Update, context: CallbackContext):
     category = context.user_data.get('category')
@@ -163,7 +179,7 @@ def show_category_products(update: Update, context: CallbackContext):
         return CATEGORY_SELECTION
     
     # Создаем кнопки товаров
-    product_buttons = [[product['name']] for product in products]
+    product_buttons = [[product.name] for product in products]
     product_buttons.append(['⬅️ Назад в меню'])
     
     reply_markup = ReplyKeyboardMarkup(product_buttons, resize_keyboard=True)
@@ -171,7 +187,7 @@ def show_category_products(update: Update, context: CallbackContext):
     # Формируем список товаров
     product_list = "-------------------------------------\n"
     for product in products:
-        product_list += f"• {product['name']} - {product['cost']} руб. ({product['quantity']} шт.)\n"
+        product_list += f"• {product.name} - {product.cost} руб. ({product.quantity} шт.)\n"
     product_list += "-------------------------------------"
     
     update.message.reply_text(
@@ -182,140 +198,220 @@ def show_category_products(update: Update, context: CallbackContext):
     
     return PRODUCT_SELECTION
 
-def handle_product_selection(update: Update, context: CallbackContext):
-    text = update.message.text
+def show_search_results(update: Update, context: CallbackContext, query: str):
+    """Показать найденные товары кнопками, как список категории"""
+    products = db.search_products(query)
     
-    # Обработка навигации
-    if text == '⬅️ Назад в меню':
-        return handle_back_to_menu(update, context)
+    if not products:
+        update.message.reply_text(
+            f"🔍 По запросу «{query}» ничего не найдено.\n"
+            "Попробуйте другое название или выберите категорию из меню."
+        )
+        return MAIN_MENU
     
-    product = db.get_product(text)
-    if not product:
-        update.message.reply_text("❌ Товар не найден. Выберите из списка:")
-        return PRODUCT_SELECTION
+    context.user_data['search_query'] = query
+    context.user_data.pop('category', None)
     
-    context.user_data['selected_product'] = product
-    context.user_data['quantity'] = 1
+    product_buttons = [[product.name] for product in products]
+    product_buttons.append(['⬅️ Назад в меню'])
     
-    # Показываем информацию о товаре
-    keyboard = [
-        ['➖ Уменьшить', '➕ Увеличить'],
-        ['✅ Подтвердить', '❌ Отменить заказ'],
-        ['🛒 Добавить к заказу'],
-        ['⬅️ Назад к товарам', '⬅️ Назад в меню']
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    reply_markup = ReplyKeyboardMarkup(product_buttons, resize_keyboard=True)
     
-    total_price = product['cost'] * context.user_data['quantity']
+    product_list = "-------------------------------------\n"
+    for product in products:
+        product_list += f"• {product.name} - {product.cost} руб. ({product.quantity} шт.)\n"
+    product_list += "-------------------------------------"
     
     update.message.reply_text(
-        f"------------------------------------------\n"
-        f"🎯 *Вы выбрали:* {product['name']}\n"
-        f"📦 *Количество:* {context.user_data['quantity']} шт.\n"
-        f"💰 *Итоговая цена:* {total_price} руб.\n"
-        f"------------------------------------------\n\n"
-        f"Выберите действие:",
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
+        f"🔍 Найдено по запросу «{query}»:\n\n{product_list}\n\nВыберите товар:",
+        reply_markup=reply_markup
     )
     
-    return QUANTITY_SELECTION
+    return PRODUCT_SELECTION
 
-def handle_quantity_change(update: Update, context: CallbackContext):
-    text = update.message.text
-    product = context.user_data.get('selected_product')
+def search_command(update: Update, context: CallbackContext):
+    """Команда /search <название>"""
+    query = ' '.join(context.args or [])
+    if not query:
+        update.message.reply_text("🔍 Напишите название товара, например: /search elf bar")
+        return MAIN_MENU
     
+    return show_search_results(update, context, query)
+
+def handle_product_selection(update: Update, context: CallbackContext):
+    text = update.message.text
+    product = db.get_product(text)
     if not product:
-        return start(update, context)
+        # Название введено не точно - ищем похожие товары
+        return show_search_results(update, context, text)
     
-    # Обработка навигации
-    if text == '⬅️ Назад к товарам':
-        return handle_back_to_products(update, context)
-    elif text == '⬅️ Назад в меню':
-        return handle_back_to_menu(update, context)
-    
-    if text == '➕ Увеличить':
-        if context.user_data['quantity'] < product['quantity']:
-            context.user_data['quantity'] += 1
-    elif text == '➖ Уменьшить':
-        if context.user_data['quantity'] > 1:
-            context.user_data['quantity'] -= 1
-    
-    total_price = product['cost'] * context.user_data['quantity']
+    context.user_data['selected_product'] = product
+    context.user_data['quantity'] = 1
     
-    keyboard = [
-        ['➖ Уменьшить', '➕ Увеличить'],
-        ['✅ Подтвердить', '❌ Отменить заказ'],
-        ['🛒 Добавить к заказу'],
-        ['⬅️ Назад к товарам', '⬅️ Назад в меню']
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    # Карточка товара с inline-кнопками: количество меняется правкой этого же сообщения
+    card_text, card_markup = format_product_card(product, 1)
+    card = None
+    try:
+        card = photos.send_photo(
+            context.bot, update.message.chat_id, product, card_text,
+            reply_markup=card_markup, parse_mode='Markdown'
+        )
+    except Exception as e:
+        logger.error(f"Error sending photo of {product.name}: {e}")
+    context.user_data['card_photo'] = card is not None
+    if card is None:
+        card = update.message.reply_text(card_text, reply_markup=card_markup, parse_mode='Markdown')
+    context.user_data['card_message_id'] = card.message_id
     
-    update.message.reply_text(
+    return QUANTITY_SELECTION
+
+# Шаги изменения количества на карточке товара
+QUANTITY_STEPS = (1, 5, 10)
+
+def format_product_card(product, quantity: int):
+    """Текст и inline-клавиатура карточки товара"""
+    total_price = format_money(to_money(product.cost) * quantity)
+    text = (
         f"------------------------------------------\n"
-        f"🎯 *Вы выбрали:* {product['name']}\n"
-        f"📦 *Количество:* {context.user_data['quantity']} шт.\n"
+        f"🎯 *Вы выбрали:* {product.name}\n"
+        f"📦 *Количество:* {quantity} шт. (в наличии {product.quantity})\n"
         f"💰 *Итоговая цена:* {total_price} руб.\n"
         f"------------------------------------------\n\n"
-        f"Выберите действие:",
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
+        f"Измените количество кнопками или отправьте число:"
     )
+    keyboard = [
+        [InlineKeyboardButton(f"➖{step}", callback_data=f"qty:-{step}") for step in reversed(QUANTITY_STEPS)],
+        [InlineKeyboardButton(f"➕{step}", callback_data=f"qty:+{step}") for step in QUANTITY_STEPS],
+        [
+            InlineKeyboardButton("✅ Подтвердить", callback_data="cart:confirm"),
+            InlineKeyboardButton("🛒 Добавить к заказу", callback_data="cart:add")
+        ],
+        [InlineKeyboardButton("❌ Отменить заказ", callback_data="cart:cancel")]
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
+
+def set_quantity(context: CallbackContext, quantity: int) -> bool:
+    """Установить количество в пределах 1..остаток; вернуть, изменилось ли оно"""
+    product = context.user_data['selected_product']
+    quantity = max(1, min(quantity, product.quantity))
+    if quantity == context.user_data.get('quantity'):
+        return False
+    context.user_data['quantity'] = quantity
+    return True
+
+def refresh_product_card(context: CallbackContext, chat_id: int):
+    product = context.user_data['selected_product']
+    card_text, card_markup = format_product_card(product, context.user_data['quantity'])
+    message = {
+        'chat_id': chat_id,
+        'message_id': context.user_data['card_message_id'],
+        'reply_markup': card_markup,
+        'parse_mode': 'Markdown',
+    }
+    # У карточки с фото текст - это подпись
+    if context.user_data.get('card_photo'):
+        context.bot.edit_message_caption(caption=card_text, **message)
+    else:
+        context.bot.edit_message_text(text=card_text, **message)
+
+def active_card_query(update: Update, context: CallbackContext):
+    """Нажатие на актуальной карточке товара или None (старая карточка уже ответила)"""
+    query = update.callback_query
+    if (not context.user_data.get('selected_product')
+            or query.message.message_id != context.user_data.get('card_message_id')):
+        query.answer("Эта карточка устарела, выберите товар заново")
+        return None
+    return query
+
+def edit_card(query, text: str):
+    """Заменить текст (или подпись фото) карточки и убрать кнопки"""
+    if query.message.photo:
+        query.edit_message_caption(text)
+    else:
+        query.edit_message_text(text)
+
+def handle_quantity_callback(update: Update, context: CallbackContext):
+    """Кнопки ±1/±5/±10 на карточке товара"""
+    query = active_card_query(update, context)
+    if query is None:
+        return None
+    
+    step = int(query.data.split(':', 1)[1])
+    if set_quantity(context, context.user_data['quantity'] + step):
+        query.answer()
+        refresh_product_card(context, query.message.chat_id)
+    else:
+        product = context.user_data['selected_product']
+        query.answer(f"Можно от 1 до {product.quantity} шт.")
     
     return QUANTITY_SELECTION
 
-def handle_cart_action(update: Update, context: CallbackContext):
+def handle_quantity_text(update: Update, context: CallbackContext):
+    """Текст при открытой карточке: число - количество, иначе другой товар из списка"""
     text = update.message.text
-    user = update.message.from_user
+    if text.isdigit() and len(text) <= 4:
+        return handle_quantity_input(update, context)
+    return handle_product_selection(update, context)
+
+def handle_quantity_input(update: Update, context: CallbackContext):
+    """Количество, введённое числом"""
     product = context.user_data.get('selected_product')
-    
-    if not product:
+    if not product or 'card_message_id' not in context.user_data:
         return start(update, context)
     
+    requested = int(update.message.text)
+    if set_quantity(context, requested):
+        refresh_product_card(context, update.message.chat_id)
+    if requested != context.user_data['quantity']:
+        update.message.reply_text(f"ℹ️ Можно от 1 до {product.quantity} шт., выбрано {context.user_data['quantity']}")
+    
+    return QUANTITY_SELECTION
+
+def handle_cart_callback(update: Update, context: CallbackContext):
+    """Кнопки «Подтвердить», «Добавить к заказу», «Отменить заказ» на карточке товара"""
+    query = active_card_query(update, context)
+    if query is None:
+        return None
+    
+    user = query.from_user
+    product = context.user_data['selected_product']
     quantity = context.user_data.get('quantity', 1)
+    action = query.data.split(':', 1)[1]
+    query.answer()
+    context.user_data.pop('card_message_id', None)
     
-    # Обработка навигации
-    if text == '⬅️ Назад к товарам':
-        return handle_back_to_products(update, context)
-    elif text == '⬅️ Назад в меню':
-        return handle_back_to_menu(update, context)
+    if action == 'cancel':
+        # Пункт 3.2 - Отмена покупок
+        db.clear_cart(user.id)
+        edit_card(query, "❌ Заказ отменен. Корзина очищена.")
+        return start(update, context)
     
-    if text == '✅ Подтвердить':
-        # Сохраняем в корзину и переходим к оформлению
-        cart = db.get_cart(user.id)
-        cart[product['name']] = quantity
-        db.save_cart(user.id, cart)
-        
+    cart = db.get_cart(user.id)
+    cart[product.name] = quantity
+    db.save_cart(user.id, cart)
+    edit_card(query, f"🛒 {product.name} x{quantity} - в корзине")
+    
+    if action == 'confirm':
+        # Переходим к оформлению
         keyboard = [
             [KeyboardButton("📍 Отправить локацию", request_location=True)],
             ['❌ Отменить заказ', '⬅️ Назад к товарам']
         ]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        update.message.reply_text(
+        query.message.reply_text(
             "📍 *Отправьте вашу геолокацию для доставки:*\n\n"
             "Нажмите кнопку ниже 👇",
             reply_markup=reply_markup,
             parse_mode='Markdown'
         )
         return AWAIT_LOCATION
-        
-    elif text == '❌ Отменить заказ':
-        # Пункт 3.2 - Отмена покупок
-        db.clear_cart(user.id)
-        update.message.reply_text("❌ Заказ отменен. Корзина очищена.")
-        return start(update, context)
-        
-    elif text == '🛒 Добавить к заказу':
-        # Пункт 3.3 - Продолжение покупок
-        cart = db.get_cart(user.id)
-        cart[product['name']] = quantity
-        db.save_cart(user.id, cart)
-        
-        update.message.reply_text(
-            "✅ Товар добавлен в корзину! Продолжайте покупки.",
-            reply_markup=ReplyKeyboardMarkup([['Одноразки', 'Жидкости', 'Вейпы']], resize_keyboard=True)
-        )
-        return MAIN_MENU
+    
+    # Пункт 3.3 - Продолжение покупок
+    query.message.reply_text(
+        "✅ Товар добавлен в корзину! Продолжайте покупки.",
+        reply_markup=ReplyKeyboardMarkup([list(CATEGORIES)], resize_keyboard=True)
+    )
+    return MAIN_MENU
 
 def handle_location(update: Update, context: CallbackContext):
     if update.message.location:
@@ -361,30 +457,31 @@ def handle_comment(update: Update, context: CallbackContext):
         )
         return ConversationHandler.END
     
-    # Получаем ВСЕ продукты из базы для расчета
-    all_products = db.get_all_products()
-    logger.info(f"All products count: {len(all_products)}")
-    
-    # Рассчитываем итоговую сумму
-    total_price = calculate_order_total(cart, all_products)
-    logger.info(f"Total price: {total_price}")
-    
-    # Сохраняем заказ
+    # Оформляем заказ: цены, списание остатков, заказ и очистка корзины - одной транзакцией
     try:
-        order_id = db.save_order(
-            user.id, 
-            user.first_name, 
-            cart, 
-            total_price, 
-            location, 
-            comment
-        )
+        result = db.checkout(user.id, user.first_name, location, comment)
+        order_id = result['order_id']
+        
+        if result['out_of_stock'] or result['unknown']:
+            missing_text = "😔 *Недостаточно товара на складе:*\n\n"
+            for item in result['out_of_stock']:
+                missing_text += f"• {item['name']} - нужно {item['requested']} шт., в наличии {item['available']} шт.\n"
+            for name in result['unknown']:
+                missing_text += f"• {name} - больше нет в каталоге\n"
+            missing_text += "\nИзмените заказ и оформите его заново."
+            
+            update.message.reply_text(
+                missing_text,
+                reply_markup=ReplyKeyboardMarkup([['/start']], resize_keyboard=True),
+                parse_mode='Markdown'
+            )
+            return ConversationHandler.END
         
         if order_id:
-            logger.info(f"Order saved with ID: {order_id}")
+            logger.info(f"Order saved with ID: {order_id}, total: {result['total_price']}")
             
-            # Формируем текст заказа
-            order_text = format_order_text(cart, all_products, location, comment)
+            # Формируем текст заказа по ценам, зафиксированным при оформлении
+            order_text = format_order_text(result['quote'], location, comment)
             
             # Отправляем подтверждение пользователю
             keyboard = [['/start']]
@@ -396,29 +493,23 @@ def handle_comment(update: Update, context: CallbackContext):
                 parse_mode='Markdown'
             )
             
-            # Отправляем уведомление админу
+            # Уведомление админу уходит из очереди, обработчик его не ждёт
             try:
                 admin_text = f"📦 *Новый заказ #{order_id}*\n\n"
                 admin_text += f"👤 Пользователь: {user.first_name} (@{user.username or 'нет'})\n"
                 admin_text += f"📞 ID: {user.id}\n\n"
                 admin_text += order_text
                 
-                context.bot.send_message(
-                    chat_id=ADMIN_ID,
-                    text=admin_text,
-                    parse_mode='Markdown'
-                )
-                logger.info("Admin notification sent")
+                outbox.send_message(ADMIN_ID, admin_text, priority=PRIORITY_ADMIN, parse_mode='Markdown')
+                logger.info("Admin notification queued")
             except Exception as e:
-                logger.error(f"Error sending admin notification: {e}")
+                logger.error(f"Error queueing admin notification: {e}")
             
-            # Очищаем корзину
-            db.clear_cart(user.id)
+            # Корзина уже удалена в транзакции оформления
             context.user_data.clear()
-            logger.info("Cart cleared")
             
         else:
-            logger.error("Order ID is None - save_order failed")
+            logger.error("Order ID is None - checkout failed")
             update.message.reply_text(
                 "❌ Произошла ошибка при сохранении заказа. Попробуйте еще раз.",
                 reply_markup=ReplyKeyboardMarkup([['/start']], resize_keyboard=True)
@@ -433,6 +524,49 @@ def handle_comment(update: Update, context: CallbackContext):
     
     return ConversationHandler.END
 
+# ==================== INLINE-РЕЖИМ ====================
+
+def inline_result(product):
+    """Результат inline-запроса: фото из кэша file_id или текстовая карточка"""
+    price = format_money(to_money(product.cost))
+    summary = f"{price} руб. · в наличии {product.quantity} шт."
+    text = f"🚬 {product.name}\n💰 {price} руб.\n📦 В наличии: {product.quantity} шт."
+    if product.description:
+        text += f"\n\n{product.description}"
+    
+    file_id = photos.file_id(product)
+    if file_id:
+        return InlineQueryResultCachedPhoto(
+            id=str(product.id), photo_file_id=file_id, title=product.name, description=summary, caption=text
+        )
+    return InlineQueryResultArticle(
+        id=str(product.id), title=product.name, description=summary,
+        input_message_content=InputTextMessageContent(text)
+    )
+
+def inline_query(update: Update, context: CallbackContext):
+    """@бот название - товары с ценой и остатком в любом чате"""
+    query = update.inline_query
+    text = query.query.strip()
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    
+    if text:
+        # Одна лишняя строка показывает, есть ли следующая страница
+        products = db.search_products(text, limit=INLINE_PAGE_SIZE + 1, offset=offset)
+    else:
+        in_stock = [product for product in db.get_all_products() if product.quantity > 0]
+        products = in_stock[offset:offset + INLINE_PAGE_SIZE + 1]
+    
+    has_more = len(products) > INLINE_PAGE_SIZE
+    query.answer(
+        [inline_result(product) for product in products[:INLINE_PAGE_SIZE]],
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=str(offset + INLINE_PAGE_SIZE) if has_more else '',
+        switch_pm_text="🛒 Открыть магазин" if not offset else None,
+        switch_pm_parameter="inline" if not offset else None
+    )
+
 # ==================== АДМИН-ПАНЕЛЬ ====================
 
 def admin_panel(update: Update, context: CallbackContext):
@@ -444,9 +578,9 @@ def admin_panel(update: Update, context: CallbackContext):
         return ConversationHandler.END
     
     # Очищаем временные данные
-    context.user_data.pop('current_orders', None)
-    context.user_data.pop('selected_order', None)
-    context.user_data.pop('order_status', None)
+    for key in ('order_page_ids', 'order_page_before', 'order_page_next',
+                'order_page_history', 'selected_order_id', 'order_status'):
+        context.user_data.pop(key, None)
     
     keyboard = [
         ['📦 Активные заказы', '✅ Завершенные'],
@@ -469,118 +603,88 @@ def admin_command(update: Update, context: CallbackContext):
     """Команда /admin для открытия админ-панели"""
     return admin_panel(update, context)
 
-def handle_admin_actions(update: Update, context: CallbackContext):
-    """Обработка действий в админ-панели"""
-    user = update.message.from_user
-    text = update.message.text
-    
-    if user.id != ADMIN_ID:
-        update.message.reply_text("❌ Доступ только для администратора.")
-        return ADMIN_PANEL
-    
-    # Обрабатываем кнопку "Главное меню"
-    if text == '⬅️ Главное меню':
-        context.user_data.clear()
-        return start(update, context)
-    
-    # Обрабатываем кнопку "Назад в админ-панель"
-    if text == '⬅️ Назад в админ-панель':
-        return admin_panel(update, context)
-    
-    # Безопасное логирование с эмодзи
-        safe_text = text.encode('ascii', 'ignore').decode('ascii') if text else 'empty'
-        logger.info(f"Admin action: '{safe_text}' from user {user.id}")
-    
-    # УДАЛЕНО: блок статистики
-    elif text == '📦 Активные заказы':
-        show_orders(update, context, 'pending')
-        return
-        
-    elif text == '✅ Завершенные':
-        show_orders(update, context, 'completed')
-        return
-        
-    elif text == '❌ Отмененные':
-        show_orders(update, context, 'cancelled')
-        return
-        
-    elif text == '🔄 Обновить товары':
-        update.message.reply_text(
-            "📦 Отправьте CSV файл с товарами.\n\n"
-            "Формат: category,name,cost,quantity,description\n"
-            "Пример: Одноразки,Elf Bar,1500,25,Вкус манго\n\n"
-            "Или нажмите /cancel для отмены"
-        )
-        context.user_data['awaiting_csv'] = True
-        return
-        
-    elif text == '🗑️ Управление товарами':
-        keyboard = [
-            ['🗑️ Очистить все товары', '📦 Заменить товары'],
-            ['📋 Показать товары', '⬅️ Назад в админ-панель']
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
-        update.message.reply_text(
-            "🛍️ *Управление товарами*\n\n"
-            "Выберите действие:",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
-        return
-    
-    # Обработка кнопок управления товарами
-    elif text == '🗑️ Очистить все товары':
-        keyboard = [['✅ Да, очистить', '❌ Нет, отмена']]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
-        update.message.reply_text(
-            "⚠️ *ВНИМАНИЕ!*\n\n"
-            "Вы уверены, что хотите очистить ВСЕ товары из базы данных?\n"
-            "Это действие нельзя отменить!",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
-        context.user_data['awaiting_clear'] = True
-        return
-        
-    elif text == '📦 Заменить товары':
-        update.message.reply_text(
-            "📦 *Замена товаров*\n\n"
-            "Отправьте CSV файл с новыми товарами.\n\n"
-            "Формат: category,name,cost,quantity,description\n"
-            "Пример: Одноразки,Elf Bar,1500,25,Вкус манго\n\n"
-            "⚠️ *ВНИМАНИЕ!* Все старые товары будут удалены!",
-            parse_mode='Markdown'
-        )
-        context.user_data['awaiting_replace'] = True
-        return
-        
-    elif text == '📋 Показать товары':
-        show_products_list(update, context)
-        return
-        
-    elif text == '⬅️ Назад в админ-панель':
-        admin_panel(update, context)
-        return
-    
-    # Обработка подтверждения очистки товаров
-    elif text in ['✅ Да, очистить', '❌ Нет, отмена']:
-        handle_clear_confirmation(update, context)
-        return
-    
-    # Обработка кнопок управления заказами
-    elif text in ['✅ Выполнить заказ', '❌ Отменить заказ', '❌ Вернуть в ожидание', '✅ Восстановить заказ', '⬅️ Назад к списку']:
-        handle_order_details(update, context)
-        return
+def handle_admin_back_to_start(update: Update, context: CallbackContext):
+    """Кнопка «Главное меню» в админ-панели"""
+    context.user_data.clear()
+    return start(update, context)
+
+def show_active_orders(update: Update, context: CallbackContext):
+    show_orders(update, context, 'pending')
+
+def show_completed_orders(update: Update, context: CallbackContext):
+    show_orders(update, context, 'completed')
+
+def show_cancelled_orders(update: Update, context: CallbackContext):
+    show_orders(update, context, 'cancelled')
+
+def ask_products_csv(update: Update, context: CallbackContext):
+    """Кнопка «Обновить товары»: ждём CSV с изменениями"""
+    update.message.reply_text(
+        "📦 Отправьте CSV файл с товарами.\n\n"
+        "Формат: category,name,cost,quantity,description\n"
+        "Пример: Одноразки,Elf Bar,1500,25,Вкус манго\n\n"
+        "Или нажмите /cancel для отмены"
+    )
+    context.user_data['awaiting_csv'] = True
+
+def products_menu(update: Update, context: CallbackContext):
+    """Меню управления товарами"""
+    keyboard = [
+        ['🗑️ Очистить все товары', '📦 Заменить товары'],
+        ['📋 Показать товары', '🖼️ Фото товаров'],
+        ['⬅️ Назад в админ-панель']
+    ]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    # Обработка выбора номера заказа
-    elif text.isdigit():
-        handle_order_selection(update, context)
-        return
+    update.message.reply_text(
+        "🛍️ *Управление товарами*\n\n"
+        "Выберите действие:",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+def ask_clear_products(update: Update, context: CallbackContext):
+    """Кнопка «Очистить все товары»: просим подтверждение"""
+    keyboard = [['✅ Да, очистить', '❌ Нет, отмена']]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    # Если это не известная команда, показываем админ-панель снова
-    admin_panel(update, context)
+    update.message.reply_text(
+        "⚠️ *ВНИМАНИЕ!*\n\n"
+        "Вы уверены, что хотите очистить ВСЕ товары из базы данных?\n"
+        "Это действие нельзя отменить!",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+    context.user_data['awaiting_clear'] = True
+
+def ask_replace_products(update: Update, context: CallbackContext):
+    """Кнопка «Заменить товары»: ждём CSV с полным списком"""
+    update.message.reply_text(
+        "📦 *Замена товаров*\n\n"
+        "Отправьте CSV файл с новыми товарами.\n\n"
+        "Формат: category,name,cost,quantity,description\n"
+        "Пример: Одноразки,Elf Bar,1500,25,Вкус манго\n\n"
+        "⚠️ *ВНИМАНИЕ!* Все старые товары будут удалены!",
+        parse_mode='Markdown'
+    )
+    context.user_data['awaiting_replace'] = True
+
+def show_images_help(update: Update, context: CallbackContext):
+    """Кнопка «Фото товаров»: как загрузить фото"""
+    update.message.reply_text(
+        "🖼️ *Фото товаров*\n\n"
+        "Отправьте фото с подписью - названием товара,\n"
+        "картинку файлом (название в подписи или в имени файла)\n"
+        "или zip-архив, где имя каждого файла - название товара.\n\n"
+        "Файлы обрабатываются в фоне, по готовности придёт отчёт.",
+        parse_mode='Markdown'
+    )
+
+def handle_admin_text(update: Update, context: CallbackContext):
+    """Номер заказа из списка; любой другой текст - снова админ-панель"""
+    if update.message.text.isdigit():
+        return handle_order_selection(update, context)
+    return admin_panel(update, context)
 
 def show_products_list(update: Update, context: CallbackContext):
     """Показать список всех товаров"""
@@ -594,7 +698,7 @@ def show_products_list(update: Update, context: CallbackContext):
         # Группируем товары по категориям
         categories = {}
         for product in products:
-            category = product['category']
+            category = product.category
             if category not in categories:
                 categories[category] = []
             categories[category].append(product)
@@ -605,7 +709,7 @@ def show_products_list(update: Update, context: CallbackContext):
         for category, category_products in categories.items():
             products_text += f"📂 *{category}:*\n"
             for product in category_products:
-                products_text += f"• {product['name']} - {product['cost']} руб. (остаток: {product['quantity']} шт.)\n"
+                products_text += f"• {product.name} - {product.cost} руб. (остаток: {product.quantity} шт.)\n"
             products_text += "\n"
         
         products_text += f"📊 *Всего товаров:* {len(products)}\n"
@@ -624,11 +728,12 @@ def show_products_list(update: Update, context: CallbackContext):
         logger.error(f"Error showing products: {e}")
         update.message.reply_text(f"❌ Ошибка при получении списка товаров: {e}")
 
-def show_orders(update: Update, context: CallbackContext, status: str):
-    """Показать заказы по статусу"""
-    logger.info(f"Showing orders with status: {status}")
-    orders = db.get_all_orders(status)
-    logger.info(f"Found {len(orders)} orders")
+def show_orders(update: Update, context: CallbackContext, status: str, before_id: Optional[int] = None):
+    """Показать страницу заказов по статусу"""
+    logger.info(f"Showing orders with status: {status}, before: {before_id}")
+    page = db.get_orders_page(status, before_id, ORDERS_PAGE_SIZE)
+    orders = page['orders']
+    logger.info(f"Found {len(orders)} orders on page")
     
     if not orders:
         keyboard = [['⬅️ Назад в админ-панель']]
@@ -639,22 +744,37 @@ def show_orders(update: Update, context: CallbackContext, status: str):
         )
         return
     
-    context.user_data['current_orders'] = orders
+    # В сессии храним только id заказов текущей страницы и курсоры
+    if before_id is None:
+        context.user_data['order_page_history'] = []
     context.user_data['order_status'] = status
+    context.user_data['order_page_ids'] = [order.id for order in orders]
+    context.user_data['order_page_before'] = before_id
+    context.user_data['order_page_next'] = page['next_before_id']
     
     # Создаем кнопки с заказами
     keyboard = []
-    orders_text = f"📦 *Заказы ({status}):*\n\n"
+    page_number = len(context.user_data.get('order_page_history', [])) + 1
+    orders_text = f"📦 *Заказы ({status}), стр. {page_number}:*\n\n"
     
     for i, order in enumerate(orders, 1):
-        order_count = len(order['order_data'])
-        orders_text += f"{i}. #{order['id']} - {order['user_name']}, {order_count}шт, {order['total_price']}руб\n"
+        order_count = len(order.order_data)
+        orders_text += f"{i}. #{order.id} - {order.user_name}, {order_count}шт, {order.total_price}руб\n"
         
         if i % 2 == 1:
             keyboard.append([str(i)])
         else:
             keyboard[-1].append(str(i))
     
+    # Навигация по страницам
+    navigation = []
+    if before_id is not None:
+        navigation.append('⬅️ Новые')
+    if page['next_before_id'] is not None:
+        navigation.append('Старые ➡️')
+    if navigation:
+        keyboard.append(navigation)
+    
     keyboard.append(['⬅️ Назад в админ-панель'])
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
@@ -664,19 +784,32 @@ def show_orders(update: Update, context: CallbackContext, status: str):
         parse_mode='Markdown'
     )
 
-def handle_order_selection(update: Update, context: CallbackContext):
-    """Обработка выбора заказа"""
+def handle_orders_page(update: Update, context: CallbackContext):
+    """Переход между страницами списка заказов"""
     text = update.message.text
-    user = update.message.from_user
-    
-    if user.id != ADMIN_ID:
-        return
+    status = context.user_data.get('order_status')
+    history = context.user_data.setdefault('order_page_history', [])
     
-    if text == '⬅️ Назад в админ-панель':
+    if not status:
         admin_panel(update, context)
         return
     
-    orders = context.user_data.get('current_orders', [])
+    if text == 'Старые ➡️':
+        next_before = context.user_data.get('order_page_next')
+        if next_before is None:
+            update.message.reply_text("📭 Это последняя страница")
+            return
+        history.append(context.user_data.get('order_page_before'))
+        show_orders(update, context, status, next_before)
+    elif text == '⬅️ Новые':
+        previous_before = history.pop() if history else None
+        show_orders(update, context, status, previous_before)
+
+def handle_order_selection(update: Update, context: CallbackContext):
+    """Обработка выбора заказа"""
+    text = update.message.text
+    
+    order_ids = context.user_data.get('order_page_ids', [])
     
     if not text.isdigit():
         update.message.reply_text("❌ Пожалуйста, выберите номер заказа:")
@@ -684,18 +817,21 @@ def handle_order_selection(update: Update, context: CallbackContext):
     
     order_index = int(text) - 1
     
-    if order_index < 0 or order_index >= len(orders):
+    if order_index < 0 or order_index >= len(order_ids):
         update.message.reply_text("❌ Неверный номер заказа. Выберите из списка:")
         return
     
-    selected_order = orders[order_index]
-    context.user_data['selected_order'] = selected_order
+    selected_order = db.get_order_by_id(order_ids[order_index])
+    if not selected_order:
+        update.message.reply_text("❌ Заказ не найден. Выберите из списка:")
+        return
+    context.user_data['selected_order_id'] = selected_order.id
     
     # Формируем текст заказа
     order_text = format_order_details(selected_order)
     
     # Кнопки действий в зависимости от статуса
-    status = context.user_data.get('order_status', 'pending')
+    status = selected_order.status
     keyboard = []
     
     if status == 'pending':
@@ -728,25 +864,22 @@ def handle_order_details(update: Update, context: CallbackContext):
     """Обработка действий с заказом"""
     text = update.message.text
     user = update.message.from_user
-    order = context.user_data.get('selected_order')
+    order_id = context.user_data.get('selected_order_id')
     
-    if user.id != ADMIN_ID:
-        return
-    
-    if not order:
+    if not order_id:
         update.message.reply_text("❌ Заказ не найден. Возвращаемся в админ-панель.")
         admin_panel(update, context)
         return
     
     if text == '⬅️ Назад к списку':
         status = context.user_data.get('order_status', 'pending')
-        show_orders(update, context, status)
+        show_orders(update, context, status, context.user_data.get('order_page_before'))
         return
     
     elif text == '✅ Выполнить заказ':
-        if db.update_order_status(order['id'], 'completed'):
+        if db.update_order_status(order_id, 'completed'):
             update.message.reply_text("✅ Заказ отмечен как выполненный")
-            logger.info(f"Order {order['id']} marked as completed by admin {user.id}")
+            logger.info(f"Order {order_id} marked as completed by admin {user.id}")
         else:
             update.message.reply_text("❌ Ошибка при обновлении статуса заказа")
         
@@ -754,9 +887,9 @@ def handle_order_details(update: Update, context: CallbackContext):
         return
     
     elif text == '❌ Отменить заказ':
-        if db.update_order_status(order['id'], 'cancelled'):
+        if db.update_order_status(order_id, 'cancelled'):
             update.message.reply_text("❌ Заказ отменен")
-            logger.info(f"Order {order['id']} cancelled by admin {user.id}")
+            logger.info(f"Order {order_id} cancelled by admin {user.id}")
         else:
             update.message.reply_text("❌ Ошибка при отмене заказа")
         
@@ -764,9 +897,9 @@ def handle_order_details(update: Update, context: CallbackContext):
         return
     
     elif text == '❌ Вернуть в ожидание':
-        if db.update_order_status(order['id'], 'pending'):
+        if db.update_order_status(order_id, 'pending'):
             update.message.reply_text("🔄 Заказ возвращен в ожидание")
-            logger.info(f"Order {order['id']} returned to pending by admin {user.id}")
+            logger.info(f"Order {order_id} returned to pending by admin {user.id}")
         else:
             update.message.reply_text("❌ Ошибка при обновлении статуса заказа")
         
@@ -774,15 +907,43 @@ def handle_order_details(update: Update, context: CallbackContext):
         return
     
     elif text == '✅ Восстановить заказ':
-        if db.update_order_status(order['id'], 'pending'):
+        if db.update_order_status(order_id, 'pending'):
             update.message.reply_text("✅ Заказ восстановлен")
-            logger.info(f"Order {order['id']} restored by admin {user.id}")
+            logger.info(f"Order {order_id} restored by admin {user.id}")
         else:
             update.message.reply_text("❌ Ошибка при восстановлении заказа")
         
         admin_panel(update, context)
         return
 
+def handle_image_upload(update: Update, context: CallbackContext):
+    """Фото товаров: фото, картинка файлом или zip-архив (обработка в фоне)"""
+    message = update.message
+    
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    if message.photo:
+        file_id = message.photo[-1].file_id
+        filename = 'фото'
+        name = message.caption or ''
+    else:
+        file_id = message.document.file_id
+        filename = message.document.file_name or 'файл'
+        name = message.caption or os.path.splitext(filename)[0]
+    
+    chat_id = message.chat_id
+    bot = context.bot
+    images.submit(
+        lambda: bytes(bot.get_file(file_id).download_as_bytearray()),
+        name.strip(),
+        filename,
+        lambda report: outbox.send_message(
+            chat_id, f"🖼️ Фото товаров ({filename}):\n\n{report.format()}", priority=PRIORITY_ADMIN
+        )
+    )
+    message.reply_text("⏳ Файл принят, обрабатываю в фоне. Отчёт придёт отдельным сообщением.")
+
 def handle_csv_file(update: Update, context: CallbackContext):
     """Обработка CSV файла"""
     user = update.message.from_user
@@ -791,90 +952,76 @@ def handle_csv_file(update: Update, context: CallbackContext):
         return
     
     if update.message.document:
+        tmp_path = None
         try:
-            file = update.message.document.get_file()
-            file_bytes = file.download_as_bytearray()
-            csv_data = file_bytes.decode('utf-8')
+            # Скачиваем во временный файл и читаем его построчно, не держа прайс в памяти
+            fd, tmp_path = tempfile.mkstemp(suffix='.csv', dir=CSV_DIR)
+            os.close(fd)
+            update.message.document.get_file().download(custom_path=tmp_path)
+            report = ImportReport()
             
-            # Проверяем, что это за операция
-            if context.user_data.get('awaiting_csv'):
-                # Обычное обновление товаров
-                success = db.import_products_from_csv(csv_data)
-                
-                if success:
-                    update.message.reply_text("✅ База данных успешно обновлена из CSV файла!")
-                else:
-                    update.message.reply_text("❌ Ошибка при обработке CSV файла")
+            with open(tmp_path, encoding='utf-8-sig', newline='') as csv_file:
+                # Проверяем, что это за операция
+                if context.user_data.get('awaiting_csv'):
+                    # Обычное обновление товаров: меняем только то, что изменилось
+                    summary = db.import_products_from_csv(csv_file, report)
                     
-            elif context.user_data.get('awaiting_replace'):
-                # Замена товаров
-                success = replace_products_from_csv(update, context, csv_data)
-                
-                if success:
-                    update.message.reply_text("✅ Товары успешно заменены из CSV файла!")
+                    if summary:
+                        update.message.reply_text(
+                            "✅ База данных успешно обновлена из CSV файла!\n\n" + format_sync_summary(summary)
+                        )
+                    else:
+                        update.message.reply_text("❌ Ошибка при обработке CSV файла")
+                        
+                elif context.user_data.get('awaiting_replace'):
+                    # Замена товаров
+                    summary = replace_products_from_csv(update, context, csv_file, report)
+                    
+                    if summary:
+                        update.message.reply_text(
+                            "✅ Товары успешно заменены из CSV файла!\n\n" + format_sync_summary(summary)
+                        )
+                    else:
+                        update.message.reply_text("❌ Ошибка при замене товаров")
                 else:
-                    update.message.reply_text("❌ Ошибка при замене товаров")
-            else:
-                update.message.reply_text("❌ Неожиданный CSV файл. Используйте команды из админ-панели.")
+                    update.message.reply_text("❌ Неожиданный CSV файл. Используйте команды из админ-панели.")
+                    report = None
+            
+            # Отчёт по строкам с ошибками
+            if report is not None:
+                update.message.reply_text(report.format())
                 
         except Exception as e:
             logger.error(f"Error processing CSV: {e}")
             update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
     
     # Очищаем флаги
     context.user_data.pop('awaiting_csv', None)
     context.user_data.pop('awaiting_replace', None)
     admin_panel(update, context)
 
-def replace_products_from_csv(update: Update, context: CallbackContext, csv_data: str):
+def replace_products_from_csv(update: Update, context: CallbackContext, csv_file, report: ImportReport):
     """Замена товаров из CSV файла"""
     try:
-        import csv
-        from io import StringIO
-        
         # Создаем резервную копию текущих товаров
         backup_products = db.get_all_products()
+        create_products_backup(backup_products)
         
-        # Читаем новый CSV
-        reader = csv.DictReader(StringIO(csv_data))
-        new_products = []
-        
-        for row in reader:
-            new_products.append((
-                row.get('category', ''),
-                row.get('name', ''),
-                float(row.get('cost', 0)),
-                int(row.get('quantity', 0)),
-                row.get('image_path', ''),
-                row.get('description', '')
-            ))
-        
-        if not new_products:
+        # Приводим каталог к новому списку одной транзакцией, не трогая совпадающие товары
+        summary = db.import_products_from_csv(csv_file, report)
+        if not summary:
             update.message.reply_text("❌ CSV файл пуст или некорректен")
-            return False
-        
-        # Очищаем старые товары и добавляем новые
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Очищаем таблицу товаров
-        cursor.execute("DELETE FROM products")
-        
-        # Добавляем новые товары
-        cursor.executemany(
-            "INSERT INTO products (category, name, cost, quantity, image_path, description) VALUES (?, ?, ?, ?, ?, ?)",
-            new_products
-        )
-        
-        conn.commit()
-        conn.close()
+            return None
         
-        logger.info(f"Products replaced: {len(backup_products)} old -> {len(new_products)} new")
-        return True
+        logger.info(f"Products replaced: {len(backup_products)} old -> {report.accepted} new, {summary}")
+        return summary
         
     except Exception as e:
         logger.error(f"Error replacing products from CSV: {e}")
-        return False
+        return None
 
 def handle_clear_confirmation(update: Update, context: CallbackContext):
     """Обработка подтверждения очистки"""
@@ -884,9 +1031,6 @@ def handle_clear_confirmation(update: Update, context: CallbackContext):
     logger.info(f"Clear confirmation: '{text}' from user {user.id}")
     print(f"DEBUG: Clear confirmation: '{text}' from user {user.id}")
     
-    if user.id != ADMIN_ID:
-        return
-    
     if not context.user_data.get('awaiting_clear'):
         logger.warning("Clear confirmation called without awaiting_clear flag")
         return
@@ -902,24 +1046,9 @@ def handle_clear_confirmation(update: Update, context: CallbackContext):
             create_products_backup(backup_products)
             
             # Очищаем товары
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            # Проверяем количество товаров до очистки
-            cursor.execute("SELECT COUNT(*) FROM products")
-            count_before = cursor.fetchone()[0]
+            count_before = db.clear_products()
             logger.info(f"Products count before clearing: {count_before}")
             
-            cursor.execute("DELETE FROM products")
-            
-            # Проверяем количество товаров после очистки
-            cursor.execute("SELECT COUNT(*) FROM products")
-            count_after = cursor.fetchone()[0]
-            logger.info(f"Products count after clearing: {count_after}")
-            
-            conn.commit()
-            conn.close()
-            
             update.message.reply_text(
                 f"✅ Все товары удалены из базы данных\n"
                 f"📦 Удалено товаров: {count_before}\n"
@@ -959,12 +1088,12 @@ def create_products_backup(products):
             
             for product in products:
                 writer.writerow([
-                    product['category'],
-                    product['name'],
-                    product['cost'],
-                    product['quantity'],
-                    product.get('image_path', ''),
-                    product.get('description', '')
+                    product.category,
+                    product.name,
+                    product.cost,
+                    product.quantity,
+                    product.image_path or '',
+                    product.description or ''
                 ])
         
         logger.info(f"Products backup created: {backup_path}")
@@ -1001,21 +1130,21 @@ def handle_db_delete_confirmation(update: Update, context: CallbackContext):
     return admin_panel(update, context)
 
 
-def format_order_details(order: dict) -> str:
+def format_order_details(order: Order) -> str:
     """Форматирование деталей заказа"""
-    order_text = f"📦 *Заказ #{order['id']}*\n\n"
-    order_text += f"👤 *Клиент:* {order['user_name']}\n"
-    order_text += f"📞 *ID:* {order['user_id']}\n"
-    order_text += f"💰 *Сумма:* {order['total_price']} руб.\n"
-    order_text += f"📋 *Статус:* {order['status']}\n"
-    order_text += f"⏰ *Дата:* {order['created_at']}\n\n"
+    order_text = f"📦 *Заказ #{order.id}*\n\n"
+    order_text += f"👤 *Клиент:* {order.user_name}\n"
+    order_text += f"📞 *ID:* {order.user_id}\n"
+    order_text += f"💰 *Сумма:* {order.total_price} руб.\n"
+    order_text += f"📋 *Статус:* {order.status}\n"
+    order_text += f"⏰ *Дата:* {order.created_at}\n\n"
     
     order_text += "🛍️ *Состав заказа:*\n"
-    for product_name, quantity in order['order_data'].items():
+    for product_name, quantity in order.order_data.items():
         order_text += f"• {product_name} x{quantity}\n"
     
-    order_text += f"\n📍 *Локация:* {order['location']}\n"
-    order_text += f"📝 *Комментарий:* {order['comment']}\n"
+    order_text += f"\n📍 *Локация:* {order.location}\n"
+    order_text += f"📝 *Комментарий:* {order.comment}\n"
     
     return order_text
 # ==================== СЛУЖЕБНЫЕ ФУНКЦИИ ====================
@@ -1117,13 +1246,13 @@ def test_db(update: Update, context: CallbackContext):
         products = db.get_all_products()
         products_text = f"📦 Товары в базе: {len(products)}\n"
         for product in products[:5]:  # Показываем первые 5
-            products_text += f"• {product['name']} - {product['cost']} руб.\n"
+            products_text += f"• {product.name} - {product.cost} руб.\n"
         
         # Проверяем заказы
-        orders = db.get_all_orders()
-        orders_text = f"\n📋 Заказы в базе: {len(orders)}\n"
-        for order in orders[:3]:  # Показываем первые 3
-            orders_text += f"• #{order['id']} - {order['user_name']} - {order['status']}\n"
+        orders = db.get_orders_page(limit=3)['orders']
+        orders_text = "\n📋 Последние заказы:\n"
+        for order in orders:  # Показываем последние 3
+            orders_text += f"• #{order.id} - {order.user_name} - {order.status}\n"
         
         update.message.reply_text(products_text + orders_text)
         
@@ -1145,19 +1274,7 @@ def force_clear_products(update: Update, context: CallbackContext):
         create_products_backup(backup_products)
         
         # Очищаем товары
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM products")
-        count_before = cursor.fetchone()[0]
-        
-        cursor.execute("DELETE FROM products")
-        
-        cursor.execute("SELECT COUNT(*) FROM products")
-        count_after = cursor.fetchone()[0]
-        
-        conn.commit()
-        conn.close()
+        count_before = db.clear_products()
         
         update.message.reply_text(
             f"✅ Товары принудительно очищены!\n"
@@ -1211,54 +1328,407 @@ def kill_all_bots(update: Update, context: CallbackContext):
     
     return ConversationHandler.END
 
+def db_stats(update: Update, context: CallbackContext):
+    """Счётчики очередей базы данных (только для админа)"""
+    user = update.message.from_user
+    
+    if user.id != ADMIN_ID:
+        update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    
+    stats = db.db_stats()
+    update.message.reply_text(
+        "🗄️ Очереди базы данных:\n\n"
+        f"✍️ Записи: {stats['write_ops']} операций в {stats['write_batches']} транзакциях, "
+        f"ошибок {stats['write_errors']}\n"
+        f"   в очереди: {stats['write_queue_depth']}, ожидание ср. {stats['write_wait_avg'] * 1000:.1f} мс, "
+        f"макс. {stats['write_wait_max'] * 1000:.1f} мс\n"
+        f"📖 Чтения: {stats['read_ops']} операций\n"
+        f"   в очереди: {stats['read_queue_depth']}, ожидание ср. {stats['read_wait_avg'] * 1000:.1f} мс, "
+        f"макс. {stats['read_wait_max'] * 1000:.1f} мс\n"
+        f"🛒 Корзин ждут записи: {db.carts.pending()}"
+    )
+    
+    dispatcher = context.dispatcher
+    if hasattr(dispatcher, 'scheduler'):
+        chats = dispatcher.scheduler.stats()
+        busiest = ', '.join(f"{chat_id}: {length}" for chat_id, length in chats['busiest']) or 'нет'
+        update.message.reply_text(
+            "💬 Очереди чатов:\n\n"
+            f"Обработано обновлений: {chats['processed']}, ошибок {chats['errors']}\n"
+            f"Активных чатов: {chats['active_chats']}, в очередях: {chats['queued']}, "
+            f"самая длинная: {chats['max_chat_queue']}\n"
+            f"Ожидание ср. {chats['wait_avg'] * 1000:.1f} мс, макс. {chats['wait_max'] * 1000:.1f} мс\n"
+            f"Длинные очереди: {busiest}"
+        )
+    
+    routes = [route for route in router.stats() if route['hits'] or route['denied']][:10]
+    if routes:
+        update.message.reply_text(
+            "🧭 Маршруты (самые частые):\n\n" + "\n".join(
+                f"{route['name']}: {route['hits']} раз, ср. {route['time_avg'] * 1000:.1f} мс, "
+                f"макс. {route['time_max'] * 1000:.1f} мс, ошибок {route['errors']}, отказов {route['denied']}"
+                for route in routes
+            )
+        )
+    
+    media = photos.stats()
+    update.message.reply_text(
+        "🖼️ Фото товаров:\n\n"
+        f"Отправлено по file_id: {media['cached']}, загружено: {media['uploaded']}, "
+        f"известно file_id: {media['known']}, файлов не найдено: {media['missing']}"
+    )
+    
+    sending = outbox.stats()
+    update.message.reply_text(
+        "📤 Очередь отправки:\n\n"
+        f"Отправлено: {sending['sent']}, ошибок {sending['failed']}, повторов после 429: {sending['retry_after']}\n"
+        f"В очереди: ответы {sending['queued_reply']}, админу {sending['queued_admin']}, "
+        f"рассылки {sending['queued_bulk']}; отправляется {sending['in_flight']}\n"
+        f"Чатов на паузе: {sending['paused_chats']}\n"
+        f"Задержка доставки ср. {sending['latency_avg'] * 1000:.0f} мс, макс. {sending['latency_max'] * 1000:.0f} мс"
+    )
+
+# ==================== МЕТРИКИ ====================
+
+# Сколько строк показывать в каждом разделе /stats
+STATS_TOP = 8
+
+def top_timings(name: str, limit: int = STATS_TOP) -> List[str]:
+    """Строки для /stats: метки семейства с наибольшим суммарным временем"""
+    errors = {
+        'bot_handler_seconds': 'bot_handler_errors_total',
+        'bot_db_call_seconds': 'bot_db_call_errors_total',
+        'bot_api_seconds': 'bot_api_errors_total',
+    }
+    failed = metrics.counter_values(errors[name])
+    series = sorted(metrics.snapshot(name).items(), key=lambda item: -item[1].sum)[:limit]
+    return [
+        f"{labels[0]}: {histogram.count} раз, ср. {histogram.sum / histogram.count * 1000:.1f} мс, "
+        f"p95 ≤ {histogram.quantile(0.95) * 1000:.1f} мс, ошибок {failed.get(labels, 0):g}"
+        for labels, histogram in series
+    ]
+
+def stats_command(update: Update, context: CallbackContext):
+    """Задержки обработчиков, базы и Bot API (только для админа)"""
+    user = update.message.from_user
+    
+    if user.id != ADMIN_ID:
+        update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    
+    updates = metrics.snapshot('bot_update_seconds').get(())
+    if updates is None or not updates.count:
+        update.message.reply_text("📈 Обновлений ещё не было.")
+        return
+    
+    per_update = {
+        kind: metrics.snapshot(f'bot_update_{kind}').get(())
+        for kind in ('api_calls', 'db_calls', 'sql_statements')
+    }
+    text = (
+        "📈 Обработка обновлений:\n\n"
+        f"Обновлений: {updates.count}, ср. {updates.sum / updates.count * 1000:.1f} мс, "
+        f"p95 ≤ {updates.quantile(0.95) * 1000:.1f} мс\n"
+        f"На обновление в среднем: запросов к Bot API {per_update['api_calls'].sum / updates.count:.1f}, "
+        f"обращений к базе {per_update['db_calls'].sum / updates.count:.1f}, "
+        f"SQL-запросов {per_update['sql_statements'].sum / updates.count:.1f}"
+    )
+    for title, name in (
+        ("⏱️ Обработчики (по суммарному времени)", 'bot_handler_seconds'),
+        ("🗄️ Методы базы", 'bot_db_call_seconds'),
+        ("📡 Запросы к Bot API", 'bot_api_seconds'),
+    ):
+        lines = top_timings(name)
+        if lines:
+            text += f"\n\n{title}:\n" + "\n".join(lines)
+    if METRICS_PORT:
+        text += f"\n\nВсе метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics"
+    update.message.reply_text(text)
+
+def register_metric_collectors(dispatcher):
+    """Текущие значения очередей для /metrics"""
+    def queues():
+        sending = outbox.stats()
+        for lane in ('reply', 'admin', 'bulk'):
+            yield 'bot_outbox_queued', 'Messages waiting in the outbox', {'lane': lane}, sending[f'queued_{lane}']
+        yield 'bot_outbox_in_flight', 'Messages being sent', {}, sending['in_flight']
+        executor = db.executor.stats()
+        yield 'bot_db_queue_depth', 'Database operations waiting for a worker', {'kind': 'write'}, executor['write_queue_depth']
+        yield 'bot_db_queue_depth', 'Database operations waiting for a worker', {'kind': 'read'}, executor['read_queue_depth']
+        yield 'bot_pending_writes', 'Changes buffered in memory', {'kind': 'carts'}, db.carts.pending()
+        yield 'bot_pending_writes', 'Changes buffered in memory', {'kind': 'conversations'}, persistence.pending()
+        if hasattr(dispatcher, 'scheduler'):
+            chats = dispatcher.scheduler.stats()
+            yield 'bot_chat_queues_active', 'Chats with updates in progress', {}, chats['active_chats']
+            yield 'bot_chat_queued_updates', 'Updates waiting in chat queues', {}, chats['queued']
+    metrics.collect(queues)
+
+def backup_job(context: CallbackContext):
+    """Снимок базы по расписанию или по команде /backup"""
+    chat_id = context.job.context
+    try:
+        path = db.backup(BACKUP_DIR)
+        removed = apply_retention(BACKUP_DIR, BACKUP_KEEP, BACKUP_MAX_AGE_DAYS)
+        if chat_id:
+            outbox.send_message(
+                chat_id,
+                f"💾 Резервная копия создана: {os.path.basename(path)}\n"
+                f"🧹 Удалено старых копий: {len(removed)}",
+                priority=PRIORITY_ADMIN
+            )
+    except Exception as e:
+        logger.error(f"Error creating database backup: {e}")
+        if chat_id:
+            outbox.send_message(chat_id, f"❌ Ошибка резервного копирования: {e}", priority=PRIORITY_ADMIN)
+
+def restore_job(context: CallbackContext):
+    """Восстановление базы из снимка (после страховочной копии текущего состояния)"""
+    chat_id, name = context.job.context
+    try:
+        safety_path = db.backup(BACKUP_DIR)
+        # Диалоги и user_data в памяти не должны перезаписать восстановленные
+        with persistence.replaced():
+            db.restore(BACKUP_DIR, name)
+        persistence.reload(context.dispatcher)
+        photos.reload()
+        outbox.send_message(
+            chat_id,
+            f"✅ База восстановлена из {name}\n"
+            f"💾 Состояние до восстановления: {os.path.basename(safety_path)}\n"
+            "🔄 Корзины, диалоги покупателей и кэш фото загружены из снимка",
+            priority=PRIORITY_ADMIN
+        )
+    except Exception as e:
+        logger.error(f"Error restoring database from {name}: {e}")
+        outbox.send_message(chat_id, f"❌ Ошибка восстановления: {e}", priority=PRIORITY_ADMIN)
+
+def backup_command(update: Update, context: CallbackContext):
+    """Команда /backup - снимок базы (только для админа)"""
+    user = update.message.from_user
+    
+    if user.id != ADMIN_ID:
+        update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    
+    update.message.reply_text("⏳ Создаю резервную копию...")
+    context.job_queue.run_once(backup_job, 0, context=update.message.chat_id)
+
+def restore_command(update: Update, context: CallbackContext):
+    """Команда /restore [имя] - список снимков или восстановление (только для админа)"""
+    user = update.message.from_user
+    
+    if user.id != ADMIN_ID:
+        update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    
+    backups = list_backups(BACKUP_DIR)
+    if not context.args:
+        if not backups:
+            update.message.reply_text("📭 Резервных копий пока нет")
+            return
+        text = "💾 *Резервные копии:*\n\n"
+        for i, name in enumerate(backups[:10], 1):
+            text += f"{i}. `{name}`\n"
+        text += "\nВосстановить: /restore <номер или имя>"
+        update.message.reply_text(text, parse_mode='Markdown')
+        return
+    
+    choice = context.args[0]
+    if choice.isdigit() and 1 <= int(choice) <= len(backups):
+        name = backups[int(choice) - 1]
+    elif choice in backups:
+        name = choice
+    else:
+        update.message.reply_text("❌ Резервная копия не найдена. Список: /restore")
+        return
+    
+    update.message.reply_text(f"⏳ Восстанавливаю базу из {name}...")
+    context.job_queue.run_once(restore_job, 0, context=(update.message.chat_id, name))
+
+def broadcast_command(update: Update, context: CallbackContext):
+    """Команда /broadcast [текст] - рассылка покупателям или её статус (только для админа)"""
+    user = update.message.from_user
+    
+    if user.id != ADMIN_ID:
+        update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    
+    # Текст берём целиком, с переносами строк
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        broadcasts = db.get_broadcasts()
+        if not broadcasts:
+            update.message.reply_text("📭 Рассылок ещё не было\n\nНовая рассылка: /broadcast <текст>")
+            return
+        status_text = "📣 Последние рассылки:\n\n"
+        for broadcast in broadcasts:
+            status_text += (
+                f"#{broadcast.id} ({broadcast.status}, {broadcast.created_at}): "
+                f"доставлено {broadcast.sent} из {broadcast.total}, ожидают {broadcast.pending}, "
+                f"заблокировали бота {broadcast.blocked}, ошибок {broadcast.failed}\n"
+            )
+        status_text += "\nОстановить: /broadcast_stop <номер>"
+        update.message.reply_text(status_text)
+        return
+    
+    broadcast = db.create_broadcast(text)
+    if broadcast is None:
+        update.message.reply_text("❌ Не удалось создать рассылку")
+        return
+    update.message.reply_text(
+        f"📣 Рассылка #{broadcast.id} запущена: {broadcast.total} получателей.\n"
+        "Статус: /broadcast"
+    )
+
+def broadcast_stop_command(update: Update, context: CallbackContext):
+    """Команда /broadcast_stop <номер> - остановить рассылку (только для админа)"""
+    user = update.message.from_user
+    
+    if user.id != ADMIN_ID:
+        update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    
+    if not context.args or not context.args[0].isdigit():
+        update.message.reply_text("Укажите номер рассылки: /broadcast_stop <номер>")
+        return
+    
+    if db.cancel_broadcast(int(context.args[0])):
+        update.message.reply_text(f"⏹ Рассылка #{context.args[0]} остановлена")
+    else:
+        update.message.reply_text("❌ Активная рассылка с таким номером не найдена")
+
+def broadcast_job(context: CallbackContext):
+    broadcaster.tick()
+
+def archive_orders_job(context: CallbackContext):
+    """Перенос старых завершённых и отменённых заказов в архив"""
+    db.archive_orders(ARCHIVE_AFTER_DAYS)
+
+def flush_persistence_job(context: CallbackContext):
+    persistence.flush()
+
+def flush_carts_job(context: CallbackContext):
+    """Периодический сброс корзин из памяти в базу"""
+    db.flush_carts()
+
 def handle_client_message(update, context):
     update.message.reply_text("Я получил твоё сообщение!")
 
 
-def main():
-    updater = Updater(BOT_TOKEN, use_context=True)
+def start_updates(updater: Updater):
+    """Запустить получение обновлений в режиме BOT_MODE"""
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            raise ValueError("Для BOT_MODE=webhook нужен WEBHOOK_URL")
+        url_path = WEBHOOK_PATH.strip('/')
+        # Угадываемый путь открыл бы обработчик любому, кто знает адрес бота
+        if len(url_path) < WEBHOOK_MIN_PATH:
+            raise ValueError(
+                f"Для BOT_MODE=webhook задайте WEBHOOK_SECRET "
+                f"(или WEBHOOK_PATH) - случайную строку от {WEBHOOK_MIN_PATH} символов"
+            )
+        updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=url_path,
+            cert=WEBHOOK_CERT,
+            key=WEBHOOK_KEY,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{url_path}",
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=DROP_PENDING_UPDATES
+        )
+        logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+    elif BOT_MODE == 'polling':
+        updater.start_polling(drop_pending_updates=DROP_PENDING_UPDATES)
+    else:
+        raise ValueError(f"Неизвестный BOT_MODE: {BOT_MODE}")
+
+# ==================== МАРШРУТЫ ====================
+
+# (состояние, кнопки или префиксы callback_data, обработчик, только для администратора)
+ROUTES = [
+    (MAIN_MENU, CATEGORIES, handle_category, False),
+    (MAIN_MENU, '👑 Админ-панель', admin_panel, True),
+    (MAIN_MENU, '⬅️ Назад в меню', handle_back_to_menu, False),
+    (CATEGORY_SELECTION, '⬅️ Назад в меню', handle_back_to_menu, False),
+    (PRODUCT_SELECTION, '⬅️ Назад в меню', handle_back_to_menu, False),
+    (QUANTITY_SELECTION, 'qty:', handle_quantity_callback, False),
+    (QUANTITY_SELECTION, 'cart:', handle_cart_callback, False),
+    (QUANTITY_SELECTION, '⬅️ Назад к товарам', handle_back_to_products, False),
+    (QUANTITY_SELECTION, '⬅️ Назад в меню', handle_back_to_menu, False),
+    (AWAIT_LOCATION, '❌ Отменить заказ', cancel, False),
+    (AWAIT_LOCATION, '⬅️ Назад к товарам', handle_back_to_products, False),
+    (ADMIN_PANEL, '⬅️ Главное меню', handle_admin_back_to_start, True),
+    (ADMIN_PANEL, '⬅️ Назад в админ-панель', admin_panel, True),
+    (ADMIN_PANEL, '📦 Активные заказы', show_active_orders, True),
+    (ADMIN_PANEL, '✅ Завершенные', show_completed_orders, True),
+    (ADMIN_PANEL, '❌ Отмененные', show_cancelled_orders, True),
+    (ADMIN_PANEL, '🔄 Обновить товары', ask_products_csv, True),
+    (ADMIN_PANEL, '🗑️ Управление товарами', products_menu, True),
+    (ADMIN_PANEL, '🗑️ Очистить все товары', ask_clear_products, True),
+    (ADMIN_PANEL, '📦 Заменить товары', ask_replace_products, True),
+    (ADMIN_PANEL, '📋 Показать товары', show_products_list, True),
+    (ADMIN_PANEL, '🖼️ Фото товаров', show_images_help, True),
+    (ADMIN_PANEL, ('✅ Да, очистить', '❌ Нет, отмена'), handle_clear_confirmation, True),
+    (ADMIN_PANEL, ('✅ Выполнить заказ', '❌ Отменить заказ', '❌ Вернуть в ожидание',
+                   '✅ Восстановить заказ', '⬅️ Назад к списку'), handle_order_details, True),
+    (ADMIN_PANEL, ('⬅️ Новые', 'Старые ➡️'), handle_orders_page, True),
+]
+
+# Текст без своей кнопки: (состояние, обработчик, только для администратора)
+FALLBACKS = [
+    (MAIN_MENU, handle_search_text, False),
+    (CATEGORY_SELECTION, show_category_products, False),
+    (PRODUCT_SELECTION, handle_product_selection, False),
+    (QUANTITY_SELECTION, handle_quantity_text, False),
+    (AWAIT_COMMENT, handle_comment, False),
+    (ADMIN_PANEL, handle_admin_text, True),
+]
+
+router = Router(is_admin=lambda user_id: user_id == ADMIN_ID, denied_text="❌ Доступ только для администратора.")
+for state, keys, callback, admin in ROUTES:
+    router.add(state, keys, callback, admin=admin)
+for state, callback, admin in FALLBACKS:
+    router.fallback(state, callback, admin=admin)
+
+def build_updater() -> Updater:
+    """Updater со всеми обработчиками и задачами; получение обновлений не запущено"""
+    # Обновления одного чата обрабатываются по порядку, разных чатов - параллельно
+    updater = create_updater(BOT_TOKEN, TELEGRAM_API_URL, BOT_WORKERS, CON_POOL_SIZE, persistence, outbox)
     dp = updater.dispatcher
     
     # Создаем основной conversation handler
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[CommandHandler('start', start), CommandHandler('search', search_command)],
         states={
-            MAIN_MENU: [
-                MessageHandler(Filters.text & ~Filters.command, handle_main_menu),
-            ],
-            CATEGORY_SELECTION: [
-                MessageHandler(Filters.regex('^⬅️ Назад в меню$'), handle_back_to_menu),
-                MessageHandler(Filters.text & ~Filters.command, show_category_products),
-            ],
-            PRODUCT_SELECTION: [
-                MessageHandler(Filters.regex('^⬅️ Назад в меню$'), handle_back_to_menu),
-                MessageHandler(Filters.text & ~Filters.command, handle_product_selection),
-            ],
-            QUANTITY_SELECTION: [
-                MessageHandler(Filters.regex('^(➖ Уменьшить|➕ Увеличить)$'), handle_quantity_change),
-                MessageHandler(Filters.regex('^(✅ Подтвердить|❌ Отменить заказ|🛒 Добавить к заказу)$'), handle_cart_action),
-                MessageHandler(Filters.regex('^⬅️ Назад к товарам$'), handle_back_to_products),
-                MessageHandler(Filters.regex('^⬅️ Назад в меню$'), handle_back_to_menu),
-            ],
+            MAIN_MENU: [router.handler(MAIN_MENU)],
+            CATEGORY_SELECTION: [router.handler(CATEGORY_SELECTION)],
+            PRODUCT_SELECTION: [router.handler(PRODUCT_SELECTION)],
+            QUANTITY_SELECTION: [router.handler(QUANTITY_SELECTION)],
             AWAIT_LOCATION: [
                 MessageHandler(Filters.location, handle_location),
-                MessageHandler(Filters.regex('^❌ Отменить заказ$'), cancel),
-                MessageHandler(Filters.regex('^⬅️ Назад к товарам$'), handle_back_to_products),
-            ],
-            AWAIT_COMMENT: [
-                MessageHandler(Filters.text & ~Filters.command, handle_comment),
+                router.handler(AWAIT_LOCATION),
             ],
+            AWAIT_COMMENT: [router.handler(AWAIT_COMMENT)],
             ADMIN_PANEL: [
-                MessageHandler(Filters.text & ~Filters.command, handle_admin_actions),
+                router.handler(ADMIN_PANEL),
                 MessageHandler(Filters.document.file_extension("csv"), handle_csv_file),
+                MessageHandler(
+                    Filters.photo | Filters.document.image | Filters.document.file_extension("zip"),
+                    handle_image_upload
+                ),
             ],
         },
         fallbacks=[
             CommandHandler('cancel', cancel), 
             CommandHandler('start', start),
+            CommandHandler('search', search_command),
             CommandHandler('stop', stop_bot)
         ],
-        allow_reentry=True
+        allow_reentry=True,
+        name='shop',
+        persistent=True
     )
     
     # Добавляем обработчики (важен порядок!)
@@ -1266,12 +1736,55 @@ def main():
     
     # Добавляем обработчик команды /admin
     dp.add_handler(CommandHandler('admin', admin_panel))
+    dp.add_handler(CommandHandler('dbstats', db_stats))
+    dp.add_handler(CommandHandler('stats', stats_command))
+    dp.add_handler(CommandHandler('backup', backup_command))
+    dp.add_handler(CommandHandler('restore', restore_command))
+    dp.add_handler(CommandHandler('broadcast', broadcast_command))
+    dp.add_handler(CommandHandler('broadcast_stop', broadcast_stop_command))
+    
+    # Поиск товаров из любого чата: @бот название
+    dp.add_handler(InlineQueryHandler(inline_query))
     
     # Обработчик ошибок
     dp.add_error_handler(error_handler)
     
+    # Задачи по расписанию тоже попадают в метрики обработчиков
+    timed_job = metrics.timed('bot_handler_seconds', 'bot_handler_errors_total')
+    
+    # Корзины копятся в памяти и пишутся в базу одной транзакцией
+    updater.job_queue.run_repeating(timed_job(flush_carts_job), interval=CART_FLUSH_INTERVAL, first=CART_FLUSH_INTERVAL)
+    
+    # Изменённые диалоги и user_data пишутся в базу пачкой
+    updater.job_queue.run_repeating(
+        timed_job(flush_persistence_job), interval=PERSISTENCE_FLUSH_INTERVAL, first=PERSISTENCE_FLUSH_INTERVAL
+    )
+    
+    # Рассылки: следующая пачка получателей, когда доставлена предыдущая
+    updater.job_queue.run_repeating(timed_job(broadcast_job), interval=BROADCAST_INTERVAL, first=BROADCAST_INTERVAL)
+    
+    # Ежедневная резервная копия базы
+    updater.job_queue.run_daily(timed_job(backup_job), time=dt_time(hour=BACKUP_HOUR), context=None)
+    
+    # Старые заказы уходят в архив небольшими транзакциями
+    updater.job_queue.run_repeating(timed_job(archive_orders_job), interval=ARCHIVE_INTERVAL, first=60)
+    
+    # Время и ошибки всех обработчиков и задач; /metrics только на локальном адресе
+    instrument_handlers(dp)
+    register_metric_collectors(dp)
+    return updater
+
+def main():
+    updater = build_updater()
+    metrics_server = None
+    if METRICS_PORT:
+        try:
+            metrics_server = metrics.serve(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Error starting metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+    
     # Запускаем бота
-    logger.info("Бот запущен...")
+    logger.info(f"Бот запущен ({BOT_MODE}, workers={BOT_WORKERS})...")
     print(f"🤖 Бот запущен с токеном: {BOT_TOKEN}")
     print(f"👑 Админ ID: {ADMIN_ID}")
     print("⏳ Ожидание сообщений...")
@@ -1279,11 +1792,19 @@ def main():
     print("📦 Админ-панель: Управление заказами и товарами")
 
     try:
-        updater.start_polling(drop_pending_updates=True)
+        start_updates(updater)
         updater.idle()
     except Exception as e:
         print(f"❌ Ошибка запуска: {e}")
         return
+    finally:
+        # Дообрабатываем фото, досылаем очередь, дописываем несохранённые диалоги и корзины перед выходом
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        images.close()
+        outbox.close()
+        persistence.flush()
+        db.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
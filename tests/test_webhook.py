@@ -0,0 +1,160 @@
+"""Режим webhook: обновление с секретного пути доходит до обработчиков,
+ответ бота уходит в Bot API (здесь - заглушка по TELEGRAM_API_URL)."""
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = 'k3J9xQw7Lp2Zt8Vb5Nm4'
+USER_ID = 42
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class StubBotAPI(BaseHTTPRequestHandler):
+    """Отвечает ok на любой метод и запоминает вызовы (метод, параметры)"""
+    calls = []
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        try:
+            params = json.loads(body or b'{}')
+        except ValueError:
+            params = {}
+        self.calls.append((method, params))
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Shop', 'username': 'shop_bot'}
+        elif method == 'sendMessage':
+            result = {
+                'message_id': len(self.calls),
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id'), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        data = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.api = ThreadingHTTPServer(('127.0.0.1', 0), StubBotAPI)
+        threading.Thread(target=cls.api.serve_forever, daemon=True).start()
+        cls.port = free_port()
+
+        # Конфиг читается при импорте, пути в нём относительные - работаем во временном каталоге
+        cls.env = dict(os.environ)
+        os.environ.update({
+            'BOT_TOKEN': '123:test',
+            'ADMIN_ID': '1',
+            'BOT_MODE': 'webhook',
+            'WEBHOOK_LISTEN': '127.0.0.1',
+            'WEBHOOK_PORT': str(cls.port),
+            'WEBHOOK_URL': 'https://bot.example.com',
+            'WEBHOOK_SECRET': SECRET,
+            'TELEGRAM_API_URL': f"http://127.0.0.1:{cls.api.server_port}/bot",
+            'IMAGE_WORKERS': '0',
+            'METRICS_PORT': '0',
+        })
+        os.environ.pop('WEBHOOK_PATH', None)
+        cls.cwd = os.getcwd()
+        cls.tmp = tempfile.mkdtemp()
+        for path in ('data', 'logs', 'csv_files', 'images/products'):
+            os.makedirs(os.path.join(cls.tmp, path))
+        os.chdir(cls.tmp)
+        sys.path.insert(0, ROOT)
+
+        import main
+        cls.main = main
+        cls.updater = main.build_updater()
+        main.start_updates(cls.updater)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.updater.stop()
+        cls.main.images.close()
+        cls.main.outbox.close()
+        cls.main.persistence.flush()
+        cls.main.db.close()
+        cls.api.shutdown()
+        os.chdir(cls.cwd)
+        sys.path.remove(ROOT)
+        os.environ.clear()
+        os.environ.update(cls.env)
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def post(self, path: str, update: dict) -> int:
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{self.port}/{path}",
+            data=json.dumps(update).encode(),
+            headers={'Content-Type': 'application/json'},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def start_update(self, update_id: int) -> dict:
+        user = {'id': USER_ID, 'is_bot': False, 'first_name': 'Test'}
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': USER_ID, 'type': 'private', 'first_name': 'Test'},
+                'from': user,
+                'text': '/start',
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+            },
+        }
+
+    def sent_messages(self) -> list:
+        return [params for method, params in StubBotAPI.calls if method == 'sendMessage']
+
+    def test_webhook_registered_with_secret_path(self):
+        urls = [params.get('url') for method, params in StubBotAPI.calls if method == 'setWebhook']
+        self.assertEqual(urls, [f"https://bot.example.com/{SECRET}"])
+
+    def test_update_reaches_handlers(self):
+        self.assertEqual(self.post(SECRET, self.start_update(1)), 200)
+        deadline = time.monotonic() + 10
+        while not self.sent_messages() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        messages = self.sent_messages()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(str(messages[0]['chat_id']), str(USER_ID))
+
+    def test_wrong_path_not_found(self):
+        sent = len(self.sent_messages())
+        self.assertEqual(self.post('webhook', self.start_update(2)), 404)
+        self.assertEqual(self.post(SECRET[:-1], self.start_update(3)), 404)
+        time.sleep(0.5)
+        self.assertEqual(len(self.sent_messages()), sent)
+
+
+if __name__ == '__main__':
+    unittest.main()
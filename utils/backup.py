@@ -0,0 +1,126 @@
+import os
+import gzip
+import shutil
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+# Сколько страниц копируется за шаг и пауза между шагами:
+# между шагами писатель базы не блокируется
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.01
+
+BACKUP_PREFIX = 'vape_shop_'
+BACKUP_SUFFIX = '.db.gz'
+
+class BackupError(Exception):
+    """Снимок повреждён или не найден"""
+
+def check_integrity(db_path: str):
+    conn = sqlite3.connect(db_path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+    if result != 'ok':
+        raise BackupError(f"integrity_check failed for {db_path}: {result}")
+
+def create_backup(db_path: str, backup_dir: str) -> str:
+    """Сделать сжатый снимок базы на ходу, вернуть путь к файлу.
+
+    Копирование идёт через sqlite3 backup API порциями по
+    BACKUP_PAGES_PER_STEP страниц из read-only соединения, которое держит
+    открытую транзакцию чтения: в режиме WAL это согласованный снимок,
+    копирование не перезапускается из-за новых записей и не мешает им.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    name = f"{BACKUP_PREFIX}{timestamp}"
+    tmp_path = os.path.join(backup_dir, f".{name}.db")
+    final_path = os.path.join(backup_dir, name + BACKUP_SUFFIX)
+
+    src = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True, isolation_level=None)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP)
+        src.execute("COMMIT")
+        # Снимок - обычный файл без WAL
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+
+    try:
+        check_integrity(tmp_path)
+        with open(tmp_path, 'rb') as raw, gzip.open(final_path + '.part', 'wb') as packed:
+            shutil.copyfileobj(raw, packed)
+        os.replace(final_path + '.part', final_path)
+    finally:
+        for path in (tmp_path, final_path + '.part'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    logger.info(f"Database backup created: {final_path} ({os.path.getsize(final_path)} bytes)")
+    return final_path
+
+def list_backups(backup_dir: str) -> List[str]:
+    """Имена снимков, новые первыми"""
+    if not os.path.isdir(backup_dir):
+        return []
+    names = [
+        name for name in os.listdir(backup_dir)
+        if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX)
+    ]
+    return sorted(names, reverse=True)
+
+def apply_retention(backup_dir: str, keep: int, max_age_days: int) -> List[str]:
+    """Удалить снимки сверх keep последних и старше max_age_days; вернуть удалённые.
+
+    Возраст считается по времени в имени файла, а не по mtime.
+    """
+    removed = []
+    border = datetime.now() - timedelta(days=max_age_days)
+    for index, name in enumerate(list_backups(backup_dir)):
+        try:
+            created = datetime.strptime(name[len(BACKUP_PREFIX):-len(BACKUP_SUFFIX)], "%Y%m%d_%H%M%S")
+        except ValueError:
+            continue
+        # Самый свежий снимок не удаляем никогда
+        if index > 0 and (index >= keep or created < border):
+            os.remove(os.path.join(backup_dir, name))
+            removed.append(name)
+    if removed:
+        logger.info(f"Old backups removed: {removed}")
+    return removed
+
+def unpack_backup(backup_dir: str, name: str) -> str:
+    """Распаковать снимок во временный файл и проверить его; вернуть путь"""
+    if os.path.basename(name) != name or name not in list_backups(backup_dir):
+        raise BackupError(f"Backup {name} not found")
+
+    tmp_path = os.path.join(backup_dir, f".restore_{name[:-len('.gz')]}")
+    with gzip.open(os.path.join(backup_dir, name), 'rb') as packed, open(tmp_path, 'wb') as raw:
+        shutil.copyfileobj(packed, raw)
+    try:
+        check_integrity(tmp_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+def restore_into(snapshot_path: str, conn: sqlite3.Connection):
+    """Скопировать снимок в открытую базу через backup API (conn - соединение писателя).
+
+    Копирование идёт одним шагом: читатели до конца видят старые данные,
+    а затем сразу новые.
+    """
+    src = sqlite3.connect(snapshot_path)
+    try:
+        src.backup(conn)
+    finally:
+        src.close()
@@ -0,0 +1,94 @@
+import logging
+import threading
+from concurrent.futures import Future
+from typing import List, Optional
+
+from telegram.error import BadRequest, Unauthorized
+
+from config import BROADCAST_BATCH
+from utils.outbox import Outbox, PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+class Broadcaster:
+    """Фоновая рассылка пачками через очередь отправки.
+
+    tick() вызывается периодической задачей: берёт из базы следующую пачку
+    ожидающих получателей и ставит сообщения в полосу рассылок Outbox -
+    ответы покупателям и уведомления админу уходят раньше, общий лимит
+    Telegram соблюдает Outbox. Следующая пачка берётся, только когда
+    предыдущая доставлена и её статусы записаны, поэтому после перезапуска
+    рассылка продолжается с ожидающих получателей (последняя недописанная
+    пачка может уйти повторно).
+    """
+
+    def __init__(self, db, outbox: Outbox, batch_size: int = BROADCAST_BATCH):
+        self._db = db
+        self._outbox = outbox
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._busy = False
+        self._results: List[tuple] = []
+        self._waiting = 0
+        self._broadcast_id: Optional[int] = None
+
+    def tick(self):
+        with self._lock:
+            if self._busy:
+                return
+            self._busy = True
+
+        try:
+            batch = self._db.next_broadcast_batch(self._batch_size)
+        except Exception as e:
+            logger.error(f"Error reading broadcast batch: {e}")
+            batch = None
+        if batch is None:
+            with self._lock:
+                self._busy = False
+            return
+
+        broadcast_id, text, user_ids = batch
+        with self._lock:
+            self._broadcast_id = broadcast_id
+            self._results = []
+            self._waiting = len(user_ids)
+        for i, user_id in enumerate(user_ids):
+            try:
+                future = self._outbox.send_message(user_id, text, priority=PRIORITY_BULK)
+            except Exception as e:
+                # Например, Outbox уже закрыт: оставшиеся получатели - неудачные,
+                # иначе пачка никогда не завершится и рассылки остановятся
+                logger.error(f"Error queueing broadcast #{broadcast_id}: {e}")
+                for unsent in user_ids[i:]:
+                    self._finish((unsent, 'failed', str(e)))
+                return
+            future.add_done_callback(lambda f, user_id=user_id: self._delivered(user_id, f))
+
+    def _delivered(self, user_id: int, future: Future):
+        error = future.exception()
+        if error is None:
+            self._finish((user_id, 'sent', None))
+        elif isinstance(error, Unauthorized) or (
+                isinstance(error, BadRequest) and 'chat not found' in str(error).lower()):
+            # Бот заблокирован, аккаунт удалён или чат недоступен
+            self._finish((user_id, 'blocked', str(error)))
+        else:
+            self._finish((user_id, 'failed', str(error)))
+
+    def _finish(self, result: tuple):
+        """Учесть результат получателя; последний в пачке записывает статусы"""
+        with self._lock:
+            self._results.append(result)
+            self._waiting -= 1
+            if self._waiting:
+                return
+            broadcast_id, results = self._broadcast_id, self._results
+
+        try:
+            self._db.record_broadcast_results(broadcast_id, results)
+        except Exception as e:
+            logger.error(f"Error saving broadcast #{broadcast_id} results: {e}")
+        finally:
+            with self._lock:
+                self._busy = False
@@ -0,0 +1,183 @@
+import os
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class CartStore:
+    """Корзины в памяти с отложенной записью в базу.
+
+    Каждое изменение корзины сразу попадает в словарь в памяти и одной
+    строкой дописывается в журнал (без fsync), а в SQLite уходит пачкой при
+    flush(): много нажатий разных пользователей - одна транзакция. При
+    старте журнал проигрывается заново, поэтому падение процесса между
+    сбросами не теряет корзины. В памяти держатся только корзины, ещё не
+    записанные в базу: после сброса они читаются из базы.
+
+    load(user_id) - прочитать корзину из базы (None, если её нет);
+    persist({user_id: cart или None}) - записать пачку одной транзакцией,
+    None означает удаление корзины.
+    """
+
+    def __init__(self, load: Callable[[int], Optional[Dict]],
+                 persist: Callable[[Dict[int, Optional[Dict]]], None],
+                 journal_path: Optional[str] = None):
+        self._load = load
+        self._persist = persist
+        self._journal_path = journal_path
+        self._lock = threading.Lock()
+        # Сериализует сбросы, чтобы пачки не обгоняли друг друга
+        self._flush_lock = threading.Lock()
+        self._carts: Dict[int, Optional[Dict]] = {}
+        self._dirty = set()
+        self._journal = None
+
+        if journal_path:
+            self._recover()
+            self._journal = open(journal_path, 'a', encoding='utf-8')
+
+    # ==================== ЖУРНАЛ ====================
+
+    def _recover(self):
+        """Проиграть журналы, оставшиеся после прошлого запуска"""
+        entries = {}
+        for path in (self._journal_path + '.flushing', self._journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Недописанная последняя строка при падении
+                        continue
+                    entries[int(record['u'])] = record['c']
+
+        if entries:
+            self._persist(entries)
+            logger.info(f"Cart journal replayed: {len(entries)} carts restored")
+
+        for path in (self._journal_path + '.flushing', self._journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _append(self, user_id: int, cart: Optional[Dict]):
+        if self._journal is not None:
+            self._journal.write(json.dumps({'u': user_id, 'c': cart}, ensure_ascii=False) + '\n')
+            self._journal.flush()
+
+    def _rotate(self):
+        flushing = self._journal_path + '.flushing'
+        self._journal.close()
+        if os.path.exists(flushing):
+            # Прошлый сброс не удался - дописываем текущий журнал к его журналу
+            with open(self._journal_path, encoding='utf-8') as src, \
+                    open(flushing, 'a', encoding='utf-8') as dst:
+                dst.write(src.read())
+            os.remove(self._journal_path)
+        else:
+            os.replace(self._journal_path, flushing)
+        self._journal = open(self._journal_path, 'a', encoding='utf-8')
+
+    # ==================== КОРЗИНЫ ====================
+
+    def get(self, user_id: int) -> Dict:
+        with self._lock:
+            if user_id in self._carts:
+                cart = self._carts[user_id]
+                return dict(cart) if cart else {}
+
+        # Прочитанное из базы не кэшируем: к этому времени корзину могли
+        # изменить и сбросить, а устаревшая копия осталась бы в памяти
+        cart = self._load(user_id)
+        return dict(cart) if cart else {}
+
+    def put(self, user_id: int, cart: Dict):
+        with self._lock:
+            self._carts[user_id] = dict(cart)
+            self._dirty.add(user_id)
+            self._append(user_id, cart)
+
+    def forget(self, user_id: int):
+        """Удалить корзину: в базу удаление уходит со сбросом, как и изменения.
+
+        Идущий в это время сброс со старой корзиной пишется раньше удаления,
+        поэтому не вернёт её.
+        """
+        with self._lock:
+            self._carts[user_id] = None
+            self._dirty.add(user_id)
+            self._append(user_id, None)
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def flush(self, user_id: Optional[int] = None):
+        """Записать изменённые корзины в базу.
+
+        С user_id - синхронно только корзину этого пользователя
+        (перед оформлением заказа), иначе - все накопленные изменения.
+        """
+        with self._flush_lock:
+            rotated = False
+            with self._lock:
+                if user_id is not None:
+                    if user_id not in self._dirty:
+                        return
+                    users = [user_id]
+                else:
+                    users = list(self._dirty)
+                    if not users:
+                        return
+                    # Новые изменения пишем в свежий журнал, старый удалим после коммита
+                    if self._journal is not None:
+                        self._rotate()
+                        rotated = True
+                batch = {uid: self._carts.get(uid) for uid in users}
+                self._dirty.difference_update(users)
+
+            try:
+                self._persist(batch)
+            except Exception:
+                with self._lock:
+                    # Повторим при следующем сбросе; журнал .flushing остаётся на диске
+                    self._dirty.update(batch)
+                raise
+
+            with self._lock:
+                # Записанные и с тех пор не менявшиеся корзины больше не держим в памяти
+                for uid in batch:
+                    if uid not in self._dirty:
+                        self._carts.pop(uid, None)
+
+            if rotated:
+                os.remove(self._journal_path + '.flushing')
+
+    @contextmanager
+    def replaced(self):
+        """Сбросы приостановлены, пока база заменяется (восстановление из снимка).
+
+        После замены корзины в памяти и журнал отбрасываются: они относятся
+        к прежней базе, корзины снова читаются из восстановленной.
+        """
+        with self._flush_lock:
+            yield
+            with self._lock:
+                self._carts.clear()
+                self._dirty.clear()
+                if self._journal is not None:
+                    self._journal.close()
+                    for path in (self._journal_path + '.flushing', self._journal_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+                    self._journal = open(self._journal_path, 'a', encoding='utf-8')
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,75 @@
+import logging
+import threading
+from typing import Callable, Iterable, List, Optional
+
+from utils.models import Product
+
+logger = logging.getLogger(__name__)
+
+class CatalogSnapshot:
+    """Неизменяемый снимок каталога с индексами по имени и категории"""
+
+    __slots__ = ('version', 'products', 'by_name', 'by_category')
+
+    def __init__(self, version: int, products: Iterable[Product]):
+        self.version = version
+        # Порядок как в SQL: ORDER BY category, name
+        self.products = tuple(sorted(products, key=lambda p: (p.category, p.name)))
+        self.by_name = {p.name: p for p in self.products}
+
+        by_category = {}
+        for product in self.products:
+            if product.quantity > 0:
+                by_category.setdefault(product.category, []).append(product)
+        self.by_category = {category: tuple(items) for category, items in by_category.items()}
+
+class CatalogCache:
+    """Кэш каталога товаров на весь процесс.
+
+    Каталог меняется только при импорте CSV, очистке и списании остатков,
+    поэтому вместо запроса на каждое нажатие держим в памяти снимок.
+    Любое изменение товаров увеличивает счётчик версии через invalidate(),
+    следующее чтение перечитывает таблицу одним запросом. Снимок
+    подменяется целиком, поэтому потоки всегда видят согласованные данные.
+    Записи Product неизменяемы и общие для всех потоков и сессий.
+    """
+
+    def __init__(self, loader: Callable[[], List[Product]]):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._version = 0
+        self._snapshot: Optional[CatalogSnapshot] = None
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self):
+        """Отметить каталог как изменённый"""
+        with self._lock:
+            self._version += 1
+
+    def snapshot(self) -> CatalogSnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self._version:
+            return snapshot
+
+        with self._lock:
+            # Другой поток мог уже перечитать каталог, пока мы ждали
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.version == self._version:
+                return snapshot
+
+            snapshot = CatalogSnapshot(self._version, self._loader())
+            self._snapshot = snapshot
+            logger.info(f"Catalog cache loaded: {len(snapshot.products)} products, version {snapshot.version}")
+            return snapshot
+
+    def get_all(self) -> List[Product]:
+        return list(self.snapshot().products)
+
+    def get_by_category(self, category: str) -> List[Product]:
+        return list(self.snapshot().by_category.get(category, ()))
+
+    def get(self, name: str) -> Optional[Product]:
+        return self.snapshot().by_name.get(name)
@@ -0,0 +1,163 @@
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Event
+from typing import Any, Callable, Deque, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BasePersistence, Dispatcher, JobQueue, Updater, ExtBot
+from telegram.utils.request import Request
+
+from utils.metrics import metrics
+from utils.outbox import Outbox, QueuedBot
+
+logger = logging.getLogger(__name__)
+
+# Ожидание обновления в очереди чата дольше этого значения попадает в лог
+SLOW_WAIT_SECONDS = 1.0
+
+# Сколько самых длинных очередей показывать в статистике
+BUSIEST_CHATS = 5
+
+class ChatScheduler:
+    """Планировщик задач с порядком внутри ключа (чата).
+
+    У каждого ключа своя очередь: задачи одного чата выполняются строго по
+    очереди, разные чаты - параллельно на пуле из workers потоков. После
+    каждой задачи чат заново встаёт в очередь пула, поэтому один активный
+    пользователь не занимает поток целиком.
+    """
+
+    def __init__(self, workers: int):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-worker')
+        self._lock = threading.Lock()
+        self._queues: Dict[Hashable, Deque[tuple]] = {}
+        self._stats = {
+            'processed': 0,
+            'errors': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+        }
+
+    def submit(self, key: Hashable, fn: Callable[..., Any], *args):
+        with self._lock:
+            chat_queue = self._queues.get(key)
+            start = chat_queue is None
+            if start:
+                chat_queue = self._queues[key] = deque()
+            chat_queue.append((fn, args, time.monotonic()))
+        if start:
+            self._pool.submit(self._run_next, key)
+
+    def _run_next(self, key: Hashable):
+        with self._lock:
+            fn, args, enqueued = self._queues[key][0]
+
+        waited = time.monotonic() - enqueued
+        try:
+            fn(*args)
+            failed = False
+        except Exception as e:
+            logger.error(f"Chat {key} task failed: {e}")
+            failed = True
+
+        with self._lock:
+            chat_queue = self._queues[key]
+            chat_queue.popleft()
+            if chat_queue:
+                self._pool.submit(self._run_next, key)
+            else:
+                del self._queues[key]
+            self._stats['processed'] += 1
+            self._stats['errors'] += failed
+            self._stats['wait_total'] += waited
+            if waited > self._stats['wait_max']:
+                self._stats['wait_max'] = waited
+
+        if waited > SLOW_WAIT_SECONDS:
+            logger.warning(f"Update for chat {key} waited {waited:.3f}s in queue")
+
+    def stats(self) -> Dict[str, Any]:
+        """Очереди чатов: активные чаты, длина очередей, ожидание"""
+        with self._lock:
+            stats = dict(self._stats)
+            lengths = {key: len(chat_queue) for key, chat_queue in self._queues.items()}
+        stats['active_chats'] = len(lengths)
+        stats['queued'] = sum(lengths.values())
+        stats['max_chat_queue'] = max(lengths.values(), default=0)
+        stats['busiest'] = sorted(lengths.items(), key=lambda item: -item[1])[:BUSIEST_CHATS]
+        stats['wait_avg'] = stats['wait_total'] / stats['processed'] if stats['processed'] else 0.0
+        return stats
+
+    def close(self):
+        """Дождаться выполнения всех очередей"""
+        while True:
+            with self._lock:
+                if not self._queues:
+                    break
+            time.sleep(0.05)
+        self._pool.shutdown(wait=True)
+
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher, который обрабатывает обновления через ChatScheduler.
+
+    Обычный Dispatcher PTB 13 выполняет обработчики по одному в своём
+    потоке. Здесь обновления одного чата идут строго по порядку (нет гонок
+    на user_data и корзине), а разные пользователи - параллельно.
+    """
+
+    def __init__(self, *args, chat_workers: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = ChatScheduler(chat_workers)
+
+    def process_update(self, update: object) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            # Ошибки опроса и обновления без чата и пользователя
+            return super().process_update(update)
+        self.scheduler.submit(key, self._process_measured, update)
+
+    def _process_measured(self, update: Update):
+        # Время обновления и число обращений к Bot API и базе в нём
+        with metrics.update_scope():
+            super().process_update(update)
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    def stop(self) -> None:
+        super().stop()
+        self.scheduler.close()
+
+def create_updater(token: str, base_url: Optional[str], chat_workers: int, con_pool_size: int,
+                   persistence: Optional[BasePersistence] = None, outbox: Optional[Outbox] = None) -> Updater:
+    """Updater с OrderedDispatcher; остальное как в Updater(token, ...).
+
+    С outbox бот - QueuedBot: все отправки идут через очередь с лимитами.
+    """
+    request = Request(con_pool_size=con_pool_size)
+    if outbox is not None:
+        bot = QueuedBot(token, base_url=base_url, request=request, outbox=outbox)
+    else:
+        bot = ExtBot(token, base_url=base_url, request=request)
+    job_queue = JobQueue()
+    dispatcher = OrderedDispatcher(
+        bot,
+        Queue(),
+        job_queue=job_queue,
+        exception_event=Event(),
+        persistence=persistence,
+        chat_workers=chat_workers
+    )
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
@@ -0,0 +1,111 @@
+import csv
+import logging
+from typing import Iterable, Iterator, List, Set, TextIO, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк CSV вставляется одним executemany
+IMPORT_BATCH_SIZE = 500
+
+# Сколько ошибок показывать администратору в одном сообщении
+MAX_REPORTED_ERRORS = 20
+
+REQUIRED_FIELDS = ('category', 'name', 'cost', 'quantity')
+
+class ImportReport:
+    """Отчёт об импорте CSV: принятые строки и ошибки по строкам"""
+
+    def __init__(self):
+        self.accepted = 0
+        self.errors: List[Tuple[int, str, str]] = []
+        # Товары из строк с ошибками: их нельзя удалять из каталога
+        self.skipped_names: Set[str] = set()
+
+    def add_error(self, line: int, field: str, reason: str):
+        self.errors.append((line, field, reason))
+
+    def format(self) -> str:
+        text = f"📄 Принято строк: {self.accepted}\n"
+        if not self.errors:
+            return text + "✅ Ошибок нет"
+
+        text += f"⚠️ Ошибок: {len(self.errors)}\n"
+        for line, field, reason in self.errors[:MAX_REPORTED_ERRORS]:
+            text += f"• строка {line}, {field}: {reason}\n"
+        if len(self.errors) > MAX_REPORTED_ERRORS:
+            text += f"... и ещё {len(self.errors) - MAX_REPORTED_ERRORS}"
+        return text
+
+def iter_product_rows(source: TextIO, report: ImportReport) -> Iterator[tuple]:
+    """Лениво читать и проверять строки CSV.
+
+    Отдаёт кортежи (category, name, cost, quantity, image_path, description)
+    только для корректных строк; ошибки складываются в report. Файл читается
+    построчно, поэтому память не зависит от размера прайса.
+    """
+    reader = csv.DictReader(source)
+    header = [field.strip() for field in (reader.fieldnames or [])]
+    reader.fieldnames = header
+    missing = [field for field in REQUIRED_FIELDS if field not in header]
+    if missing:
+        report.add_error(1, ', '.join(missing), "нет обязательных колонок")
+        return
+
+    seen = set()
+    for row in reader:
+        line = reader.line_num
+        name = (row.get('name') or '').strip()
+        category = (row.get('category') or '').strip()
+        valid = True
+
+        if not name:
+            report.add_error(line, 'name', "пустое название")
+            continue
+        if name in seen:
+            report.add_error(line, 'name', f"товар '{name}' уже был выше, строка пропущена")
+            continue
+        seen.add(name)
+
+        if not category:
+            report.add_error(line, 'category', "пустая категория")
+            valid = False
+
+        try:
+            cost = float((row.get('cost') or '').replace(',', '.'))
+            if cost < 0:
+                raise ValueError
+        except ValueError:
+            report.add_error(line, 'cost', f"некорректная цена '{row.get('cost')}'")
+            valid = False
+
+        try:
+            quantity = int(row.get('quantity') or '')
+            if quantity < 0:
+                raise ValueError
+        except ValueError:
+            report.add_error(line, 'quantity', f"некорректное количество '{row.get('quantity')}'")
+            valid = False
+
+        if not valid:
+            report.skipped_names.add(name)
+            continue
+
+        report.accepted += 1
+        yield (
+            category,
+            name,
+            cost,
+            quantity,
+            (row.get('image_path') or '').strip(),
+            (row.get('description') or '').strip()
+        )
+
+def iter_batches(rows: Iterable[tuple], size: int = IMPORT_BATCH_SIZE) -> Iterator[List[tuple]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
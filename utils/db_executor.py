@@ -0,0 +1,236 @@
+import time
+import queue
+import logging
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько операций записи объединяется в одну транзакцию
+MAX_WRITE_BATCH = 64
+
+# Ожидание в очереди дольше этого значения попадает в лог
+SLOW_WAIT_SECONDS = 0.5
+
+_STOP = object()
+
+class _WriteOp:
+    __slots__ = ('fn', 'future', 'enqueued', 'transaction')
+
+    def __init__(self, fn: Callable[[sqlite3.Connection], Any], transaction: bool):
+        self.fn = fn
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.transaction = transaction
+
+class DBExecutor:
+    """Исполнитель запросов к SQLite.
+
+    Все записи выполняет один поток-писатель, владеющий соединением на
+    запись: он забирает из очереди до MAX_WRITE_BATCH операций и выполняет
+    их одной транзакцией (group commit), каждую - в своём SAVEPOINT, так что
+    ошибка одной операции не откатывает соседние. Чтения выполняет
+    небольшой пул потоков, у каждого своё read-only соединение.
+    Результаты возвращаются через concurrent.futures.Future.
+    """
+
+    def __init__(self, connect_writer: Callable[[], sqlite3.Connection],
+                 connect_reader: Optional[Callable[[], sqlite3.Connection]], readers: int = 4):
+        self._writer_conn = connect_writer()
+        self._connect_reader = connect_reader
+        self._queue: "queue.Queue" = queue.Queue()
+        self._local = threading.local()
+        self._reader_conns: List[sqlite3.Connection] = []
+        self._reader_conns_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'write_ops': 0,
+            'write_batches': 0,
+            'write_errors': 0,
+            'write_wait_total': 0.0,
+            'write_wait_max': 0.0,
+            'read_ops': 0,
+            'read_wait_total': 0.0,
+            'read_wait_max': 0.0,
+        }
+
+        self._writer = threading.Thread(target=self._writer_loop, name='db-writer', daemon=True)
+        self._writer.start()
+
+        # Без отдельных читателей (база в памяти) чтения идут через писателя
+        self._readers = None
+        if connect_reader is not None:
+            self._readers = ThreadPoolExecutor(
+                max_workers=readers,
+                thread_name_prefix='db-reader',
+                initializer=self._init_reader
+            )
+
+    # ==================== ЗАПИСЬ ====================
+
+    def submit_write(self, fn: Callable[[sqlite3.Connection], Any], transaction: bool = True) -> Future:
+        """Поставить fn(conn) в очередь писателя.
+
+        transaction=False - выполнить вне транзакции и отдельно от пачки
+        (для операций, которые сами управляют соединением, например backup).
+        """
+        op = _WriteOp(fn, transaction)
+        self._queue.put(op)
+        return op.future
+
+    def write(self, fn: Callable[[sqlite3.Connection], Any], transaction: bool = True) -> Any:
+        if threading.current_thread() is self._writer:
+            # Вложенный вызов из операции писателя - уже внутри транзакции
+            return fn(self._writer_conn)
+        return self.submit_write(fn, transaction).result()
+
+    def _writer_loop(self):
+        while True:
+            op = self._queue.get()
+            if op is _STOP:
+                break
+
+            if not op.transaction:
+                self._run_alone(op)
+                continue
+
+            batch = [op]
+            stop = False
+            deferred = None
+            while len(batch) < MAX_WRITE_BATCH:
+                try:
+                    next_op = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if next_op is _STOP:
+                    stop = True
+                    break
+                if not next_op.transaction:
+                    deferred = next_op
+                    break
+                batch.append(next_op)
+
+            self._run_batch(batch)
+            if deferred is not None:
+                self._run_alone(deferred)
+            if stop:
+                break
+
+        self._writer_conn.close()
+
+    def _record_wait(self, kind: str, waited: float, count: int = 1):
+        with self._stats_lock:
+            self._stats[f'{kind}_ops'] += count
+            self._stats[f'{kind}_wait_total'] += waited
+            if waited > self._stats[f'{kind}_wait_max']:
+                self._stats[f'{kind}_wait_max'] = waited
+        if waited > SLOW_WAIT_SECONDS:
+            logger.warning(f"DB {kind} waited {waited:.3f}s in queue (depth {self.queue_depth()})")
+
+    def _run_alone(self, op: _WriteOp):
+        self._record_wait('write', time.monotonic() - op.enqueued)
+        try:
+            op.future.set_result(op.fn(self._writer_conn))
+        except Exception as e:
+            with self._stats_lock:
+                self._stats['write_errors'] += 1
+            op.future.set_exception(e)
+
+    def _run_batch(self, batch: List[_WriteOp]):
+        conn = self._writer_conn
+        started = time.monotonic()
+        for op in batch:
+            self._record_wait('write', started - op.enqueued)
+
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for op in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    result = op.fn(conn)
+                    conn.execute("RELEASE op")
+                    outcomes.append((True, result))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    outcomes.append((False, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            # Не удалось закоммитить пачку - ошибка у всех операций
+            logger.error(f"DB write batch of {len(batch)} failed: {e}")
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            outcomes = [(False, e)] * len(batch)
+
+        with self._stats_lock:
+            self._stats['write_batches'] += 1
+            self._stats['write_errors'] += sum(1 for ok, _ in outcomes if not ok)
+
+        for op, (ok, value) in zip(batch, outcomes):
+            if ok:
+                op.future.set_result(value)
+            else:
+                op.future.set_exception(value)
+
+    # ==================== ЧТЕНИЕ ====================
+
+    def _init_reader(self):
+        conn = self._connect_reader()
+        self._local.conn = conn
+        with self._reader_conns_lock:
+            self._reader_conns.append(conn)
+
+    def submit_read(self, fn: Callable[[sqlite3.Connection], Any]) -> Future:
+        if self._readers is None:
+            return self.submit_write(fn)
+
+        enqueued = time.monotonic()
+
+        def run():
+            self._record_wait('read', time.monotonic() - enqueued)
+            return fn(self._local.conn)
+
+        return self._readers.submit(run)
+
+    def read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        if threading.current_thread() is self._writer:
+            return fn(self._writer_conn)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            # Вложенное чтение из потока-читателя
+            return fn(conn)
+        return self.submit_read(fn).result()
+
+    # ==================== СЛУЖЕБНОЕ ====================
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def read_queue_depth(self) -> int:
+        if self._readers is None:
+            return 0
+        return self._readers._work_queue.qsize()
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики очередей: глубина, число операций, ожидание в очереди"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['write_queue_depth'] = self.queue_depth()
+        stats['read_queue_depth'] = self.read_queue_depth()
+        stats['write_wait_avg'] = stats['write_wait_total'] / stats['write_ops'] if stats['write_ops'] else 0.0
+        stats['read_wait_avg'] = stats['read_wait_total'] / stats['read_ops'] if stats['read_ops'] else 0.0
+        return stats
+
+    def close(self):
+        """Дождаться выполнения очереди и закрыть соединения"""
+        self._queue.put(_STOP)
+        self._writer.join()
+        if self._readers is not None:
+            self._readers.shutdown(wait=True)
+        with self._reader_conns_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
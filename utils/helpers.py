@@ -1,5 +1,7 @@
 import logging
-from typing import Dict, List
+from typing import Dict
+
+from utils.pricing import PriceQuote, format_money
 
 # Добавляем logger
 logger = logging.getLogger(__name__)
@@ -14,53 +16,23 @@ def setup_logging():
         ]
     )
 
-def calculate_order_total(cart: Dict, products: List[Dict]) -> float:
-    total = 0.0
-    logger.info(f"Calculating total for cart: {cart}")
-    
-    for product_name, quantity in cart.items():
-        # Ищем товар по точному совпадению имени
-        product = next((p for p in products if p['name'] == product_name), None)
-        if product:
-            product_total = quantity * product['cost']
-            logger.info(f"Product: {product_name}, Qty: {quantity}, Price: {product_total}")
-            total += product_total
-        else:
-            logger.warning(f"Product '{product_name}' not found in products list")
-            # Попробуем найти по частичному совпадению
-            for p in products:
-                if product_name in p['name'] or p['name'] in product_name:
-                    product_total = quantity * p['cost']
-                    logger.info(f"Found similar: {p['name']} for {product_name}")
-                    total += product_total
-                    break
-    
-    logger.info(f"Total calculated: {total}")
-    return round(total, 2)
-
-def format_order_text(cart: Dict, products: List[Dict], location: str, comment: str) -> str:
+def format_order_text(quote: PriceQuote, location: str, comment: str) -> str:
     order_text = "✅ *Ваш заказ подтверждён!*\n\n"
     order_text += "📦 *Состав заказа:*\n"
+    order_text += "\n".join(quote.lines) + "\n"
     
-    total = 0.0
-    for product_name, quantity in cart.items():
-        product = next((p for p in products if p['name'] == product_name), None)
-        if product:
-            product_total = quantity * product['cost']
-            order_text += f"• {product_name} x{quantity} - {product_total} руб.\n"
-            total += product_total
-        else:
-            # Если точное совпадение не найдено, ищем похожее
-            for p in products:
-                if product_name in p['name'] or p['name'] in product_name:
-                    product_total = quantity * p['cost']
-                    order_text += f"• {p['name']} x{quantity} - {product_total} руб.\n"
-                    total += product_total
-                    break
-    
-    order_text += f"\n💰 *Итого: {round(total, 2)} руб.*\n"
+    order_text += f"\n💰 *Итого: {format_money(quote.total)} руб.*\n"
     order_text += f"📍 *Локация:* {location}\n"
     order_text += f"📝 *Комментарий:* {comment}\n\n"
     order_text += "⏳ *Мы свяжемся с вами в ближайшее время для подтверждения заказа!*"
     
-    return order_text
\ No newline at end of file
+    return order_text
+
+def format_sync_summary(summary: Dict) -> str:
+    """Сводка синхронизации товаров для администратора"""
+    return (
+        f"➕ Добавлено: {summary['added']}\n"
+        f"✏️ Изменено: {summary['updated']}\n"
+        f"➖ Удалено: {summary['removed']}\n"
+        f"▫️ Без изменений: {summary['unchanged']}"
+    )
\ No newline at end of file
@@ -0,0 +1,272 @@
+import io
+import os
+import hashlib
+import imghdr
+import logging
+import zipfile
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils.search import normalize
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен: фото сохраняются без пережатия
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Расширения сохраняемых файлов по типу из сигнатуры
+IMAGE_EXTENSIONS = {
+    'jpeg': '.jpg',
+    'png': '.png',
+    'gif': '.gif',
+    'webp': '.webp',
+    'bmp': '.bmp',
+    'tiff': '.tiff',
+}
+
+# Без Pillow сохраняются только форматы, которые Telegram принимает как фото
+PHOTO_TYPES = ('jpeg', 'png')
+
+# Ограничения: размер загрузки (Bot API отдаёт файлы до 20 МБ), фото для Telegram,
+# число пикселей (защита от «бомб»), архивы
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+MAX_PHOTO_BYTES = 10 * 1024 * 1024
+MAX_PIXELS = 40_000_000
+MAX_ARCHIVE_FILES = 500
+MAX_ARCHIVE_BYTES = 200 * 1024 * 1024
+
+# Варианты после пережатия: суффикс имени файла и наибольшая сторона
+VARIANTS = (('', 1280), ('_thumb', 320))
+JPEG_QUALITY = 85
+
+# Сколько проблемных файлов показывать администратору в одном сообщении
+MAX_REPORTED_FILES = 20
+
+def start_encoder_pool(workers: int) -> Optional[ProcessPoolExecutor]:
+    """Пул процессов для пережатия фото; None без Pillow или при workers <= 0.
+
+    Вызывать до запуска потоков: fork копирует только вызывающий поток, и
+    замок, захваченный в этот момент другим потоком, в дочернем процессе
+    не освободится никогда. fork нужен, чтобы процесс пула не импортировал
+    заново main.py. Пустая задача сразу запускает все процессы пула.
+    """
+    if Image is None or workers <= 0:
+        return None
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    pool.submit(int).result()
+    return pool
+
+def encode_variants(data: bytes) -> List[Tuple[str, bytes]]:
+    """Пережать картинку в JPEG размеров из VARIANTS (выполняется в процессе пула)"""
+    try:
+        source = Image.open(io.BytesIO(data))
+    except Exception:
+        raise ValueError("файл повреждён или формат не поддерживается")
+    with source:
+        if source.width * source.height > MAX_PIXELS:
+            raise ValueError(f"слишком большое разрешение {source.width}x{source.height}")
+        image = ImageOps.exif_transpose(source)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # Прозрачность - на белый фон
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        variants = []
+        for suffix, side in VARIANTS:
+            variant = image.copy()
+            variant.thumbnail((side, side))
+            buffer = io.BytesIO()
+            variant.save(buffer, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            variants.append((suffix, buffer.getvalue()))
+        return variants
+
+class IngestReport:
+    """Отчёт о приёме фото: привязанные к товарам, повторы и отклонённые файлы"""
+
+    def __init__(self):
+        self.linked: List[Tuple[str, str]] = []
+        self.duplicates = 0
+        self.rejected: List[Tuple[str, str]] = []
+        self.unmatched: List[str] = []
+
+    def reject(self, filename: str, reason: str):
+        self.rejected.append((filename, reason))
+
+    def format(self) -> str:
+        text = f"✅ Привязано к товарам: {len(self.linked)}\n"
+        if self.duplicates:
+            text += f"♻️ Повторяющиеся картинки (хранятся один раз): {self.duplicates}\n"
+        if self.unmatched:
+            text += f"❓ Нет товара с таким названием: {len(self.unmatched)}\n"
+            for name in self.unmatched[:MAX_REPORTED_FILES]:
+                text += f"• {name}\n"
+        if self.rejected:
+            text += f"⚠️ Отклонено: {len(self.rejected)}\n"
+            for filename, reason in self.rejected[:MAX_REPORTED_FILES]:
+                text += f"• {filename}: {reason}\n"
+        return text.rstrip()
+
+class ImageIngestor:
+    """Приём фото товаров в фоне.
+
+    submit() только ставит задачу в очередь: скачивание, распаковка zip и
+    разбор идут в отдельном потоке, пережатие - в пуле процессов, поэтому
+    большая загрузка не занимает потоки обработки обновлений. Тип файла
+    определяется по сигнатуре (imghdr), одинаковые картинки (SHA-256)
+    пережимаются и хранятся один раз. Результат - JPEG с ограниченной
+    стороной и миниатюра в каталоге фото; основной вариант записывается в
+    image_path товара, найденного по названию (подпись к фото или имя файла).
+    Без Pillow JPEG и PNG до MAX_PHOTO_BYTES сохраняются как есть.
+    """
+
+    def __init__(self, db, images_dir: str, pool: Optional[ProcessPoolExecutor] = None):
+        self._db = db
+        self._images_dir = images_dir
+        self._queue = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-ingest')
+        # Пул из start_encoder_pool(); без него пережатие идёт в потоке очереди
+        self._pool = pool
+        os.makedirs(images_dir, exist_ok=True)
+
+    def submit(self, fetch: Callable[[], bytes], name: str, filename: str,
+               done: Callable[[IngestReport], None]) -> Future:
+        """Обработать файл в фоне: fetch() скачивает байты, done(report) получает отчёт.
+
+        name - название товара для одиночной картинки; в zip-архиве товар
+        определяется по имени каждого файла.
+        """
+        return self._queue.submit(self._run, fetch, name, filename, done)
+
+    # ==================== РАЗБОР ====================
+
+    def _run(self, fetch: Callable[[], bytes], name: str, filename: str, done: Callable[[IngestReport], None]):
+        report = IngestReport()
+        try:
+            data = fetch()
+            if len(data) > MAX_UPLOAD_BYTES:
+                report.reject(filename, "файл больше 20 МБ")
+            elif data[:4] == b'PK\x03\x04':
+                self._ingest(self._unzip(data, report), report)
+            else:
+                self._ingest([(name, filename, data)], report)
+        except Exception as e:
+            logger.error(f"Error ingesting {filename}: {e}")
+            report.reject(filename, str(e))
+        logger.info(f"Images ingested from {filename}: {len(report.linked)} linked, "
+                    f"{len(report.rejected)} rejected, {len(report.unmatched)} unmatched")
+        try:
+            done(report)
+        except Exception as e:
+            logger.error(f"Error reporting image ingestion: {e}")
+
+    @staticmethod
+    def _unzip(data: bytes, report: IngestReport) -> List[Tuple[str, str, bytes]]:
+        """Файлы архива: (название товара из имени файла, имя файла, байты)"""
+        entries = []
+        total = 0
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for info in archive.infolist():
+                basename = os.path.basename(info.filename)
+                if info.is_dir() or not basename or basename.startswith('.') or '__MACOSX' in info.filename:
+                    continue
+                if len(entries) >= MAX_ARCHIVE_FILES:
+                    report.reject(basename, f"в архиве больше {MAX_ARCHIVE_FILES} файлов")
+                    break
+                if info.file_size > MAX_UPLOAD_BYTES or total + info.file_size > MAX_ARCHIVE_BYTES:
+                    report.reject(basename, "слишком большой файл")
+                    continue
+                total += info.file_size
+                entries.append((os.path.splitext(basename)[0], basename, archive.read(info)))
+        return entries
+
+    def _ingest(self, entries: List[Tuple[str, str, bytes]], report: IngestReport):
+        products = {normalize(product.name): product.name for product in self._db.get_all_products()}
+        stored: Dict[str, object] = {}
+        links = []
+
+        for name, filename, data in entries:
+            product = products.get(normalize(name or ''))
+            if product is None:
+                report.unmatched.append(name or filename)
+                continue
+            kind = imghdr.what(None, data)
+            if kind not in IMAGE_EXTENSIONS:
+                report.reject(filename, "не картинка")
+                continue
+
+            digest = hashlib.sha256(data).hexdigest()
+            if digest in stored:
+                report.duplicates += 1
+            else:
+                stored[digest] = self._store(digest, kind, data, report)
+            links.append((product, filename, digest))
+
+        rows = []
+        for product, filename, digest in links:
+            result = stored[digest]
+            if isinstance(result, Future):
+                # Первая ссылка на картинку дожидается пережатия и пишет файлы
+                try:
+                    result = self._write_variants(digest, result)
+                except Exception as e:
+                    result = e
+                stored[digest] = result
+            if isinstance(result, Exception):
+                report.reject(filename, str(result))
+                continue
+            rows.append((result, product))
+            report.linked.append((product, result))
+        if rows:
+            self._db.set_product_images(rows)
+
+    # ==================== ХРАНЕНИЕ ====================
+
+    def _store(self, digest: str, kind: str, data: bytes, report: IngestReport):
+        """Имя готового файла, Future пережатия или исключение"""
+        base = digest[:24]
+        if Image is None:
+            if kind not in PHOTO_TYPES or len(data) > MAX_PHOTO_BYTES:
+                return ValueError("нужен Pillow, чтобы пережать такой файл")
+            path = base + IMAGE_EXTENSIONS[kind]
+            if os.path.exists(os.path.join(self._images_dir, path)):
+                report.duplicates += 1
+            else:
+                self._write_file(path, data)
+            return path
+
+        if os.path.exists(os.path.join(self._images_dir, base + '.jpg')):
+            report.duplicates += 1
+            return base + '.jpg'
+        if self._pool is not None:
+            return self._pool.submit(encode_variants, data)
+        future = Future()
+        try:
+            future.set_result(encode_variants(data))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _write_variants(self, digest: str, future: Future) -> str:
+        base = digest[:24]
+        for suffix, data in future.result():
+            self._write_file(base + suffix + '.jpg', data)
+        return base + '.jpg'
+
+    def _write_file(self, name: str, data: bytes):
+        path = os.path.join(self._images_dir, name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        """Дождаться обработки очереди и остановить пул"""
+        self._queue.shutdown(wait=True)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
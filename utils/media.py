@@ -0,0 +1,206 @@
+import os
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from telegram import Bot, InputMediaPhoto, Message
+from telegram.error import BadRequest
+
+from utils.models import Product
+
+logger = logging.getLogger(__name__)
+
+# Фото в одном альбоме (ограничение Telegram: от 2 до 10)
+ALBUM_SIZE = 10
+
+class PhotoCache:
+    """Фото товаров с кэшем file_id.
+
+    Файл загружается в Telegram один раз: file_id из ответа сохраняется в
+    базе по SHA-256 содержимого, дальше отправляется только file_id.
+    Одинаковые картинки разных товаров делят один file_id, заменённый файл
+    получает новый хэш и загружается заново. Хэш файла считается один раз
+    на файл и пересчитывается, когда меняются его размер или mtime. Если
+    Telegram не принимает сохранённый file_id (например, сменился бот),
+    запись удаляется и файл загружается снова. Фото берутся только из
+    каталога фото: путь из CSV, ведущий за его пределы, не отправляется.
+    """
+
+    def __init__(self, db, images_dir: str):
+        self._db = db
+        self._images_dir = images_dir
+        self._root = os.path.realpath(images_dir)
+        self._lock = threading.Lock()
+        self._file_ids: Optional[Dict[str, str]] = None
+        # путь -> (размер, mtime, sha256)
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+        self._stats = {'cached': 0, 'uploaded': 0, 'missing': 0}
+
+    # ==================== ФАЙЛЫ ====================
+
+    def _path(self, image_path: Optional[str]) -> Optional[str]:
+        """Файл фото: путь как есть или относительно каталога фото"""
+        if not image_path:
+            return None
+        inside = [
+            path for path in map(os.path.realpath, (image_path, os.path.join(self._images_dir, image_path)))
+            if os.path.commonpath([path, self._root]) == self._root
+        ]
+        if not inside:
+            logger.warning(f"Image outside {self._images_dir} ignored: {image_path}")
+            return None
+        for path in inside:
+            if os.path.isfile(path):
+                return path
+        with self._lock:
+            self._stats['missing'] += 1
+        logger.debug(f"Image not found: {image_path}")
+        return None
+
+    def _digest(self, path: str) -> str:
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        # Одна запись на файл: заменённый файл вытесняет старый хэш
+        self._hashes[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def _known_locked(self) -> Dict[str, str]:
+        if self._file_ids is None:
+            self._file_ids = self._db.load_media_file_ids()
+        return self._file_ids
+
+    def _known(self) -> Dict[str, str]:
+        with self._lock:
+            return self._known_locked()
+
+    def _lookup(self, product: Product) -> Optional[Tuple[str, str, Optional[str]]]:
+        """(путь, sha256, сохранённый file_id или None) для фото товара"""
+        path = self._path(product.image_path)
+        if path is None:
+            return None
+        try:
+            digest = self._digest(path)
+        except OSError as e:
+            logger.error(f"Error reading image {path}: {e}")
+            return None
+        return path, digest, self._known().get(digest)
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    # ==================== FILE_ID ====================
+
+    def _remember(self, uploaded: List[Tuple[str, Message]]):
+        rows = [(digest, message.photo[-1].file_id) for digest, message in uploaded if message.photo]
+        if not rows:
+            return
+        with self._lock:
+            self._known_locked().update(rows)
+            self._stats['uploaded'] += len(rows)
+        self._db.save_media_file_ids(rows)
+
+    def _forget(self, digests: Sequence[str]):
+        with self._lock:
+            for digest in digests:
+                self._known_locked().pop(digest, None)
+        for digest in digests:
+            self._db.forget_media_file_id(digest)
+
+    @staticmethod
+    def _stale_file_id(error: BadRequest) -> bool:
+        # "Wrong file identifier/http url specified", "Wrong remote file identifier..."
+        return 'file' in str(error).lower()
+
+    def reload(self):
+        """Перечитать file_id из базы (после восстановления из снимка)"""
+        with self._lock:
+            self._file_ids = None
+
+    def file_id(self, product: Product) -> Optional[str]:
+        """Сохранённый file_id фото товара без загрузки (для inline-режима)"""
+        photo = self._lookup(product)
+        return photo[2] if photo else None
+
+    # ==================== ОТПРАВКА ====================
+
+    def send_photo(self, bot: Bot, chat_id: int, product: Product, caption: str, **kwargs) -> Optional[Message]:
+        """Фото товара с подписью; None - у товара нет фото"""
+        photo = self._lookup(product)
+        if photo is None:
+            return None
+        path, digest, file_id = photo
+
+        if file_id:
+            try:
+                message = bot.send_photo(chat_id, file_id, caption=caption, **kwargs)
+                with self._lock:
+                    self._stats['cached'] += 1
+                return message
+            except BadRequest as e:
+                if not self._stale_file_id(e):
+                    raise
+                logger.warning(f"Cached photo of {product.name} rejected: {e}, uploading again")
+                self._forget([digest])
+
+        message = bot.send_photo(chat_id, self._read(path), caption=caption, **kwargs)
+        self._remember([(digest, message)])
+        return message
+
+    def send_album(self, bot: Bot, chat_id: int, items: Sequence[Tuple[Product, str]],
+                   limit: Optional[int] = None) -> int:
+        """Фото товаров альбомами по ALBUM_SIZE; items - (товар, подпись),
+        limit - не больше стольких фото. Возвращает число фото"""
+        photos = []
+        for product, caption in items:
+            if limit is not None and len(photos) >= limit:
+                break
+            photo = self._lookup(product)
+            if photo is not None:
+                photos.append((product, caption) + photo)
+
+        for start in range(0, len(photos), ALBUM_SIZE):
+            chunk = photos[start:start + ALBUM_SIZE]
+            if len(chunk) == 1:
+                product, caption = chunk[0][:2]
+                self.send_photo(bot, chat_id, product, caption)
+                continue
+
+            cached = [digest for _, _, _, digest, file_id in chunk if file_id]
+            try:
+                messages = bot.send_media_group(chat_id, self._album(chunk, use_cache=True))
+            except BadRequest as e:
+                if not cached or not self._stale_file_id(e):
+                    raise
+                logger.warning(f"Cached album photos rejected: {e}, uploading again")
+                self._forget(cached)
+                cached = []
+                messages = bot.send_media_group(chat_id, self._album(chunk, use_cache=False))
+
+            with self._lock:
+                self._stats['cached'] += len(cached)
+            self._remember([
+                (digest, message)
+                for (_, _, _, digest, _), message in zip(chunk, messages)
+                if digest not in cached
+            ])
+        return len(photos)
+
+    def _album(self, chunk: Sequence[tuple], use_cache: bool) -> List[InputMediaPhoto]:
+        return [
+            InputMediaPhoto(file_id if use_cache and file_id else self._read(path), caption=caption)
+            for _, caption, path, _, file_id in chunk
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        """Отправлено по file_id, загружено файлов, не найдено файлов"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['known'] = len(self._file_ids or {})
+        return stats
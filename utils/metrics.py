@@ -0,0 +1,300 @@
+import math
+import time
+import logging
+import threading
+import functools
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм: время (секунды) и число вызовов на обновление
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+# Коллектор отдаёт текущие значения: (имя, описание, {метка: значение}, значение)
+Collector = Callable[[], Iterable[Tuple[str, str, Dict[str, str], float]]]
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как в Prometheus"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # Последняя корзина - +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля: верхняя граница корзины, в которую он попал"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return self.buckets[-1]
+
+class Metrics:
+    """Реестр метрик процесса: гистограммы, счётчики и коллекторы.
+
+    Кроме общих значений считает обращения к Bot API и к базе внутри
+    одного обновления: update_scope() открывает счётчики в потоке,
+    который обрабатывает обновление, count() добавляет к ним вызов.
+    render() - текстовый формат Prometheus для /metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families: Dict[str, Tuple[str, str, Tuple[str, ...], Tuple[float, ...]]] = {}
+        self._histograms: Dict[str, Dict[tuple, Histogram]] = {}
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._collectors: List[Collector] = []
+        self._local = threading.local()
+
+    # ==================== ОПИСАНИЕ ====================
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self._families[name] = ('histogram', help_text, labels, buckets)
+        self._histograms[name] = {}
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self._families[name] = ('counter', help_text, labels, ())
+        self._counters[name] = {}
+
+    def collect(self, collector: Collector):
+        """Добавить источник текущих значений (очереди, кэши) для /metrics"""
+        self._collectors.append(collector)
+
+    # ==================== ЗАПИСЬ ====================
+
+    def observe(self, name: str, value: float, *labels: str):
+        with self._lock:
+            histogram = self._histograms[name].get(labels)
+            if histogram is None:
+                histogram = self._histograms[name][labels] = Histogram(self._families[name][3])
+            histogram.observe(value)
+
+    def inc(self, name: str, *labels: str, value: float = 1):
+        with self._lock:
+            series = self._counters[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def timed(self, histogram: str, errors: str, label: Optional[str] = None):
+        """Декоратор: время вызова в histogram, исключения в errors с меткой label (по умолчанию имя функции)"""
+        def decorator(fn: Callable) -> Callable:
+            name = label or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    self.inc(errors, name)
+                    raise
+                finally:
+                    self.observe(histogram, time.perf_counter() - started, name)
+            return wrapper
+        return decorator
+
+    # ==================== ОБНОВЛЕНИЕ ====================
+
+    @contextmanager
+    def update_scope(self):
+        """Время обработки обновления и число вызовов Bot API и базы в нём"""
+        counts = self._local.counts = {'api': 0, 'db': 0, 'sql': 0}
+        started = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self._local.counts = None
+            self.observe('bot_update_seconds', time.perf_counter() - started)
+            self.observe('bot_update_api_calls', counts['api'])
+            self.observe('bot_update_db_calls', counts['db'])
+            self.observe('bot_update_sql_statements', counts['sql'])
+
+    def update_counts(self) -> Optional[Dict[str, int]]:
+        """Счётчики обновления, которое обрабатывает текущий поток, или None"""
+        return getattr(self._local, 'counts', None)
+
+    def count(self, kind: str):
+        counts = self.update_counts()
+        if counts is not None:
+            counts[kind] += 1
+
+    def traced(self, fn: Callable[[Any], Any]) -> Callable[[Any], Any]:
+        """fn(conn) с подсчётом обращения к базе и SQL-запросов для текущего обновления"""
+        counts = self.update_counts()
+        if counts is None:
+            return fn
+        counts['db'] += 1
+
+        def run(conn):
+            conn.set_trace_callback(lambda statement: counts.__setitem__('sql', counts['sql'] + 1))
+            try:
+                return fn(conn)
+            finally:
+                conn.set_trace_callback(None)
+        return run
+
+    # ==================== ЧТЕНИЕ ====================
+
+    def snapshot(self, name: str) -> Dict[tuple, Histogram]:
+        """Копия гистограмм семейства по меткам"""
+        with self._lock:
+            snapshot = {}
+            for labels, histogram in self._histograms[name].items():
+                copy = Histogram(histogram.buckets)
+                copy.counts = list(histogram.counts)
+                copy.sum = histogram.sum
+                copy.count = histogram.count
+                snapshot[labels] = copy
+            return snapshot
+
+    def counter_values(self, name: str) -> Dict[tuple, float]:
+        with self._lock:
+            return dict(self._counters[name])
+
+    @staticmethod
+    def _labels(names: Tuple[str, ...], values: tuple, extra: str = '') -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for name, (kind, help_text, label_names, _) in self._families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for labels, value in sorted(self.counter_values(name).items()):
+                    lines.append(f"{name}{self._labels(label_names, labels)} {_number(value)}")
+                continue
+            for labels, histogram in sorted(self.snapshot(name).items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    bucket = self._labels(label_names, labels, 'le="%g"' % bound)
+                    lines.append(f"{name}_bucket{bucket} {cumulative}")
+                bucket = self._labels(label_names, labels, 'le="+Inf"')
+                lines.append(f"{name}_bucket{bucket} {histogram.count}")
+                lines.append(f"{name}_sum{self._labels(label_names, labels)} {_number(histogram.sum)}")
+                lines.append(f"{name}_count{self._labels(label_names, labels)} {histogram.count}")
+
+        gauges: Dict[str, Tuple[str, List[str]]] = {}
+        for collector in self._collectors:
+            try:
+                for name, help_text, labels, value in collector():
+                    label_text = self._labels(tuple(labels), tuple(labels.values()))
+                    gauges.setdefault(name, (help_text, []))[1].append(f"{name}{label_text} {_number(value)}")
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        for name, (help_text, samples) in gauges.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    # ==================== HTTP ====================
+
+    def serve(self, host: str, port: int) -> ThreadingHTTPServer:
+        """Отдавать /metrics по HTTP в фоновом потоке"""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Metrics request: {format % args}")
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info(f"Metrics endpoint: http://{host}:{port}/metrics")
+        return server
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _number(value: float) -> str:
+    """Значение без потери точности: целые - как int, дробные - repr(float)"""
+    if isinstance(value, int):
+        return str(int(value))
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def timed_methods(histogram: str, errors: str):
+    """Декоратор класса: время и ошибки каждого публичного метода (метка - имя метода)"""
+    def decorator(cls):
+        for name, value in list(vars(cls).items()):
+            if not name.startswith('_') and callable(value) and not isinstance(value, type):
+                setattr(cls, name, metrics.timed(histogram, errors, name)(value))
+        return cls
+    return decorator
+
+def instrument_handlers(dispatcher):
+    """Обернуть callback всех обработчиков диспетчера (и внутри ConversationHandler) в замер времени.
+
+    Маршруты Router считает сам (utils/router.py).
+    """
+    from telegram.ext import ConversationHandler
+    from utils.router import RouteHandler
+
+    def wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            for inner in handler.entry_points + handler.fallbacks:
+                wrap(inner)
+            for state_handlers in handler.states.values():
+                for inner in state_handlers:
+                    wrap(inner)
+            return
+        if isinstance(handler, RouteHandler) or hasattr(handler.callback, '__wrapped__'):
+            return
+        handler.callback = metrics.timed('bot_handler_seconds', 'bot_handler_errors_total')(handler.callback)
+
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+
+# Реестр процесса
+metrics = Metrics()
+metrics.histogram('bot_handler_seconds', 'Handler (route, command, job) execution time', ('handler',))
+metrics.counter('bot_handler_errors_total', 'Handler exceptions', ('handler',))
+metrics.histogram('bot_update_seconds', 'Time to process one update')
+metrics.histogram('bot_update_api_calls', 'Bot API calls made while processing one update', buckets=COUNT_BUCKETS)
+metrics.histogram('bot_update_db_calls', 'Database operations while processing one update', buckets=COUNT_BUCKETS)
+metrics.histogram('bot_update_sql_statements', 'SQL statements while processing one update', buckets=COUNT_BUCKETS)
+metrics.histogram('bot_db_call_seconds', 'Database method execution time', ('method',))
+metrics.counter('bot_db_call_errors_total', 'Database method exceptions', ('method',))
+metrics.histogram('bot_api_seconds', 'Bot API request time', ('method',))
+metrics.counter('bot_api_errors_total', 'Bot API request errors', ('method',))
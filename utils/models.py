@@ -0,0 +1,54 @@
+from typing import Dict, NamedTuple, Optional, Tuple
+
+# Записи, которые возвращает Database. Это кортежи с именованными полями:
+# без __dict__ на каждый экземпляр и без копирования ключей-строк,
+# неизменяемые - один объект товара из кэша каталога безопасно делить
+# между всеми пользователями и потоками.
+
+class Product(NamedTuple):
+    id: int
+    category: str
+    name: str
+    cost: float
+    quantity: int
+    image_path: Optional[str]
+    description: Optional[str]
+
+class OrderItem(NamedTuple):
+    product_id: Optional[int]
+    name: str
+    unit_price: Optional[float]
+    quantity: int
+
+    @property
+    def total(self) -> float:
+        return (self.unit_price or 0) * self.quantity
+
+class Order(NamedTuple):
+    id: int
+    user_id: int
+    user_name: str
+    total_price: float
+    location: str
+    comment: str
+    status: str
+    created_at: str
+    items: Tuple[OrderItem, ...]
+
+    @property
+    def order_data(self) -> Dict[str, int]:
+        """Состав заказа: название -> количество"""
+        data = {}
+        for item in self.items:
+            data[item.name] = data.get(item.name, 0) + item.quantity
+        return data
+
+class Broadcast(NamedTuple):
+    id: int
+    status: str
+    created_at: str
+    total: int
+    sent: int
+    failed: int
+    blocked: int
+    pending: int
@@ -0,0 +1,323 @@
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Union
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.ext import ExtBot
+
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Полосы приоритета: меньше - раньше
+PRIORITY_REPLY = 0   # ответы покупателю
+PRIORITY_ADMIN = 1   # уведомления администратору
+PRIORITY_BULK = 2    # рассылки
+LANES = ('reply', 'admin', 'bulk')
+
+# Повторы при 429 (RetryAfter) и сетевых ошибках
+MAX_RETRY_AFTER = 5
+MAX_NETWORK_RETRIES = 3
+NETWORK_RETRY_DELAY = 1.0
+
+# Сообщение, ждавшее отправки дольше этого значения, попадает в лог
+SLOW_DELIVERY_SECONDS = 3.0
+
+ChatId = Union[int, str]
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def drain(self):
+        self.tokens = min(self.tokens, 0.0)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class _Outgoing:
+    __slots__ = ('chat_id', 'fn', 'args', 'kwargs', 'priority', 'future', 'enqueued', 'retries')
+
+    def __init__(self, chat_id: ChatId, fn: Callable, args: tuple, kwargs: dict, priority: int):
+        self.chat_id = chat_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.retries = 0
+
+class Outbox:
+    """Очередь исходящих сообщений с учётом лимитов Telegram.
+
+    Сообщения ждут в полосах приоритета (ответы покупателям раньше
+    уведомлений администратору и рассылок). Поток-планировщик выбирает
+    следующее сообщение, для которого есть токен в общем ведре (лимит бота)
+    и в ведре чата (лимит на чат, у групп строже), и отдаёт его пулу
+    отправителей. Сообщения одного чата уходят по порядку: пока одно
+    отправляется, следующие для этого чата ждут. На RetryAfter (429) чат
+    ставится на паузу на указанное время и сообщение повторяется.
+
+    submit() возвращает Future - обработчик может не ждать отправки.
+    """
+
+    def __init__(self, workers: int = 4, global_rate: float = 30, chat_rate: float = 1,
+                 chat_burst: float = 3, group_rate: float = 20 / 60):
+        self.bot: Optional[ExtBot] = None
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._group_rate = group_rate
+        self._buckets: Dict[ChatId, TokenBucket] = {}
+        self._paused: Dict[ChatId, float] = {}
+        self._lanes: List[Deque[_Outgoing]] = [deque() for _ in LANES]
+        self._in_flight: Set[ChatId] = set()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._local = threading.local()
+        self._stats = {
+            'sent': 0,
+            'failed': 0,
+            'retry_after': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        }
+
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='outbox-sender',
+            initializer=self._init_sender
+        )
+        self._scheduler = threading.Thread(target=self._schedule_loop, name='outbox', daemon=True)
+        self._scheduler.start()
+
+    # ==================== ПОСТАНОВКА В ОЧЕРЕДЬ ====================
+
+    def submit(self, chat_id: ChatId, fn: Callable, *args, priority: int = PRIORITY_REPLY, **kwargs) -> Future:
+        """Поставить вызов fn(*args, **kwargs) к Bot API для чата chat_id в очередь"""
+        item = _Outgoing(chat_id, fn, args, kwargs, priority)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Outbox is closed")
+            self._lanes[priority].append(item)
+            self._cond.notify()
+        return item.future
+
+    def send_message(self, chat_id: ChatId, text: str, priority: int = PRIORITY_REPLY, **kwargs) -> Future:
+        return self.submit(chat_id, self.bot.send_message, chat_id, text, priority=priority, **kwargs)
+
+    def in_sender(self) -> bool:
+        """Вызов из потока-отправителя (отправлять напрямую, мимо очереди)"""
+        return getattr(self._local, 'sender', False)
+
+    # ==================== ПЛАНИРОВЩИК ====================
+
+    def _init_sender(self):
+        self._local.sender = True
+
+    def _bucket(self, chat_id: ChatId) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Группы и каналы (отрицательный id или @username) - 20 сообщений в минуту
+            if isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0):
+                bucket = TokenBucket(self._group_rate, self._chat_burst)
+            else:
+                bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _pick(self, now: float):
+        """Следующее сообщение, которое можно отправить сейчас, или время ожидания"""
+        global_wait = self._global.wait_time(now)
+        if global_wait > 0:
+            return None, global_wait
+
+        wait = None
+        blocked: Set[ChatId] = set()
+        for lane in self._lanes:
+            for index, item in enumerate(lane):
+                chat_id = item.chat_id
+                if chat_id in blocked or chat_id in self._in_flight:
+                    blocked.add(chat_id)
+                    continue
+                chat_wait = max(self._bucket(chat_id).wait_time(now), self._paused.get(chat_id, 0) - now)
+                if chat_wait > 0:
+                    blocked.add(chat_id)
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                    continue
+                del lane[index]
+                self._bucket(chat_id).take(now)
+                self._global.take(now)
+                self._paused.pop(chat_id, None)
+                return item, None
+        return None, wait
+
+    def _prune_buckets(self, now: float):
+        # Полные вёдра без пауз ничего не ограничивают - их можно забыть
+        if len(self._buckets) > 10000:
+            for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                            if chat_id not in self._paused and bucket.is_full(now)]:
+                del self._buckets[chat_id]
+
+    def _schedule_loop(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                item, wait = self._pick(now)
+                if item is None:
+                    if self._closed and not self.queue_depth() and not self._in_flight:
+                        break
+                    self._prune_buckets(now)
+                    self._cond.wait(wait)
+                    continue
+                self._in_flight.add(item.chat_id)
+            self._pool.submit(self._deliver, item)
+
+    # ==================== ОТПРАВКА ====================
+
+    def _deliver(self, item: _Outgoing):
+        retry_delay = None
+        try:
+            result = item.fn(*item.args, **item.kwargs)
+        except RetryAfter as e:
+            if item.retries < MAX_RETRY_AFTER:
+                retry_delay = float(e.retry_after)
+                with self._cond:
+                    self._stats['retry_after'] += 1
+                logger.warning(f"Flood limit for chat {item.chat_id}, retry in {retry_delay}s")
+            else:
+                self._finish(item, error=e)
+        except BadRequest as e:
+            # В PTB 13 BadRequest - подкласс NetworkError, но повтор не поможет
+            self._finish(item, error=e)
+        except (TimedOut, NetworkError) as e:
+            if item.retries < MAX_NETWORK_RETRIES:
+                retry_delay = NETWORK_RETRY_DELAY * (item.retries + 1)
+                logger.warning(f"Network error sending to chat {item.chat_id}: {e}, retry in {retry_delay}s")
+            else:
+                self._finish(item, error=e)
+        except Exception as e:
+            self._finish(item, error=e)
+        else:
+            self._finish(item, result=result)
+
+        with self._cond:
+            self._in_flight.discard(item.chat_id)
+            if retry_delay is not None:
+                item.retries += 1
+                self._paused[item.chat_id] = time.monotonic() + retry_delay
+                self._bucket(item.chat_id).drain()
+                # Повтор раньше следующих сообщений этого чата
+                self._lanes[item.priority].appendleft(item)
+            self._cond.notify()
+
+    def _finish(self, item: _Outgoing, result: Any = None, error: Exception = None):
+        latency = time.monotonic() - item.enqueued
+        with self._cond:
+            if error is None:
+                self._stats['sent'] += 1
+                self._stats['latency_total'] += latency
+                if latency > self._stats['latency_max']:
+                    self._stats['latency_max'] = latency
+            else:
+                self._stats['failed'] += 1
+        if error is None:
+            if latency > SLOW_DELIVERY_SECONDS:
+                logger.warning(f"Message to chat {item.chat_id} delivered after {latency:.1f}s")
+            item.future.set_result(result)
+        else:
+            logger.error(f"Error sending to chat {item.chat_id}: {error}")
+            item.future.set_exception(error)
+
+    # ==================== СЛУЖЕБНОЕ ====================
+
+    def queue_depth(self) -> int:
+        return sum(len(lane) for lane in self._lanes)
+
+    def stats(self) -> Dict[str, Any]:
+        """Очередь отправки: глубина по полосам, отправлено, задержка доставки"""
+        with self._cond:
+            stats = dict(self._stats)
+            for name, lane in zip(LANES, self._lanes):
+                stats[f'queued_{name}'] = len(lane)
+            stats['in_flight'] = len(self._in_flight)
+            stats['paused_chats'] = sum(1 for until in self._paused.values() if until > time.monotonic())
+        stats['queued'] = sum(stats[f'queued_{name}'] for name in LANES)
+        stats['latency_avg'] = stats['latency_total'] / stats['sent'] if stats['sent'] else 0.0
+        return stats
+
+    def close(self, timeout: float = 10.0):
+        """Дождаться отправки очереди (не дольше timeout) и остановить потоки"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._scheduler.join(timeout)
+        if self._scheduler.is_alive():
+            logger.warning(f"Outbox closed with {self.queue_depth()} messages not sent")
+        self._pool.shutdown(wait=True)
+
+class QueuedBot(ExtBot):
+    """ExtBot, у которого все send_*/edit_* (и reply_text, альбомы) идут через Outbox.
+
+    Вызов из обработчика ставится в полосу ответов и ждёт отправки,
+    поэтому лимиты и повторы при 429 действуют для всего кода бота без
+    изменений в обработчиках. Потоки Outbox отправляют напрямую.
+    """
+
+    def __init__(self, *args, outbox: Outbox, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = outbox
+        outbox.bot = self
+
+    def _post(self, endpoint: str, *args, **kwargs):
+        # Все запросы к Bot API: время и ошибки по методу
+        if not self.outbox.in_sender():
+            metrics.count('api')
+        started = time.perf_counter()
+        try:
+            return super()._post(endpoint, *args, **kwargs)
+        except Exception:
+            metrics.inc('bot_api_errors_total', endpoint)
+            raise
+        finally:
+            metrics.observe('bot_api_seconds', time.perf_counter() - started, endpoint)
+
+    def _message(self, endpoint: str, data: Dict[str, Any], *args, **kwargs):
+        if self.outbox.in_sender():
+            return super()._message(endpoint, data, *args, **kwargs)
+        # Запрос уйдёт из потока Outbox - засчитываем его обновлению здесь
+        metrics.count('api')
+        send = super()._message
+        return self.outbox.submit(data.get('chat_id'), send, endpoint, data, *args, **kwargs).result()
+
+    def send_media_group(self, chat_id: ChatId, *args, **kwargs):
+        # sendMediaGroup в PTB 13 идёт мимо _message
+        if self.outbox.in_sender():
+            return super().send_media_group(chat_id, *args, **kwargs)
+        metrics.count('api')
+        send = super().send_media_group
+        return self.outbox.submit(chat_id, send, chat_id, *args, **kwargs).result()
@@ -0,0 +1,152 @@
+import json
+import pickle
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, DefaultDict, Dict, List, Optional, Tuple
+
+from telegram.ext import BasePersistence, ConversationHandler, Dispatcher
+
+logger = logging.getLogger(__name__)
+
+class SQLitePersistence(BasePersistence):
+    """Состояния ConversationHandler и user_data/chat_data в SQLite.
+
+    PTB вызывает update_* после каждого обработанного обновления; здесь
+    запись сразу сериализуется (pickle - это и копия на момент обновления)
+    и помечается изменённой. Запись в базу - в flush(): изменённые записи
+    пишутся одной транзакцией, неизменённые не трогаются. flush() вызывается
+    периодической задачей и PTB при остановке бота.
+
+    load() - все сохранённые строки (kind, key, data);
+    persist([(kind, key, data или None)]) - записать пачку одной транзакцией,
+    None означает удаление. kind: 'user', 'chat' или 'conv:<имя диалога>'.
+    """
+
+    def __init__(self, load: Callable[[], List[Tuple[str, str, bytes]]],
+                 persist: Callable[[List[Tuple[str, str, Optional[bytes]]]], None]):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=False)
+        self._load = load
+        self._persist = persist
+        self._lock = threading.Lock()
+        # Сериализует сбросы, чтобы пачки не обгоняли друг друга
+        self._flush_lock = threading.Lock()
+        self._stored: Optional[Dict[str, Dict[str, Any]]] = None
+        self._dirty: Dict[Tuple[str, str], Optional[bytes]] = {}
+
+    def _loaded(self) -> Dict[str, Dict[str, Any]]:
+        if self._stored is None:
+            stored: Dict[str, Dict[str, Any]] = {}
+            for kind, key, data in self._load():
+                try:
+                    stored.setdefault(kind, {})[key] = pickle.loads(data)
+                except Exception as e:
+                    logger.error(f"Cannot restore {kind} {key}: {e}")
+            self._stored = stored
+            logger.info(f"Persistence loaded: {sum(len(rows) for rows in stored.values())} records")
+        return self._stored
+
+    def _mark(self, kind: str, key: str, value: Any):
+        """Запомнить изменённую запись сериализованной; None - удалить"""
+        data = None
+        if value is not None:
+            try:
+                data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                logger.error(f"Cannot serialize {kind} {key}: {e}")
+                return
+        with self._lock:
+            self._dirty[(kind, key)] = data
+
+    # Bot в user_data не хранится, а данные всё равно сериализуются pickle,
+    # поэтому обход PTB не нужен. Он пересобирает кортежи как
+    # obj.__class__(generator) и падает на NamedTuple (Product в user_data).
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        return obj
+
+    def insert_bot(self, obj: object) -> object:
+        return obj
+
+    # ==================== ЧТЕНИЕ (при старте) ====================
+
+    def get_user_data(self) -> DefaultDict[int, Dict]:
+        rows = self._loaded().get('user', {})
+        return defaultdict(dict, {int(key): value for key, value in rows.items()})
+
+    def get_chat_data(self) -> DefaultDict[int, Dict]:
+        rows = self._loaded().get('chat', {})
+        return defaultdict(dict, {int(key): value for key, value in rows.items()})
+
+    def get_bot_data(self) -> Dict:
+        return {}
+
+    def get_conversations(self, name: str) -> Dict[tuple, object]:
+        rows = self._loaded().get(f'conv:{name}', {})
+        return {tuple(json.loads(key)): state for key, state in rows.items()}
+
+    # ==================== ИЗМЕНЕНИЯ ====================
+
+    def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        # Состояние 0 (MAIN_MENU) - тоже состояние, удаляем только None
+        self._mark(f'conv:{name}', json.dumps(list(key)), new_state)
+
+    def update_user_data(self, user_id: int, data: Dict):
+        self._mark('user', str(user_id), data or None)
+
+    def update_chat_data(self, chat_id: int, data: Dict):
+        self._mark('chat', str(chat_id), data or None)
+
+    def update_bot_data(self, data: Dict):
+        pass
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._dirty)
+
+    def flush(self):
+        """Записать изменённые записи одной транзакцией"""
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+
+            rows = [(kind, key, data) for (kind, key), data in dirty.items()]
+            try:
+                self._persist(rows)
+            except Exception as e:
+                # Вернуть в очередь то, что не успели изменить заново
+                with self._lock:
+                    for item_key, value in dirty.items():
+                        self._dirty.setdefault(item_key, value)
+                logger.error(f"Error flushing persistence ({len(rows)} records): {e}")
+                return
+            logger.debug(f"Persistence flushed: {len(rows)} records")
+
+    # ==================== ВОССТАНОВЛЕНИЕ БАЗЫ ====================
+
+    @contextmanager
+    def replaced(self):
+        """Сбросы приостановлены, пока база заменяется; несохранённые изменения
+        после замены отбрасываются, следующее чтение идёт из новой базы"""
+        with self._flush_lock:
+            yield
+            with self._lock:
+                self._dirty.clear()
+                self._stored = None
+
+    def reload(self, dispatcher: Dispatcher):
+        """Заменить user_data, chat_data и состояния диалогов диспетчера сохранёнными в базе"""
+        user_data = self.get_user_data()
+        chat_data = self.get_chat_data()
+        dispatcher.user_data.clear()
+        dispatcher.user_data.update(user_data)
+        dispatcher.chat_data.clear()
+        dispatcher.chat_data.update(chat_data)
+        for handlers in dispatcher.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler) and handler.persistent and handler.name:
+                    handler.conversations = self.get_conversations(handler.name)
+        logger.info("Conversation state reloaded from database")
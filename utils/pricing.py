@@ -0,0 +1,47 @@
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, List, Mapping
+
+from utils.models import Product, OrderItem
+
+CENT = Decimal('0.01')
+
+def to_money(value) -> Decimal:
+    """Цена из базы (REAL) в точные копейки: через str, без хвостов float"""
+    return Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+def format_money(value: Decimal) -> str:
+    # 500.00 -> "500", 499.90 -> "499.9"
+    text = f"{value:.2f}".rstrip('0').rstrip('.')
+    return text or '0'
+
+class PriceQuote:
+    """Расчёт корзины: позиции, строки для текста заказа, итог и неизвестные товары"""
+
+    __slots__ = ('items', 'lines', 'total', 'unknown')
+
+    def __init__(self):
+        self.items: List[OrderItem] = []
+        self.lines: List[str] = []
+        self.total = Decimal('0.00')
+        self.unknown: List[str] = []
+
+def price_cart(cart: Mapping[str, int], products: Dict[str, Product]) -> PriceQuote:
+    """Посчитать корзину за один проход.
+
+    products - товары корзины по точному названию (одна выборка WHERE name IN).
+    Товары, которых нет в products, попадают в unknown и в сумму не входят:
+    подбирать похожие по названию нельзя - так можно продать не тот товар.
+    """
+    quote = PriceQuote()
+    for name, quantity in cart.items():
+        product = products.get(name)
+        if product is None:
+            quote.unknown.append(name)
+            continue
+
+        unit_price = to_money(product.cost)
+        line_total = unit_price * quantity
+        quote.total += line_total
+        quote.items.append(OrderItem(product.id, name, float(unit_price), quantity))
+        quote.lines.append(f"• {name} x{quantity} - {format_money(line_total)} руб.")
+    return quote
@@ -0,0 +1,160 @@
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Union
+
+from telegram import Update
+from telegram.ext import CallbackContext, Dispatcher, Handler
+
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+Callback = Callable[[Update, CallbackContext], Any]
+
+class Route:
+    """Обработчик маршрута и его счётчики"""
+
+    __slots__ = ('name', 'callback', 'admin', 'hits', 'errors', 'denied', 'time_total', 'time_max')
+
+    def __init__(self, name: str, callback: Callback, admin: bool):
+        self.name = name
+        self.callback = callback
+        self.admin = admin
+        self.hits = 0
+        self.errors = 0
+        self.denied = 0
+        self.time_total = 0.0
+        self.time_max = 0.0
+
+class Router:
+    """Маршруты диалога: (состояние, текст кнопки или префикс callback_data) -> обработчик.
+
+    На каждое состояние - один словарь, поэтому обработчик находится одним
+    поиском по ключу вместо цепочек if/elif и нескольких Filters.regex на
+    обновление. Ключ для кнопки - её текст, для inline-кнопки - часть
+    callback_data до двоеточия вместе с ним ('qty:' для 'qty:+5'). Текст,
+    не совпавший ни с одной кнопкой, получает fallback состояния (поиск,
+    ввод количества и т.п.); команды маршрутизатор не трогает.
+
+    Права администратора проверяются один раз, в маршруте с admin=True.
+    Для каждого маршрута считаются вызовы, отказы, ошибки и время обработки;
+    время и ошибки попадают и в метрики обработчиков (bot_handler_seconds).
+    """
+
+    def __init__(self, is_admin: Callable[[int], bool], denied_text: str):
+        self._is_admin = is_admin
+        self._denied_text = denied_text
+        self._routes: Dict[Hashable, Dict[str, Route]] = {}
+        self._fallbacks: Dict[Hashable, Route] = {}
+        # Один обработчик в разных состояниях - один маршрут с общими счётчиками
+        self._by_name: Dict[str, Route] = {}
+        self._lock = threading.Lock()
+
+    # ==================== ТАБЛИЦА ====================
+
+    def _route(self, callback: Callback, admin: bool, name: Optional[str]) -> Route:
+        name = name or callback.__name__
+        route = self._by_name.get(name)
+        if route is None:
+            route = self._by_name[name] = Route(name, callback, admin)
+        elif route.callback is not callback or route.admin != admin:
+            raise ValueError(f"Route name {name!r} is used for different handlers")
+        return route
+
+    def add(self, state: Hashable, keys: Union[str, Iterable[str]], callback: Callback,
+            admin: bool = False, name: Optional[str] = None):
+        route = self._route(callback, admin, name)
+        routes = self._routes.setdefault(state, {})
+        for key in ([keys] if isinstance(keys, str) else keys):
+            if key in routes:
+                raise ValueError(f"Route {key!r} is already defined for state {state}")
+            routes[key] = route
+
+    def fallback(self, state: Hashable, callback: Callback, admin: bool = False, name: Optional[str] = None):
+        if state in self._fallbacks:
+            raise ValueError(f"Fallback is already defined for state {state}")
+        self._fallbacks[state] = self._route(callback, admin, name)
+
+    def handler(self, state: Hashable) -> 'RouteHandler':
+        """Обработчик PTB для списка состояния в ConversationHandler"""
+        return RouteHandler(self, state)
+
+    # ==================== ОБРАБОТКА ====================
+
+    def match(self, state: Hashable, update: Update) -> Optional[Route]:
+        routes = self._routes.get(state, {})
+        if update.callback_query is not None:
+            data = update.callback_query.data or ''
+            return routes.get(data[:data.find(':') + 1] or data)
+
+        message = update.message
+        if message is None or message.text is None or message.text.startswith('/'):
+            return None
+        return routes.get(message.text) or self._fallbacks.get(state)
+
+    def dispatch(self, route: Route, update: Update, context: CallbackContext) -> Any:
+        user = update.effective_user
+        if route.admin and (user is None or not self._is_admin(user.id)):
+            with self._lock:
+                route.denied += 1
+            logger.warning(f"Route {route.name} denied for user {user.id if user else None}")
+            if update.callback_query is not None:
+                update.callback_query.answer(self._denied_text)
+            else:
+                update.effective_message.reply_text(self._denied_text)
+            return None
+
+        started = time.perf_counter()
+        failed = False
+        try:
+            return route.callback(update, context)
+        except Exception:
+            failed = True
+            metrics.inc('bot_handler_errors_total', route.name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe('bot_handler_seconds', elapsed, route.name)
+            with self._lock:
+                route.hits += 1
+                route.errors += failed
+                route.time_total += elapsed
+                if elapsed > route.time_max:
+                    route.time_max = elapsed
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Счётчики маршрутов, самые частые первыми"""
+        with self._lock:
+            stats = [
+                {
+                    'name': route.name,
+                    'hits': route.hits,
+                    'errors': route.errors,
+                    'denied': route.denied,
+                    'time_total': route.time_total,
+                    'time_avg': route.time_total / route.hits if route.hits else 0.0,
+                    'time_max': route.time_max,
+                }
+                for route in self._by_name.values()
+            ]
+        return sorted(stats, key=lambda item: -item['hits'])
+
+class RouteHandler(Handler):
+    """Handler PTB, который находит маршрут состояния в Router"""
+
+    __slots__ = ('router', 'state')
+
+    def __init__(self, router: Router, state: Hashable):
+        super().__init__(router.dispatch)
+        self.router = router
+        self.state = state
+
+    def check_update(self, update: object) -> Optional[Route]:
+        if not isinstance(update, Update):
+            return None
+        return self.router.match(self.state, update)
+
+    def handle_update(self, update: Update, dispatcher: Dispatcher, check_result: Route,
+                      context: CallbackContext = None) -> Any:
+        return self.router.dispatch(check_result, update, context)
@@ -0,0 +1,80 @@
+import re
+from difflib import SequenceMatcher
+from typing import Iterable, List, Optional
+
+from utils.models import Product
+
+# Сколько результатов поиска показывать покупателю
+SEARCH_LIMIT = 15
+
+# Кандидатов из триграммного индекса для пересчёта похожести
+FUZZY_CANDIDATES = 50
+
+# Минимальная похожесть названия на запрос при поиске с опечатками
+FUZZY_MIN_RATIO = 0.45
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+def normalize(text: str) -> str:
+    return ' '.join(_WORD_RE.findall(text.lower().replace('ё', 'е')))
+
+def prefix_query(text: str) -> Optional[str]:
+    """Запрос FTS5: все слова запроса как префиксы ("pod"* AND "salt"*).
+
+    Слова берутся в кавычки, поэтому операторы и спецсимволы FTS5 из
+    пользовательского ввода не интерпретируются.
+    """
+    words = normalize(text).split()
+    if not words:
+        return None
+    return ' AND '.join(f'"{word}"*' for word in words)
+
+def trigram_query(text: str) -> Optional[str]:
+    """Запрос к триграммному индексу: любая из триграмм слов запроса.
+
+    Опечатка портит не больше трёх триграмм слова, остальные совпадают,
+    поэтому кандидат всё равно находится; ранжирование по bm25.
+    """
+    trigrams = []
+    for word in normalize(text).split():
+        for i in range(len(word) - 2):
+            trigram = word[i:i + 3]
+            if trigram not in trigrams:
+                trigrams.append(trigram)
+    if not trigrams:
+        return None
+    return ' OR '.join(f'"{trigram}"' for trigram in trigrams)
+
+def prefix_scan(text: str, products: Iterable[Product]) -> List[Product]:
+    """Поиск без FTS5: товары в наличии, где каждое слово запроса - префикс
+    слова названия, категории или описания. Совпадения в названии - первыми."""
+    query = normalize(text).split()
+    in_name = []
+    elsewhere = []
+    for product in products:
+        if product.quantity <= 0:
+            continue
+        name = normalize(product.name).split()
+        words = name + normalize(f"{product.category} {product.description or ''}").split()
+        if not all(any(word.startswith(part) for word in words) for part in query):
+            continue
+        if all(any(word.startswith(part) for word in name) for part in query):
+            in_name.append(product)
+        else:
+            elsewhere.append(product)
+    return in_name + elsewhere
+
+def rank_fuzzy(text: str, products: Iterable[Product], limit: int = SEARCH_LIMIT) -> List[Product]:
+    """Отсортировать кандидатов по похожести названия и отбросить непохожие"""
+    query = normalize(text)
+    scored = []
+    for product in products:
+        name = normalize(product.name)
+        ratio = SequenceMatcher(None, query, name).ratio()
+        # Запрос может быть похож на часть длинного названия
+        for word in name.split():
+            ratio = max(ratio, SequenceMatcher(None, query, word).ratio())
+        if ratio >= FUZZY_MIN_RATIO:
+            scored.append((ratio, product))
+    scored.sort(key=lambda item: -item[0])
+    return [product for _, product in scored[:limit]]